@@ -0,0 +1,215 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Build cloud-init NoCloud seed images in memory.
+#
+# The image is an ISO 9660 filesystem labelled "cidata", as made by
+# cloud-localds, with a Joliet tree so that the files keep their real names
+# when mounted. Only a flat root directory of small files is supported,
+# which is all that a seed needs.
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import struct
+import time
+
+SECTOR_SIZE = 2048
+VOLUME_ID = 'cidata'
+
+# Sectors 0-15 are the system area, then the primary and Joliet volume
+# descriptors and the terminator.
+_PRIMARY_DESCRIPTOR = 16
+_JOLIET_DESCRIPTOR = 17
+_TERMINATOR = 18
+_FIRST_FREE = 19
+
+# Joliet UCS-2 level 3
+_JOLIET_ESCAPE = b'%/E'
+
+
+def _both16(n):
+    return struct.pack('<H', n) + struct.pack('>H', n)
+
+
+def _both32(n):
+    return struct.pack('<I', n) + struct.pack('>I', n)
+
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _pad(data, size, fill=b'\0'):
+    assert len(data) <= size
+    return data + fill * (size - len(data))
+
+
+def _text(s, size, joliet):
+    if joliet:
+        return _pad(s.encode('utf-16-be'), size, b'\0 ')[:size]
+    return _pad(s.encode('ascii'), size, b' ')
+
+
+def _volume_datetime(t):
+    tm = time.gmtime(t)
+    return (time.strftime('%Y%m%d%H%M%S', tm) + '00').encode('ascii') + b'\0'
+
+
+def _record_datetime(t):
+    tm = time.gmtime(t)
+    return struct.pack(
+        'BBBBBBb', tm.tm_year - 1900, tm.tm_mon, tm.tm_mday, tm.tm_hour,
+        tm.tm_min, tm.tm_sec, 0
+    )
+
+
+def _primary_name(name):
+    """Return the ISO 9660 level 1 identifier for name."""
+    base, dot, extension = name.upper().rpartition('.')
+    if not dot:
+        base, extension = extension, ''
+    base = re.sub('[^A-Z0-9_]', '_', base)[:8]
+    extension = re.sub('[^A-Z0-9_]', '_', extension)[:3]
+    return ('%s.%s;1' % (base, extension)).encode('ascii')
+
+
+def _joliet_name(name):
+    return (name + ';1').encode('utf-16-be')
+
+
+def _directory_record(identifier, extent, size, t, is_directory=False):
+    record = (
+        b'\0' + _both32(extent) + _both32(size) + _record_datetime(t) +
+        struct.pack('BBB', 2 if is_directory else 0, 0, 0) + _both16(1) +
+        struct.pack('B', len(identifier)) + identifier
+    )
+    if len(identifier) % 2 == 0:
+        record += b'\0'
+    return struct.pack('B', len(record) + 1) + record
+
+
+def _directory(records):
+    """Lay out directory records, none of which may cross a sector."""
+    data = b''
+    for record in records:
+        if len(data) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+            data = _pad(data, _sectors(len(data)) * SECTOR_SIZE)
+        data += record
+    return _pad(data, _sectors(len(data)) * SECTOR_SIZE)
+
+
+def _path_table(root_extent, big_endian):
+    order = '>' if big_endian else '<'
+    return struct.pack(order + 'BBIH', 1, 0, root_extent, 1) + b'\0\0'
+
+
+def _volume_descriptor(joliet, volume_id, volume_size, root_extent,
+        root_size, path_table_extents, t):
+    path_table_size = len(_path_table(0, False))
+    l_path_table, m_path_table = path_table_extents
+    return _pad(
+        struct.pack('B', 2 if joliet else 1) + b'CD001\x01\0' +
+        _text('', 32, joliet) + _text(volume_id, 32, joliet) + b'\0' * 8 +
+        _both32(volume_size) +
+        _pad(_JOLIET_ESCAPE if joliet else b'', 32) +
+        _both16(1) + _both16(1) + _both16(SECTOR_SIZE) +
+        _both32(path_table_size) +
+        struct.pack('<II', l_path_table, 0) +
+        struct.pack('>II', m_path_table, 0) +
+        _directory_record(b'\0', root_extent, root_size, t, True) +
+        _text('', 128, joliet) * 4 + _text('', 37, joliet) * 3 +
+        _volume_datetime(t) * 2 + b'0' * 16 + b'\0' + _volume_datetime(t) +
+        b'\x01',
+        SECTOR_SIZE
+    )
+
+
+def make_iso(files, volume_id=VOLUME_ID, now=None):
+    """Return an ISO 9660 image, with Joliet names, containing files.
+
+    files is a sequence of (name, data) to put in the root directory.
+
+    """
+    if now is None:
+        now = time.time()
+    files = sorted(files)
+    primary_names = [_primary_name(name) for name, _ in files]
+    if len(set(primary_names)) != len(primary_names):
+        raise ValueError("file names are not unique in ISO 9660")
+
+    # The root directories only hold a few records each, so lay them out
+    # once to find their size before their extents are known.
+    def root_records(names, extents, root_extent, root_size):
+        return [
+            _directory_record(b'\0', root_extent, root_size, now, True),
+            _directory_record(b'\1', root_extent, root_size, now, True),
+        ] + [
+            _directory_record(name, extent, len(data), now)
+            for name, extent, (_, data) in zip(names, extents, files)
+        ]
+
+    joliet_names = [_joliet_name(name) for name, _ in files]
+    primary_size = len(_directory(
+        root_records(primary_names, [0] * len(files), 0, 0)))
+    joliet_size = len(_directory(
+        root_records(joliet_names, [0] * len(files), 0, 0)))
+
+    # Path tables: primary L and M, then Joliet L and M.
+    path_tables = range(_FIRST_FREE, _FIRST_FREE + 4)
+    primary_root = _FIRST_FREE + 4
+    joliet_root = primary_root + _sectors(primary_size)
+    extent = joliet_root + _sectors(joliet_size)
+    extents = []
+    for _, data in files:
+        extents.append(extent)
+        extent += _sectors(len(data))
+    volume_size = extent
+
+    image = bytearray(volume_size * SECTOR_SIZE)
+
+    def put(sector, data):
+        image[sector * SECTOR_SIZE:sector * SECTOR_SIZE + len(data)] = data
+
+    put(_PRIMARY_DESCRIPTOR, _volume_descriptor(
+        False, volume_id, volume_size, primary_root, primary_size,
+        path_tables[0:2], now
+    ))
+    put(_JOLIET_DESCRIPTOR, _volume_descriptor(
+        True, volume_id, volume_size, joliet_root, joliet_size,
+        path_tables[2:4], now
+    ))
+    put(_TERMINATOR, _pad(b'\xffCD001\x01', SECTOR_SIZE))
+    put(path_tables[0], _path_table(primary_root, False))
+    put(path_tables[1], _path_table(primary_root, True))
+    put(path_tables[2], _path_table(joliet_root, False))
+    put(path_tables[3], _path_table(joliet_root, True))
+    put(primary_root, _directory(root_records(
+        primary_names, extents, primary_root, primary_size)))
+    put(joliet_root, _directory(root_records(
+        joliet_names, extents, joliet_root, joliet_size)))
+    for extent, (_, data) in zip(extents, files):
+        put(extent, data)
+    return bytes(image)
+
+
+def make_seed_image(user_data, meta_data, now=None):
+    """Return a NoCloud seed image holding user_data and meta_data, which
+    are bytes."""
+    return make_iso(
+        [('user-data', user_data), ('meta-data', meta_data)], now=now)
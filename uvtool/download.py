@@ -0,0 +1,290 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An on-disk cache of image downloads, so that interrupted ones can resume.
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import hashlib
+import io
+import json
+import os
+import time
+import urllib
+import urllib2
+import urlparse
+
+PARTIAL_SUFFIX = '.partial'
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def open_url(url, offset=0):
+    """Open url for reading, starting at offset if possible.
+
+    Local paths and file:// URLs are seeked. Anything else is fetched with
+    urllib2 using a Range header.
+
+    Return (fobj, offset), where offset is where fobj actually starts. This
+    is zero if the server ignored the range.
+
+    """
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme in ('', 'file'):
+        if parsed.scheme:
+            path = urllib.url2pathname(parsed.path)
+        else:
+            path = url
+        fobj = open(path, 'rb')
+        fobj.seek(offset)
+        return fobj, offset
+
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    response = urllib2.urlopen(request)
+    if offset and response.getcode() != 206:
+        return response, 0
+    return response, offset
+
+
+class DownloadError(RuntimeError):
+    """A download did not end at its expected size."""
+    pass
+
+
+def _expected_size(fobj, offset):
+    """Return the full size of the download that fobj reads from offset on,
+    or None if that cannot be found out."""
+    info = getattr(fobj, 'info', None)
+    if info is not None:
+        length = info().getheader('Content-Length')
+        if length is None:
+            return None
+        return offset + int(length)
+    try:
+        return os.fstat(fobj.fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+class _CachingReader(object):
+    """Read a download through its cache entry.
+
+    Any data already in the partial file is read back first, then the rest
+    comes from source and is appended to the partial file. When source is
+    exhausted, the partial file must have reached expected_size (if known);
+    otherwise DownloadError is raised. A short download is kept to be
+    resumed, but one that ran long cannot be trusted and is thrown away.
+
+    """
+    def __init__(self, partial, source, expected_size=None):
+        self._partial = partial
+        self._source = source
+        self._expected_size = expected_size
+        self._replaying = True
+        self._complete = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(io.DEFAULT_BUFFER_SIZE), b''))
+        if self._replaying:
+            data = self._partial.read(size)
+            if data:
+                return data
+            self._replaying = False
+        data = self._source.read(size)
+        if data:
+            self._partial.write(data)
+        elif not self._complete:
+            self._check_size()
+            self._complete = True
+        return data
+
+    def _check_size(self):
+        actual = self._partial.tell()
+        if self._expected_size is None or actual == self._expected_size:
+            return
+        if actual > self._expected_size:
+            self._partial.truncate(0)
+        raise DownloadError(
+            "expected %d bytes but got %d" % (self._expected_size, actual))
+
+    def close(self):
+        if self._partial:
+            self._partial.close()
+            self._partial = None
+        self._source.close()
+
+
+class DownloadCache(object):
+    """Keep downloads on disk until they have been imported.
+
+    Entries are keyed by what was downloaded, including its published
+    checksum, so that a changed image is never confused with an old one.
+    Only downloads that are incomplete, or not yet imported, are kept; the
+    caller discards each entry once it is done with it.
+
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(product_name, version_name, item_name, checksum):
+        return hashlib.sha256(json.dumps(
+            [product_name, version_name, item_name, checksum]
+        ).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + PARTIAL_SUFFIX)
+
+    def open(self, key, url, source=None, size=None, wrap_source=None):
+        """Return a reader for the download of url.
+
+        The download is resumed from where any earlier one for key stopped,
+        or started from source (or url if source is None) if there is
+        nothing to resume. Everything read from the network is also
+        appended to the entry, which stays locked until the reader is closed.
+
+        size is the expected size of the download. If it is None, then the
+        size reported by the server is used if there is one.
+
+        If another process is already downloading into the same entry, or we
+        are not allowed to write to the cache, then return None, and the
+        caller should read source uncached instead.
+
+        wrap_source, if given, is called on whatever will be read from url
+        (but not on data read from the cache), and its result read instead.
+
+        """
+        if wrap_source is None:
+            wrap_source = lambda fobj: fobj
+
+        path = self.path(key)
+        try:
+            _mkdir_p(self.cache_dir)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            if e.errno not in [errno.EACCES, errno.EPERM, errno.EROFS]:
+                raise
+            return None
+        partial = io.FileIO(fd, 'r+')
+        try:
+            fcntl.flock(partial.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            partial.close()
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            return None
+
+        try:
+            offset = os.fstat(partial.fileno()).st_size
+            if size is not None and offset > size:
+                offset = 0
+            if size is not None and offset == size:
+                # Already complete; just not imported yet.
+                source = io.BytesIO()
+            else:
+                if offset or source is None:
+                    source, offset = open_url(url, offset)
+                if size is None:
+                    size = _expected_size(source, offset)
+                source = wrap_source(source)
+            if not offset:
+                partial.truncate(0)
+        except:
+            partial.close()
+            raise
+        return _CachingReader(partial, source, size)
+
+    def discard(self, key):
+        _unlink_if_exists(self.path(key))
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        entries = []
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((path, os.stat(path)))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return entries
+
+    @staticmethod
+    def _in_use(partial_path):
+        try:
+            with open(partial_path, 'rb') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in [errno.EAGAIN, errno.EACCES]:
+                return True
+            if e.errno != errno.ENOENT:
+                raise
+        return False
+
+    def evict(self, max_size=None, max_age=None):
+        """Remove entries older than max_age seconds, then the least recently
+        used until the total is at most max_size bytes.
+
+        Return the number of bytes removed.
+
+        """
+        removed = 0
+        kept = []
+        now = time.time()
+        for path, st in sorted(
+                self._entries(), key=lambda entry: entry[1].st_mtime):
+            if path.endswith(PARTIAL_SUFFIX) and self._in_use(path):
+                continue
+            if max_age is not None and now - st.st_mtime > max_age:
+                _unlink_if_exists(path)
+                removed += st.st_size
+            else:
+                kept.append((path, st))
+        if max_size is not None:
+            total = sum(st.st_size for path, st in kept)
+            for path, st in kept:
+                if total <= max_size:
+                    break
+                _unlink_if_exists(path)
+                total -= st.st_size
+                removed += st.st_size
+        return removed
@@ -0,0 +1,120 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Facts about the host that take a subprocess to find out, cached between
+# invocations so that the command line tools start quickly.
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import errno
+import json
+import os
+import subprocess
+import time
+
+FACTS_FILE = 'facts.json'
+
+# distro-info answers from this file and from the current date.
+DISTRO_INFO_CSV = '/usr/share/distro-info/ubuntu.csv'
+LTS_SERIES_MAX_AGE = 24 * 60 * 60
+
+DPKG = '/usr/bin/dpkg'
+
+
+def cache_dir():
+    """Return the directory for uvtool's per-user caches."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'uvtool')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def _load(path):
+    try:
+        with codecs.open(path, 'rb', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save(path, facts):
+    # tempfile is slow to import, and only needed once facts have changed.
+    import tempfile
+    # Another invocation may be writing at the same time, so replace the
+    # file atomically. Failing to cache is harmless.
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(facts).encode('utf-8'))
+        os.rename(temp_path, path)
+    except EnvironmentError:
+        pass
+
+
+def cached(name, compute, max_age=None, depends=()):
+    """Return the value of compute(), remembered from a previous call if
+    possible.
+
+    A remembered value is used if it is less than max_age seconds old (or
+    any age if max_age is None) and none of the files in depends have
+    changed since. The value must be serializable as JSON.
+
+    """
+    path = os.path.join(cache_dir(), FACTS_FILE)
+    facts = _load(path)
+    mtimes = dict((dependency, _mtime(dependency)) for dependency in depends)
+    now = time.time()
+    fact = facts.get(name)
+    if (isinstance(fact, dict) and fact.get('depends') == mtimes and
+            (max_age is None or 0 <= now - fact.get('time', 0) < max_age)):
+        return fact['value']
+    value = compute()
+    facts[name] = {'value': value, 'time': now, 'depends': mtimes}
+    _save(path, facts)
+    return value
+
+
+def _check_output(args):
+    return subprocess.check_output(args, close_fds=True).decode().strip()
+
+
+def lts_series():
+    return cached(
+        'lts_series', lambda: _check_output(['distro-info', '--lts']),
+        max_age=LTS_SERIES_MAX_AGE, depends=[DISTRO_INFO_CSV]
+    )
+
+
+def system_arch():
+    return cached(
+        'system_arch',
+        lambda: _check_output(['dpkg', '--print-architecture']),
+        depends=[DPKG]
+    )
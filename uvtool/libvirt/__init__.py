@@ -19,22 +19,158 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import codecs
+import collections
 import contextlib
+import errno
+import fcntl
+import io
 import itertools
 import os
-import shutil
+import stat
 import subprocess
-import tempfile
+import threading
+import time
 
-import libvirt
-from lxml import etree
-from lxml.builder import E
+from uvtool.lazy import LazyModule
+
+# These are slow to import, so only import them once they are used.
+libvirt = LazyModule('libvirt')
+etree = LazyModule('lxml.etree')
+E = LazyModule('lxml.builder', 'E')
 
 LIBVIRT_DNSMASQ_LEASE_FILE = '/var/lib/libvirt/dnsmasq/default.leases'
+LIBVIRT_URI = 'qemu:///system'
 
 # The xmlns used for custom libvirt domain xml storage
 LIBVIRT_METADATA_XMLNS = 'https://launchpad.net/uvtool/libvirt/1'
 
+# Data is read from a source file object in blocks of STREAM_BLOCK_SIZE
+# bytes, and up to STREAM_QUEUE_DEPTH such blocks may be buffered in memory
+# ahead of libvirt.
+STREAM_BLOCK_SIZE = 1024 * 1024
+STREAM_QUEUE_DEPTH = 16
+
+# Appended to the name of a volume being created to name the temporary
+# volume that it is converted from. Any left behind after an interruption are
+# removed by a full garbage collection of the pool; see
+# uvtool.libvirt.simplestreams.clean_extraneous_images.
+STAGING_VOLUME_SUFFIX = '.partial'
+
+# When a source is not a regular file, holes are found by looking for runs of
+# blocks of this size that are entirely zero.
+SPARSE_SCAN_BLOCK_SIZE = 64 * 1024
+
+# Python 2 does not define these, but Linux does.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# The most to ask copy_file_range(2) or sendfile(2) to copy in one call.
+LOCAL_COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+
+# Errors that mean that a method of copying between two files isn't
+# available for them, rather than that something went wrong.
+_COPY_UNSUPPORTED_ERRNOS = frozenset([
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+])
+
+
+# Shared connections send a keepalive every KEEPALIVE_INTERVAL seconds if
+# the session asks for it, and are considered dead after KEEPALIVE_COUNT
+# go unanswered.
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# Counts of expensive operations, such as opening a libvirt connection, so
+# that their cost can be measured and tested.
+counters = collections.Counter()
+
+
+def open_connection(uri=LIBVIRT_URI):
+    """Open a new libvirt connection. Most callers want get_connection()."""
+    counters['connections'] += 1
+    return libvirt.open(uri)
+
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def _start_event_loop():
+    """Run libvirt's default event loop, which keepalives need, in the
+    background. This must happen before the connection is opened."""
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is None:
+            libvirt.virEventRegisterDefaultImpl()
+            _event_loop_thread = threading.Thread(target=_run_event_loop)
+            _event_loop_thread.daemon = True
+            _event_loop_thread.start()
+
+
+class Session(object):
+    """Open one libvirt connection per URI when first needed and reuse it.
+
+    A cached connection that has died is replaced. If keepalive is True,
+    then new connections send keepalives so that a dead libvirtd is noticed
+    during long operations; this runs libvirt's event loop in a thread.
+
+    """
+    def __init__(self, keepalive=False):
+        self.keepalive = keepalive
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get_connection(self, uri=LIBVIRT_URI):
+        with self._lock:
+            conn = self._connections.get(uri)
+            if conn is not None:
+                try:
+                    alive = conn.isAlive()
+                except libvirt.libvirtError:
+                    alive = False
+                if alive:
+                    counters['connection_reuses'] += 1
+                    return conn
+            if self.keepalive:
+                _start_event_loop()
+            conn = open_connection(uri)
+            if self.keepalive:
+                conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            self._connections[uri] = conn
+            return conn
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except libvirt.libvirtError:
+                pass
+
+
+# The session used by everything in uvtool that isn't given a connection.
+session = Session()
+
+
+def get_connection(uri=LIBVIRT_URI):
+    """Return the shared connection to uri."""
+    return session.get_connection(uri)
+
+
+def format_counters():
+    return ' '.join(
+        '%s=%d' % (name, count) for name, count in sorted(counters.items()))
+
 
 def get_libvirt_pool_object(libvirt_conn, pool_name):
     try:
@@ -44,40 +180,683 @@ def get_libvirt_pool_object(libvirt_conn, pool_name):
     return pool
 
 
+class _BoundedReader(object):
+    """Read from a file object in a background thread into reused buffers.
+
+    queue_depth buffers of block_size bytes are allocated up front and cycled
+    between the reading thread and the consumer. This lets a slow source
+    (such as a network download) be read concurrently with data being sent
+    on to libvirt, with bounded memory use and no allocation per block.
+
+    """
+    def __init__(self, fobj, block_size=STREAM_BLOCK_SIZE,
+            queue_depth=STREAM_QUEUE_DEPTH):
+        import Queue
+        self._fobj = fobj
+        self._free = Queue.Queue()
+        for i in range(queue_depth):
+            self._free.put(bytearray(block_size))
+        self._full = Queue.Queue()
+        self._closed = threading.Event()
+        self.read_calls = 0
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get(self, queue, closable=False):
+        import Queue
+        # Queue.get() without a timeout cannot be interrupted by SIGINT in
+        # Python 2, so poll instead. The reading thread gives up if the
+        # consumer has gone away rather than waiting forever for a buffer.
+        while not (closable and self._closed.is_set()):
+            try:
+                return queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+        return None
+
+    def _fill(self):
+        try:
+            while True:
+                buf = self._get(self._free, closable=True)
+                if buf is None:
+                    return
+                length = _read_block(self._fobj, buf)
+                self.read_calls += 1
+                self._full.put((buf, length, None))
+                if not length:
+                    return
+        except Exception as e:
+            self._full.put((None, 0, e))
+
+    def blocks(self):
+        """Generate (buffer, length) for each block read, until EOF.
+
+        Each buffer is reused once the consumer asks for the next block.
+
+        """
+        while True:
+            buf, length, error = self._get(self._full)
+            if error is not None:
+                raise error
+            if not length:
+                return
+            try:
+                yield buf, length
+            finally:
+                self._free.put(buf)
+
+    def close(self):
+        self._closed.set()
+
+
+class _DirectReader(object):
+    """Read from a file object into one reused buffer, as _BoundedReader
+    does but without a thread.
+
+    This is for sources that are already in memory or fit in one block,
+    which a reading thread and a ring of buffers would only slow down.
+
+    """
+    def __init__(self, fobj, block_size=STREAM_BLOCK_SIZE):
+        self._fobj = fobj
+        self._buf = bytearray(block_size)
+        self.read_calls = 0
+
+    def blocks(self):
+        while True:
+            length = _read_block(self._fobj, self._buf)
+            self.read_calls += 1
+            if not length:
+                return
+            yield self._buf, length
+
+    def close(self):
+        pass
+
+
+def _read_block(fobj, buf):
+    """Read from fobj into buf and return the length read."""
+    readinto = getattr(fobj, 'readinto', None)
+    if readinto is None:
+        data = fobj.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+    return readinto(buf) or 0
+
+
+def _open_reader(fobj, block_size, size=None):
+    """Return a reader of fobj's blocks suited to it.
+
+    If size, the length of the data left in fobj, is known, then no more
+    buffer space than that is allocated.
+
+    """
+    queue_depth = STREAM_QUEUE_DEPTH
+    if size is not None:
+        block_size = max(1, min(block_size, size))
+        queue_depth = min(queue_depth, -(-size // block_size))
+    if isinstance(fobj, io.BytesIO) or queue_depth <= 1:
+        return _DirectReader(fobj, block_size=block_size)
+    return _BoundedReader(
+        fobj, block_size=block_size, queue_depth=queue_depth)
+
+
+def _fobj_size(fobj):
+    """Return the size of the data left in fobj, or None if unknown."""
+    try:
+        fileno = fobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        pass
+    else:
+        st = os.fstat(fileno)
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size - fobj.tell()
+    try:
+        position = fobj.tell()
+        fobj.seek(0, os.SEEK_END)
+        end = fobj.tell()
+        fobj.seek(position)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return end - position
+
+
+class UploadStats(object):
+    """Counters for a volume upload.
+
+    Pass an instance as the stats argument to create_volume_from_fobj to
+    find out how much data was actually transferred to libvirt, how much was
+    skipped by sending it as holes in a sparse stream, and how many calls and
+    how long it took to do it.
+
+    method is one of "stream" or "sparse stream" for uploads through libvirt,
+    or "reflink", "copy_file_range", "sendfile" or "qemu-img convert" if the
+    volume was filled directly on this host. For the copies, "sends" counts
+    copy calls.
+
+    """
+    def __init__(self):
+        self.method = None
+        self.sparse = False
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        self.read_calls = 0
+        self.send_calls = 0
+        self.hole_calls = 0
+        self.seconds = 0.0
+
+    @property
+    def bytes_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.bytes_sent / self.seconds
+
+    def __str__(self):
+        return (
+            "%d bytes sent, %d bytes skipped as holes using %s; "
+            "%d reads, %d sends, %d holes in %.2fs (%.1f MB/s)" % (
+                self.bytes_sent,
+                self.bytes_skipped,
+                self.method,
+                self.read_calls,
+                self.send_calls,
+                self.hole_calls,
+                self.seconds,
+                self.bytes_per_second / 1000000,
+            )
+        )
+
+
+def _file_section(fd, position, end):
+    """Return (in_data, length) for the section of fd starting at position.
+
+    Holes are found using SEEK_DATA and SEEK_HOLE.
+
+    """
+    remaining = end - position
+    try:
+        data = os.lseek(fd, position, SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # There is no more data before EOF.
+            return False, remaining
+        elif e.errno == errno.EINVAL:
+            # The filesystem cannot tell us, so treat it all as data.
+            return True, remaining
+        raise
+    if data > position:
+        return False, min(data, end) - position
+    hole = os.lseek(fd, position, SEEK_HOLE)
+    return True, min(hole, end) - position
+
+
+def _file_sections(fobj, block_size, sparse, stats):
+    """Generate (in_data, buffer, offset, length) for a regular file.
+
+    The file descriptor is read directly and the file object's own position
+    and buffering are bypassed. Data sections are read block_size bytes at a
+    time into a single reused buffer.
+
+    """
+    fd = fobj.fileno()
+    position = fobj.tell()
+    end = os.fstat(fd).st_size
+    raw = io.FileIO(fd, closefd=False)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    while position < end:
+        if sparse:
+            in_data, length = _file_section(fd, position, end)
+        else:
+            in_data, length = True, end - position
+        if not in_data:
+            yield False, None, 0, length
+            position += length
+            continue
+        section_end = position + length
+        raw.seek(position)
+        while position < section_end:
+            read_length = raw.readinto(
+                view[:min(block_size, section_end - position)])
+            stats.read_calls += 1
+            if not read_length:
+                # The file was truncated underneath us.
+                return
+            yield True, buf, 0, read_length
+            position += read_length
+
+
+def _stream_sections(fobj, block_size, sparse, stats, size=None):
+    """Generate (in_data, buffer, offset, length) for any file object.
+
+    If sparse is True, each block is checked for runs of zeros
+    SPARSE_SCAN_BLOCK_SIZE bytes at a time, and these are reported as holes.
+    size, if known, is the length of the data left in fobj.
+
+    """
+    reader = _open_reader(fobj, block_size, size)
+    try:
+        hole = 0
+        for buf, length in reader.blocks():
+            if not sparse:
+                yield True, buf, 0, length
+                continue
+            data_start = None
+            for offset in range(0, length, SPARSE_SCAN_BLOCK_SIZE):
+                chunk = min(SPARSE_SCAN_BLOCK_SIZE, length - offset)
+                if buf.count(b'\0', offset, offset + chunk) == chunk:
+                    if data_start is not None:
+                        yield True, buf, data_start, offset - data_start
+                        data_start = None
+                    hole += chunk
+                else:
+                    if hole:
+                        yield False, None, 0, hole
+                        hole = 0
+                    if data_start is None:
+                        data_start = offset
+            if data_start is not None:
+                yield True, buf, data_start, length - data_start
+        if hole:
+            yield False, None, 0, hole
+    finally:
+        reader.close()
+        stats.read_calls += reader.read_calls
+
+
+def _is_regular_file(fobj):
+    try:
+        fileno = fobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return stat.S_ISREG(os.fstat(fileno).st_mode)
+
+
+def _send_to_stream(stream, fobj, sparse, stats, block_size, size=None):
+    if _is_regular_file(fobj):
+        sections = _file_sections(fobj, block_size, sparse, stats)
+    else:
+        sections = _stream_sections(fobj, block_size, sparse, stats, size)
+
+    start_time = time.time()
+    try:
+        for in_data, buf, offset, length in sections:
+            if not in_data:
+                stream.sendHole(length, 0)
+                stats.hole_calls += 1
+                stats.bytes_skipped += length
+                continue
+            while length:
+                # buffer() gives libvirt a read-only view without a copy.
+                sent = stream.send(buffer(buf, offset, length))
+                stats.send_calls += 1
+                if sent < 0:
+                    raise RuntimeError(
+                        "Unexpected return %d from virStreamSend." % sent)
+                stats.bytes_sent += sent
+                offset += sent
+                length -= sent
+    finally:
+        stats.seconds += time.time() - start_time
+
+
+# ctypes is only imported by the functions below, which are only needed for
+# local copies; ctypes.util in particular is slow to import.
+def _get_libc():
+    import ctypes.util
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def _check_libc_result(result):
+    import ctypes
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def _copy_file_range(src_fd, src_offset, dst_fd, dst_offset, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(
+            src_fd, dst_fd, count, src_offset, dst_offset)
+    import ctypes
+    # Raises AttributeError if glibc is older than 2.27.
+    copy_file_range = _get_libc().copy_file_range
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+        ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+        ctypes.c_size_t, ctypes.c_uint,
+    ]
+    return _check_libc_result(copy_file_range(
+        src_fd, ctypes.byref(ctypes.c_longlong(src_offset)),
+        dst_fd, ctypes.byref(ctypes.c_longlong(dst_offset)),
+        count, 0
+    ))
+
+
+def _sendfile(src_fd, src_offset, dst_fd, dst_offset, count):
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dst_fd, src_fd, src_offset, count)
+    import ctypes
+    sendfile = _get_libc().sendfile
+    sendfile.restype = ctypes.c_ssize_t
+    sendfile.argtypes = [
+        ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t,
+    ]
+    return _check_libc_result(sendfile(
+        dst_fd, src_fd, ctypes.byref(ctypes.c_longlong(src_offset)), count))
+
+
+def _copy_range(src_fd, src_offset, dst_fd, dst_offset, length, stats):
+    """Copy length bytes between file descriptors inside the kernel.
+
+    copy_file_range(2) is tried first, since it can share extents on
+    filesystems that support it. sendfile(2) is the fallback.
+
+    """
+    while length > 0:
+        count = min(length, LOCAL_COPY_CHUNK_SIZE)
+        if stats.method == 'copy_file_range':
+            try:
+                copied = _copy_file_range(
+                    src_fd, src_offset, dst_fd, dst_offset, count)
+            except AttributeError:
+                stats.method = 'sendfile'
+                continue
+            except OSError as e:
+                if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                    raise
+                stats.method = 'sendfile'
+                continue
+        else:
+            copied = _sendfile(src_fd, src_offset, dst_fd, dst_offset, count)
+        stats.send_calls += 1
+        if not copied:
+            raise IOError("Source file shrank during copy.")
+        stats.bytes_sent += copied
+        src_offset += copied
+        dst_offset += copied
+        length -= copied
+
+
+def _is_local_dir_pool(conn, pool):
+    import urlparse
+    if urlparse.urlparse(conn.getURI()).netloc:
+        return False
+    return etree.fromstring(pool.XMLDesc(0)).get('type') == 'dir'
+
+
+def _fill_local_volume(conn, pool, vol, fobj, sparse, stats):
+    """Fill vol directly from fobj if both are files on this host.
+
+    This needs fobj to be a regular file, the pool to be a local directory
+    pool and the volume file to be writable by us (usually meaning that we
+    are root). The whole file is cloned with FICLONE if the filesystem
+    supports it; otherwise each data section is copied with
+    copy_file_range(2) or sendfile(2) and holes are left as holes.
+
+    Return False without touching the volume if this is not possible.
+
+    """
+    if not _is_regular_file(fobj) or not _is_local_dir_pool(conn, pool):
+        return False
+    path = vol.path()
+    if not os.access(path, os.W_OK):
+        return False
+
+    src_fd = fobj.fileno()
+    start = fobj.tell()
+    end = os.fstat(src_fd).st_size
+    start_time = time.time()
+    with open(path, 'r+b') as dst:
+        dst_fd = dst.fileno()
+        os.ftruncate(dst_fd, 0)
+        stats.method = None
+        if start == 0:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            except (IOError, OSError) as e:
+                if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                    raise
+            else:
+                stats.method = 'reflink'
+                stats.bytes_sent = end
+        if stats.method is None:
+            stats.method = 'copy_file_range'
+            os.ftruncate(dst_fd, end - start)
+            position = start
+            while position < end:
+                if sparse:
+                    in_data, length = _file_section(src_fd, position, end)
+                else:
+                    in_data, length = True, end - position
+                if in_data:
+                    _copy_range(
+                        src_fd, position, dst_fd, position - start, length,
+                        stats
+                    )
+                else:
+                    stats.bytes_skipped += length
+                position += length
+    stats.sparse = sparse
+    stats.seconds += time.time() - start_time
+
+    # Let libvirt see the new size and, for qcow2, the image header.
+    pool.refresh(0)
+    return True
+
+
+def _convert_into_local_volume(conn, pool, vol, fobj, stats):
+    """Convert the qcow2 image in fobj into vol if both are files on this host.
+
+    This has the same requirements as _fill_local_volume, and additionally
+    that fobj is positioned at the start of the image. qemu-img reads the
+    image straight from fobj's descriptor, so no staging volume is needed.
+
+    Return False without touching the volume if this is not possible.
+
+    """
+    if (not _is_regular_file(fobj) or fobj.tell() != 0 or
+            not _is_local_dir_pool(conn, pool)):
+        return False
+    path = vol.path()
+    if not os.access(path, os.W_OK):
+        return False
+
+    start_time = time.time()
+    subprocess.check_call(
+        [
+            'qemu-img', 'convert', '-f', 'qcow2', '-O', 'qcow2',
+            '/dev/fd/%d' % fobj.fileno(), path,
+        ],
+        close_fds=False,
+    )
+    stats.method = 'qemu-img convert'
+    stats.bytes_sent = os.fstat(fobj.fileno()).st_size
+    stats.seconds += time.time() - start_time
+
+    pool.refresh(0)
+    return True
+
+
 def create_volume_from_fobj(new_volume_name, fobj, image_type='raw',
-        pool_name='default'):
-    """Create a new libvirt volume and populate it from a file-like object."""
-
-    compressed_fobj = tempfile.NamedTemporaryFile()
-    decompressed_fobj = tempfile.NamedTemporaryFile()
-    with contextlib.closing(compressed_fobj):
-        with contextlib.closing(decompressed_fobj):
-            shutil.copyfileobj(fobj, compressed_fobj)
-            compressed_fobj.flush()
-            compressed_fobj.seek(0)  # is this necessary?
-            subprocess.check_call(
-                [
-                    'qemu-img', 'convert', '-f', image_type, '-O', image_type,
-                    compressed_fobj.name, decompressed_fobj.name
-                ],
-                shell=False, close_fds=False)
-            decompressed_fobj.seek(0)  # is this necessary?
+        pool_name='default', sparse=True, stats=None,
+        block_size=STREAM_BLOCK_SIZE, conn=None):
+    """Create a new libvirt volume and populate it from a file-like object.
+
+    The data is streamed straight from fobj into libvirt, so no local
+    scratch space is needed whatever the size of the image. A qcow2 image
+    is uploaded verbatim into a staging volume first, and then converted
+    into the new volume by libvirt itself; this expands any compressed
+    clusters, as the image would otherwise be slow for guests to read.
+
+    If fobj is a regular file and the pool is a directory pool on this host
+    that we can write to directly, then the volume is filled locally instead
+    of through a libvirt stream: a raw image using a reflink,
+    copy_file_range(2) or sendfile(2), and a qcow2 image by converting it
+    with qemu-img straight into the new volume.
+
+    If sparse is True and both the libvirt bindings and libvirtd support
+    it, runs of zeros are sent as holes instead of data. These are found with
+    SEEK_DATA and SEEK_HOLE if fobj is a regular file, or by scanning for
+    zero blocks otherwise. If stats is an UploadStats instance, it is filled
+    in with byte counts, call counts and timing for the upload.
+
+    Data is read and sent block_size bytes at a time.
+
+    """
+    if image_type == 'raw':
+        fobj_size = _fobj_size(fobj)
+        if fobj_size is not None:
             return _create_volume_from_fobj_with_size(
                 new_volume_name=new_volume_name,
-                fobj=decompressed_fobj,
-                fobj_size=os.fstat(decompressed_fobj.fileno()).st_size,
+                fobj=fobj,
+                fobj_size=fobj_size,
                 image_type=image_type,
-                pool_name=pool_name
+                pool_name=pool_name,
+                sparse=sparse,
+                stats=stats,
+                block_size=block_size,
+                conn=conn,
             )
+        # A raw volume must be created with its final size, so if that
+        # cannot be determined up front then there is no choice but to
+        # spool the data first.
+        import shutil
+        import tempfile
+        spool_fobj = tempfile.TemporaryFile()
+        with contextlib.closing(spool_fobj):
+            shutil.copyfileobj(fobj, spool_fobj, block_size)
+            spool_fobj.seek(0)
+            return _create_volume_from_fobj_with_size(
+                new_volume_name=new_volume_name,
+                fobj=spool_fobj,
+                fobj_size=_fobj_size(spool_fobj),
+                image_type=image_type,
+                pool_name=pool_name,
+                sparse=sparse,
+                stats=stats,
+                block_size=block_size,
+                conn=conn,
+            )
+    elif image_type != 'qcow2':
+        raise NotImplementedError("Unknown image type %r." % image_type)
+
+    if conn is None:
+        conn = get_connection()
+    pool = get_libvirt_pool_object(conn, pool_name)
+    if stats is None:
+        stats = UploadStats()
+    if _is_regular_file(fobj) and _is_local_dir_pool(conn, pool):
+        new_vol = E.volume(
+            E.name(new_volume_name),
+            E.capacity('0'),
+            E.target(E.format(type=image_type)),
+            )
+        vol = pool.createXML(etree.tostring(new_vol), 0)
+        try:
+            converted = _convert_into_local_volume(
+                conn, pool, vol, fobj, stats)
+        except:
+            vol.delete(flags=0)
+            raise
+        if converted:
+            return vol
+        vol.delete(flags=0)
+
+    staging_vol = _create_volume_from_fobj_with_size(
+        new_volume_name=new_volume_name + STAGING_VOLUME_SUFFIX,
+        fobj=fobj,
+        fobj_size=None,
+        image_type=image_type,
+        pool_name=pool_name,
+        sparse=sparse,
+        stats=stats,
+        block_size=block_size,
+        conn=conn,
+    )
+    try:
+        new_vol = E.volume(
+            E.name(new_volume_name),
+            E.capacity('0'),
+            E.target(E.format(type=image_type)),
+            )
+        # libvirt runs "qemu-img convert" from the staging volume for us.
+        return pool.createXMLFrom(etree.tostring(new_vol), staging_vol, 0)
+    finally:
+        staging_vol.delete(flags=0)
+
+
+def _abort_stream(stream):
+    try:
+        # This unexpectedly raises an exception even on a normal call,
+        # so ignore it.
+        stream.abort()
+    except:
+        pass
+
+
+def _have_sparse_streams():
+    return (
+        hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM') and
+        hasattr(libvirt.virStream, 'sendHole')
+    )
+
+
+def _upload(conn, vol, fobj, fobj_size, sparse, stats, block_size):
+    sparse = sparse and _have_sparse_streams()
+    stream = conn.newStream(0)
+    if sparse:
+        try:
+            vol.upload(
+                stream, 0, fobj_size or 0,
+                libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM
+            )
+        except libvirt.libvirtError as e:
+            if e.get_error_code() not in (
+                    libvirt.VIR_ERR_NO_SUPPORT,
+                    libvirt.VIR_ERR_INVALID_ARG,
+                    libvirt.VIR_ERR_ARGUMENT_UNSUPPORTED):
+                raise
+            # libvirtd is too old to accept sparse streams even though the
+            # bindings are new enough, so fall back to sending everything.
+            _abort_stream(stream)
+            sparse = False
+            stream = conn.newStream(0)
+    if not sparse:
+        vol.upload(stream, 0, fobj_size or 0, 0)
+    stats.sparse = sparse
+    stats.method = 'sparse stream' if sparse else 'stream'
+
+    try:
+        _send_to_stream(stream, fobj, sparse, stats, block_size, fobj_size)
+    except Exception as e:
+        _abort_stream(stream)
+        raise e
+    stream.finish()
 
 
 def _create_volume_from_fobj_with_size(new_volume_name, fobj, fobj_size,
-        image_type, pool_name):
-    conn = libvirt.open('qemu:///system')
+        image_type, pool_name, sparse=True, stats=None,
+        block_size=STREAM_BLOCK_SIZE, conn=None):
+    # fobj_size may be None for qcow2 volumes, in which case all data up to
+    # EOF is uploaded.
+    if conn is None:
+        conn = get_connection()
     pool = get_libvirt_pool_object(conn, pool_name)
 
+    if stats is None:
+        stats = UploadStats()
+
     if image_type == 'raw':
-        extra = [E.allocation(str(fobj_size)), E.capacity(str(fobj_size))]
+        # If holes are going to be skipped, then don't preallocate space for
+        # them.
+        allocation = 0 if sparse else fobj_size
+        extra = [E.allocation(str(allocation)), E.capacity(str(fobj_size))]
     elif image_type == 'qcow2':
         extra = [E.capacity('0')]
     else:
@@ -91,23 +870,8 @@ def _create_volume_from_fobj_with_size(new_volume_name, fobj, fobj_size,
     vol = pool.createXML(etree.tostring(new_vol), 0)
 
     try:
-        stream = conn.newStream(0)
-        vol.upload(stream, 0, fobj_size, 0)
-
-        def handler(stream_ignored, size, opaque_ignored):
-            return fobj.read(size)
-
-        try:
-            stream.sendAll(handler, None)
-        except Exception as e:
-            try:
-                # This unexpectedly raises an exception even on a normal call,
-                # so ignore it.
-                stream.abort()
-            except:
-                pass
-            raise e
-        stream.finish()
+        if not _fill_local_volume(conn, pool, vol, fobj, sparse, stats):
+            _upload(conn, vol, fobj, fobj_size, sparse, stats, block_size)
     except:
         vol.delete(flags=0)
         raise
@@ -115,21 +879,36 @@ def _create_volume_from_fobj_with_size(new_volume_name, fobj, fobj_size,
     return vol
 
 
-def volume_names_in_pool(pool_name='default'):
-    conn = libvirt.open('qemu:///system')
+def volume_names_in_pool(pool_name='default', conn=None):
+    if conn is None:
+        conn = get_connection()
     pool = get_libvirt_pool_object(conn, pool_name)
     return pool.listVolumes()
 
 
-def delete_volume_by_name(volume_name, pool_name='default'):
-    conn = libvirt.open('qemu:///system')
+def delete_volume_by_name(volume_name, pool_name='default', conn=None):
+    if conn is None:
+        conn = get_connection()
     pool = get_libvirt_pool_object(conn, pool_name)
     volume = pool.storageVolLookupByName(volume_name)
     volume.delete(flags=0)
 
 
-def have_volume_by_name(volume_name, pool_name='default'):
-    conn = libvirt.open('qemu:///system')
+def volume_allocation(volume_name, pool_name='default', conn=None):
+    """Return the bytes of storage a volume uses, or None if it is missing."""
+    if conn is None:
+        conn = get_connection()
+    pool = get_libvirt_pool_object(conn, pool_name)
+    try:
+        volume = pool.storageVolLookupByName(volume_name)
+    except libvirt.libvirtError:
+        return None
+    return volume.info()[2]
+
+
+def have_volume_by_name(volume_name, pool_name='default', conn=None):
+    if conn is None:
+        conn = get_connection()
     pool = get_libvirt_pool_object(conn, pool_name)
     try:
         volume = pool.storageVolLookupByName(volume_name)
@@ -140,19 +919,56 @@ def have_volume_by_name(volume_name, pool_name='default'):
 
 
 def _get_all_domains(conn=None):
+    """Yield (domain, active) for every domain."""
     if conn is None:
-        conn = libvirt.open('qemu:///system')
+        conn = get_connection()
+
+    try:
+        active = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        inactive = conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+    except AttributeError:
+        # libvirt in Precise doesn't seem to have a binding for
+        # virConnectListAllDomains, and it seems that we must enumerate
+        # defined-by-not-running and running instances separately and in
+        # different ways.
+        for domain_id in conn.listDomainsID():
+            yield conn.lookupByID(domain_id), True
+        for domain_name in conn.listDefinedDomains():
+            yield conn.lookupByName(domain_name), False
+    else:
+        for domain in active:
+            yield domain, True
+        for domain in inactive:
+            yield domain, False
 
-    # libvirt in Precise doesn't seem to have a binding for
-    # virConnectListAllDomains, and it seems that we must enumerate
-    # defined-by-not-running and running instances separately and in different
-    # ways.
 
-    for domain_id in conn.listDomainsID():
-        yield conn.lookupByID(domain_id)
+def _get_all_volumes(conn):
+    """Yield (pool, volume) for every volume in every active pool."""
+    try:
+        pools = conn.listAllStoragePools(
+            libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE)
+    except AttributeError:
+        pools = [
+            conn.storagePoolLookupByName(pool_name)
+            for pool_name in conn.listStoragePools()
+        ]
+    for pool in pools:
+        try:
+            volumes = pool.listAllVolumes(0)
+        except AttributeError:
+            volumes = [
+                pool.storageVolLookupByName(volume_name)
+                for volume_name in pool.listVolumes()
+            ]
+        for volume in volumes:
+            yield pool, volume
 
-    for domain_name in conn.listDefinedDomains():
-        yield conn.lookupByName(domain_name)
+
+def _is_missing_error(e):
+    # Something that disappeared between being listed and being looked at
+    return e.get_error_code() in [
+        libvirt.VIR_ERR_NO_DOMAIN, libvirt.VIR_ERR_NO_STORAGE_VOL]
 
 
 def _domain_element_to_volume_paths(element):
@@ -165,16 +981,6 @@ def _domain_element_to_volume_paths(element):
     )
 
 
-def _domain_volume_paths(domain):
-    volume_paths = set()
-
-    for flags in [0, libvirt.VIR_DOMAIN_XML_INACTIVE]:
-        element = etree.fromstring(domain.XMLDesc(flags))
-        volume_paths.update(_domain_element_to_volume_paths(element))
-
-    return frozenset(volume_paths)
-
-
 def _volume_element_to_volume_paths(element):
     assert element.tag == 'volume'
     return itertools.chain(
@@ -183,54 +989,218 @@ def _volume_element_to_volume_paths(element):
     )
 
 
-def _volume_volume_paths(volume):
-    # Volumes can depend on other volumes ("backing stores"), so return all
-    # paths a volume needs to function, including the top level one.
-    volume_paths = set()
+VolumeNode = collections.namedtuple(
+    'VolumeNode', ['name', 'path', 'pool_name', 'backing_paths', 'volume'])
 
-    element = etree.fromstring(volume.XMLDesc(0))
-    volume_paths.update(_volume_element_to_volume_paths(element))
 
-    return frozenset(volume_paths)
+class DomainVolumeGraph(object):
+    """A snapshot of which volumes each domain uses.
 
+    Domains and volumes are each listed with a single call where libvirt
+    supports it, and each XML description is fetched and parsed only once,
+    when first needed. Volumes are keyed by path, and link to the paths of
+    their backing stores, so that everything a domain depends on can be
+    found without any further lookups.
 
-def _get_all_domain_volume_paths(conn=None):
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    If bulk is False, then volumes are instead looked up one at a time as
+    they are needed, which is cheaper when only a few domains are of
+    interest.
+
+    The snapshot is not updated by itself; remove_domain() and
+    remove_volume() keep it consistent with deletions made by the caller.
+
+    """
+    def __init__(self, conn=None, bulk=True):
+        if conn is None:
+            conn = get_connection()
+        self.conn = conn
+        self.bulk = bulk
+        self._domains = None
+        self._domain_disk_paths = {}
+        self._volumes = {}
+        self._volumes_complete = False
+        self._missing_paths = set()
+
+    def _load_domains(self):
+        if self._domains is None:
+            self._domains = collections.OrderedDict(
+                (domain.name(), (domain, active))
+                for domain, active in _get_all_domains(self.conn)
+            )
+        return self._domains
+
+    @staticmethod
+    def _volume_node(pool_name, volume):
+        try:
+            element = etree.fromstring(volume.XMLDesc(0))
+        except libvirt.libvirtError as e:
+            if not _is_missing_error(e):
+                raise
+            return None
+        path = element.findtext('target/path')
+        return VolumeNode(
+            name=element.findtext('name'),
+            path=path,
+            pool_name=pool_name,
+            backing_paths=frozenset(
+                _volume_element_to_volume_paths(element)) - frozenset([path]),
+            volume=volume,
+        )
+
+    def _load_volumes(self):
+        if not self._volumes_complete:
+            volumes = {}
+            for pool, volume in _get_all_volumes(self.conn):
+                node = self._volume_node(pool.name(), volume)
+                if node:
+                    volumes[node.path] = node
+            self._volumes = volumes
+            self._volumes_complete = True
+        return self._volumes
+
+    def _lookup_volume(self, path):
+        try:
+            volume = self.conn.storageVolLookupByKey(path)
+            pool_name = volume.storagePoolLookupByVolume().name()
+        except libvirt.libvirtError:
+            # Not a volume that libvirt knows about
+            self._missing_paths.add(path)
+            return None
+        node = self._volume_node(pool_name, volume)
+        if node:
+            self._volumes[path] = node
+        else:
+            self._missing_paths.add(path)
+        return node
 
-    all_volume_paths = set()
-    for domain in _get_all_domains(conn):
-        for path in _domain_volume_paths(domain):
+    def load(self):
+        """Fetch everything now rather than when first needed, so that
+        threads can then share the graph."""
+        for domain_name in self.domain_names():
+            self.domain_disk_paths(domain_name)
+        if self.bulk:
+            self._load_volumes()
+
+    def domain_names(self):
+        return list(self._load_domains().keys())
+
+    def domain_uuid(self, domain_name):
+        domain, _ = self._load_domains()[domain_name]
+        return domain.UUIDString()
+
+    def domain_disk_paths(self, domain_name):
+        """Return the paths of the disks attached to a domain, whether now or
+        when it next starts."""
+        try:
+            return self._domain_disk_paths[domain_name]
+        except KeyError:
+            pass
+        domain, active = self._load_domains()[domain_name]
+        # A running domain may have disks hotplugged or queued for its next
+        # boot, so both its live and persistent definitions count.
+        flag_sets = [0, libvirt.VIR_DOMAIN_XML_INACTIVE] if active else [0]
+        paths = set()
+        for flags in flag_sets:
             try:
-                volume = conn.storageVolLookupByKey(path)
-            except libvirt.libvirtError:
-                # ignore a lookup failure, since if a volume doesn't exist,
-                # it isn't reasonable to consider what backing volumes it may
-                # have
+                element = etree.fromstring(domain.XMLDesc(flags))
+            except libvirt.libvirtError as e:
+                if not _is_missing_error(e):
+                    raise
+                continue
+            paths.update(_domain_element_to_volume_paths(element))
+        paths = frozenset(paths)
+        self._domain_disk_paths[domain_name] = paths
+        return paths
+
+    def volume(self, path):
+        """Return the VolumeNode at path, or None if it is not a volume."""
+        if self.bulk or self._volumes_complete:
+            return self._load_volumes().get(path)
+        if path in self._missing_paths:
+            return None
+        return self._volumes.get(path) or self._lookup_volume(path)
+
+    def volumes_in_pool(self, pool_name):
+        return [
+            node for node in self._load_volumes().values()
+            if node.pool_name == pool_name
+        ]
+
+    def domain_volumes(self, domain_name):
+        """Return the VolumeNode of each volume attached to a domain."""
+        nodes = (
+            self.volume(path) for path in self.domain_disk_paths(domain_name))
+        return [node for node in nodes if node]
+
+    def _dependency_paths(self, node):
+        # Follow the backing store chain as far as it goes
+        paths = set([node.path])
+        pending = list(node.backing_paths)
+        while pending:
+            path = pending.pop()
+            if path in paths:
                 continue
-            all_volume_paths.update(_volume_volume_paths(volume))
+            paths.add(path)
+            backing_node = self.volume(path)
+            if backing_node:
+                pending.extend(backing_node.backing_paths)
+        return paths
+
+    def domain_dependency_paths(self, domain_name):
+        """Return the paths of all volumes that a domain needs, including
+        backing stores."""
+        paths = set()
+        for node in self.domain_volumes(domain_name):
+            paths.update(self._dependency_paths(node))
+        return frozenset(paths)
+
+    def volume_paths_in_use(self):
+        paths = set()
+        for domain_name in self.domain_names():
+            paths.update(self.domain_dependency_paths(domain_name))
+        return frozenset(paths)
+
+    def domains_using(self, path):
+        """Return the names of the domains that need the volume at path."""
+        return [
+            domain_name for domain_name in self.domain_names()
+            if path in self.domain_dependency_paths(domain_name)
+        ]
+
+    def remove_domain(self, domain_name):
+        self._load_domains().pop(domain_name, None)
+        self._domain_disk_paths.pop(domain_name, None)
+
+    def remove_volume(self, path):
+        self._volumes.pop(path, None)
+        self._missing_paths.add(path)
+
 
-    return frozenset(all_volume_paths)
+def _get_all_domain_volume_paths(conn=None, graph=None):
+    if graph is None:
+        graph = DomainVolumeGraph(conn)
+    return graph.volume_paths_in_use()
 
 
-def get_all_domain_volume_names(conn=None, filter_by_dir=None):
+def get_all_domain_volume_names(conn=None, filter_by_dir=None, graph=None):
     # Limitation: filter_by_dir must currently end in a '/' and be the
-    # canonical path as libvirt returns it. Ideally I'd filter by pool instead,
-    # but the libvirt API appears to not provide any method to find what pool a
-    # volume is in when looked up by key.
-    if conn is None:
-        conn = libvirt.open('qemu:///system')
+    # canonical path as libvirt returns it.
+    if graph is None:
+        graph = DomainVolumeGraph(conn)
 
-    for path in _get_all_domain_volume_paths(conn=conn):
-        volume = conn.storageVolLookupByKey(path)
-        if filter_by_dir and not volume.path().startswith(filter_by_dir):
+    for path in _get_all_domain_volume_paths(graph=graph):
+        node = graph.volume(path)
+        if node is None:
+            # A backing file outside of any pool
+            continue
+        if filter_by_dir and not node.path.startswith(filter_by_dir):
             continue
-        yield volume.name()
+        yield node.name
 
 
 def get_domain_macs(domain_name, conn=None):
     if conn is None:
-        conn = libvirt.open('qemu:///system')
+        conn = get_connection()
 
     domain = conn.lookupByName(domain_name)
     xml = etree.fromstring(domain.XMLDesc(0))
@@ -239,19 +1209,76 @@ def get_domain_macs(domain_name, conn=None):
         yield mac.get('address')
 
 
-def mac_to_ip(mac):
-    canonical_mac = mac.lower()
-    with codecs.open(LIBVIRT_DNSMASQ_LEASE_FILE, 'r') as f:
-        for line in f:
-            fields = line.split()
-            if len(fields) > 1 and fields[1].lower() == canonical_mac:
-                return fields[2]
+def _lease_file_version(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+class LeaseIndex(object):
+    """Index of the leases in a dnsmasq lease file by MAC address.
+
+    The file is only parsed again when it has changed, whether dnsmasq has
+    rewritten it in place or replaced it with a new file.
+
+    """
+    def __init__(self, path=LIBVIRT_DNSMASQ_LEASE_FILE):
+        self.path = path
+        self._version = None
+        self._leases = {}
+
+    def refresh(self):
+        """Parse the lease file again if it has changed since last time."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._version = None
+            self._leases = {}
+            return
+        if _lease_file_version(st) == self._version:
+            return
+        with codecs.open(self.path, 'r') as f:
+            # Any change made while reading happens after this, so is seen
+            # next time.
+            version = _lease_file_version(os.fstat(f.fileno()))
+            leases = {}
+            for line in f:
+                # expiry time, MAC address, IP address, hostname, client id
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                try:
+                    expiry = int(fields[0])
+                except ValueError:
+                    continue
+                leases.setdefault(fields[1].lower(), []).append(
+                    (expiry, fields[2]))
+        counters['lease_file_parses'] += 1
+        self._leases, self._version = leases, version
+
+    def lookup(self, mac, now=None):
+        """Return the IP address leased to mac, or None if it has none."""
+        self.refresh()
+        if now is None:
+            now = time.time()
+        for expiry, ip in self._leases.get(mac.lower(), []):
+            # dnsmasq writes an expiry time of 0 for infinite leases
+            if not expiry or expiry > now:
+                return ip
         return None
 
 
+# The lease index used by everything in uvtool.
+leases = LeaseIndex()
+
+
+def mac_to_ip(mac):
+    return leases.lookup(mac)
+
+
 def get_domain_ssh_known_hosts(domain_name, conn=None, prefix=None):
     if conn is None:
-        conn = libvirt.open('qemu:///system')
+        conn = get_connection()
 
     domain = conn.lookupByName(domain_name)
     xml = etree.fromstring(domain.XMLDesc(0))
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-# Wrapper around cloud-localds and libvirt
+# Wrapper around cloud-init and libvirt
 
 # Copyright (C) 2012-3 Canonical Ltd.
 # Author: Robie Basak <robie.basak@canonical.com>
@@ -23,33 +23,64 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import copy
 import errno
 import functools
+import io
 import itertools
+import json
 import os
-import shutil
+import re
 import signal
 import StringIO
 import subprocess
 import sys
-import tempfile
-import uuid
-import yaml
-
-import libvirt
-from lxml import etree
-from lxml.builder import E, ElementMaker
+import threading
 
+import uvtool.cidata
+import uvtool.facts
 import uvtool.libvirt
-from uvtool.libvirt import LIBVIRT_METADATA_XMLNS
-import uvtool.libvirt.simplestreams
+from uvtool.libvirt import LIBVIRT_METADATA_XMLNS, E, etree, libvirt
+from uvtool.lazy import LazyModule
 import uvtool.ssh
-import uvtool.wait
+
+ElementMaker = LazyModule('lxml.builder', 'ElementMaker')
+
+# uuid, yaml, tempfile, uvtool.wait (and so pyinotify) and
+# uvtool.libvirt.simplestreams (and so simplestreams) are imported only by the
+# subcommands that need them, and libvirt and lxml only once they are first
+# used, so that quick ones such as "ip" and "ssh" start quickly.
 
 DEFAULT_TEMPLATE = '/usr/share/uvtool/libvirt/template.xml'
+
+# How the cloud-init seed reaches a VM: on a small volume attached as a second
+# disk, or in the domain XML itself, passed to the guest through fw_cfg with
+# an SMBIOS serial number telling cloud-init where to find it.
+DATASOURCE_VOLUME = 'volume'
+DATASOURCE_FIRMWARE = 'firmware'
+DATASOURCES = [DATASOURCE_VOLUME, DATASOURCE_FIRMWARE]
+
+# Each seed file is passed as the fw_cfg entry FW_CFG_SEED_PREFIX followed by
+# its name. The guest kernel shows an entry as a directory under
+# FW_CFG_SYSFS_DIR, named after the entry, with the data in a file called
+# "raw" inside it.
+FW_CFG_SEED_PREFIX = 'opt/org.uvtool/'
+FW_CFG_SYSFS_DIR = '/sys/firmware/qemu_fw_cfg/by_name/'
+
+# cloud-init's NoCloud datasource reads its seed from the URL in an SMBIOS
+# serial number of "ds=nocloud;s=URL". It finds each file by putting its name
+# in place of NOCLOUD_FILE_PLACEHOLDER in the URL; without a placeholder it
+# would append the name, which cannot reach the "raw" file of an entry. So
+# the placeholder is part of the serial number, not left over formatting.
+NOCLOUD_FILE_PLACEHOLDER = '%s'
+NOCLOUD_FW_CFG_SERIAL = 'ds=nocloud;s=file://' + (
+    FW_CFG_SYSFS_DIR + FW_CFG_SEED_PREFIX + NOCLOUD_FILE_PLACEHOLDER + '/raw')
 DEFAULT_REMOTE_WAIT_SCRIPT = '/usr/share/uvtool/libvirt/remote-wait.sh'
 POOL_NAME = 'uvtool'
 
+# How "uvt-kvm create --count" names VMs by default.
+DEFAULT_NAME_PATTERN = '{name}-{index}'
+
 
 class CLIError(Exception):
     """An error that should be reflected back to the CLI user."""
@@ -152,23 +183,31 @@ def get_ssh_authorized_keys(filename):
         return []
 
 
-def create_default_user_data(fobj, args, ssh_host_keys=None):
+def create_default_user_data(fobj, args, ssh_host_keys=None,
+        ssh_authorized_keys=None):
     """Write some sensible default cloud-init user-data to the given file
     object.
 
+    ssh_authorized_keys, if given, are used instead of looking them up from
+    args.
+
     """
+    import yaml
 
-    ssh_authorized_keys = get_ssh_authorized_keys(args.ssh_public_key_file)
+    if ssh_authorized_keys is None:
+        ssh_authorized_keys = get_ssh_authorized_keys(
+            args.ssh_public_key_file)
 
     data = {
         b'hostname': args.hostname.encode('ascii'),
         b'manage_etc_hosts': b'localhost',
         b'snappy': {b'enable_ssh': True},
-        b'ssh_keys': uvtool.ssh.generate_ssh_host_keys()[0],
+        b'ssh_keys': ssh_host_keys,
     }
 
-    if ssh_host_keys:
-        data[b'ssh_keys'] = ssh_host_keys
+    if ssh_host_keys is None:
+        data[b'ssh_keys'] = uvtool.ssh.generate_ssh_host_keys(
+            args.ssh_host_key_types)[0]
 
     if ssh_authorized_keys:
         data[b'ssh_authorized_keys'] = ssh_authorized_keys
@@ -192,48 +231,52 @@ def create_default_user_data(fobj, args, ssh_host_keys=None):
 
 
 def create_default_meta_data(fobj, args):
+    import uuid
+    import yaml
     data = {
         b'instance-id': str(uuid.uuid1()).encode('ascii'),
     }
     fobj.write(yaml.dump(data))
 
 
-def create_ds_image(temp_dir, hostname, user_data_fobj, meta_data_fobj):
-    """Create a file called ds.img inside temp_dir that contains a useful
-    cloud-init data source.
-
-    Other temporary files created in temp_dir are currently metadata and
-    userdata and can be safely deleted.
+def create_ds_image(hostname, user_data_fobj, meta_data_fobj):
+    """Return the bytes of an image that contains a useful cloud-init data
+    source.
 
     """
+    return uvtool.cidata.make_seed_image(
+        user_data_fobj.read(), meta_data_fobj.read())
 
-    with open(os.path.join(temp_dir, 'userdata'), 'wb') as f:
-        f.write(user_data_fobj.read())
-    with open(os.path.join(temp_dir, 'metadata'), 'wb') as f:
-        f.write(meta_data_fobj.read())
 
-    subprocess.check_call(
-        ['cloud-localds', 'ds.img', 'userdata', 'metadata'], cwd=temp_dir)
+def create_ds_volume(new_volume_name, hostname, user_data_fobj, meta_data_fobj,
+        conn=None):
+    """Create a new libvirt cloud-init datasource volume."""
 
+    image = create_ds_image(hostname, user_data_fobj, meta_data_fobj)
+    return uvtool.libvirt.create_volume_from_fobj(
+        new_volume_name, io.BytesIO(image), pool_name=POOL_NAME, conn=conn)
 
-def create_ds_volume(new_volume_name, hostname, user_data_fobj, meta_data_fobj):
-    """Create a new libvirt cloud-init datasource volume."""
 
-    temp_dir = tempfile.mkdtemp(prefix='uvt-kvm-')
-    try:
-        create_ds_image(temp_dir, hostname, user_data_fobj, meta_data_fobj)
-        with open(os.path.join(temp_dir, 'ds.img'), 'rb') as f:
-            return uvtool.libvirt.create_volume_from_fobj(
-                new_volume_name, f, pool_name=POOL_NAME)
-    finally:
-        shutil.rmtree(temp_dir)
+def firmware_seed(user_data, meta_data):
+    """Return the seed for compose_domain_xml() as a dict, or None if
+    user_data or meta_data cannot be written into domain XML."""
+    seed = {}
+    for name, data in [('user-data', user_data), ('meta-data', meta_data)]:
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        if re.search('[\x00-\x08\x0b\x0c\x0e-\x1f]', text):
+            return None
+        seed[name] = text
+    return seed
 
 
 def create_cow_volume(backing_volume_name, new_volume_name, new_volume_size,
         conn=None):
 
     if conn is None:
-        conn = libvirt.open('qemu:///system')
+        conn = uvtool.libvirt.get_connection()
 
     pool = conn.storagePoolLookupByName(POOL_NAME)
     try:
@@ -253,7 +296,7 @@ def create_cow_volume_by_path(backing_volume_path, new_volume_name,
     """Create a new libvirt qcow2 volume backed by an existing volume path."""
 
     if conn is None:
-        conn = libvirt.open('qemu:///system')
+        conn = uvtool.libvirt.get_connection()
 
     pool = conn.storagePoolLookupByName(POOL_NAME)
 
@@ -270,83 +313,222 @@ def create_cow_volume_by_path(backing_volume_path, new_volume_name,
     return pool.createXML(etree.tostring(new_vol), 0)
 
 
-def compose_domain_xml(name, volumes, cpu=1, memory=512, unsafe_caching=False,
-        template_path=DEFAULT_TEMPLATE, log_console_output=False, bridge=None,
-        ssh_known_hosts=None):
-    tree = etree.parse(template_path)
-    domain = tree.getroot()
-    assert domain.tag == 'domain'
-
-    etree.strip_elements(domain, 'name')
-    etree.SubElement(domain, 'name').text = name
-
-    etree.strip_elements(domain, 'vcpu')
-    etree.SubElement(domain, 'vcpu').text = str(cpu)
-
-    etree.strip_elements(domain, 'currentMemory')
-    etree.SubElement(domain, 'currentMemory').text = str(memory * 1024)
+class DomainTemplate(object):
+    """A libvirt domain XML template, compiled for rendering many domains.
 
-    etree.strip_elements(domain, 'memory')
-    etree.SubElement(domain, 'memory').text = str(memory * 1024)
+    Everything that compose_domain_xml() replaces is taken out of the
+    template once, leaving slots that render() fills in with the domain's
+    own elements. The template's own elements that an option may replace
+    are kept to put back when that option is not used.
 
-    devices = domain.find('devices')
+    """
+    _SLOTS = ['domain', 'os', 'devices', 'metadata']
+
+    def __init__(self, tree, path=None):
+        tree = copy.deepcopy(tree)
+        domain = tree.getroot()
+        if domain.tag != 'domain':
+            raise CLIError("%s: not a libvirt domain template" % path)
+
+        for tag in ['name', 'vcpu', 'currentMemory', 'memory']:
+            etree.strip_elements(domain, tag)
+        os_element = self._child(domain, 'os')
+        devices = self._child(domain, 'devices')
+        metadata = self._child(domain, 'metadata')
+        etree.strip_elements(devices, 'disk')
+
+        element = metadata.find('{%s}datasource' % LIBVIRT_METADATA_XMLNS)
+        self.datasource = None
+        if element is not None:
+            self.datasource = (element.text or '').strip()
+            metadata.remove(element)
+            if self.datasource not in DATASOURCES:
+                raise CLIError("%s: unknown datasource: %s" % (
+                    path, self.datasource))
+
+        self._interfaces = self._take(devices, 'interface')
+        self._serials = self._take(devices, 'serial')
+        self._smbios = self._take(os_element, 'smbios')
+        self._sysinfo = self._take(domain, 'sysinfo')
+
+        for slot, parent in zip(
+                self._SLOTS, [domain, os_element, devices, metadata]):
+            etree.SubElement(parent, 'uvt-slot-' + slot)
+        # Alternately XML text and the name of the slot that follows it,
+        # in document order
+        self._fragments = re.split(
+            b'<uvt-slot-([a-z]+)/>', etree.tostring(tree))
+
+    @staticmethod
+    def _child(parent, tag):
+        element = parent.find(tag)
+        if element is None:
+            element = etree.SubElement(parent, tag)
+        return element
+
+    @staticmethod
+    def _take(parent, tag):
+        """Remove the tag elements from parent and return them as XML."""
+        elements = parent.findall(tag)
+        for element in elements:
+            element.tail = None
+            parent.remove(element)
+        return [etree.tostring(element) for element in elements]
+
+    def render(self, name, disks, cpu=1, memory=512, unsafe_caching=False,
+            log_console_output=False, bridge=None, ssh_known_hosts=None,
+            seed=None):
+        """Return the XML for a new domain, as compose_domain_xml()."""
+        domain = [E.name(name), E.vcpu(str(cpu)),
+            E.currentMemory(str(memory * 1024)), E.memory(str(memory * 1024))]
+        os_element = []
+        devices = []
+        metadata = []
+
+        for disk_device, (path, disk_format_type) in zip(['vda', 'vdb'],
+                disks):
+            if unsafe_caching:
+                disk_driver = E.driver(
+                    name='qemu', type=disk_format_type, cache='unsafe')
+            else:
+                disk_driver = E.driver(name='qemu', type=disk_format_type)
+            devices.append(
+                E.disk(
+                    disk_driver,
+                    E.source(file=path),
+                    E.target(dev=disk_device),
+                    type='file',
+                    device='disk',
+                    )
+                )
 
-    etree.strip_elements(devices, 'disk')
-    for disk_device, vol in zip(['vda', 'vdb'], volumes):
-        disk_format_type = (
-            etree.fromstring(vol.XMLDesc(0)).
-            find('target').
-            find('format').
-            get('type')
+        if bridge:
+            devices.append(E.interface(
+                             E.source(bridge=bridge),
+                             E.model(type='virtio'),
+                             type='bridge'),
+                          )
+        else:
+            devices.extend(self._interfaces)
+
+        if log_console_output:
+            print(
+                "Warning: logging guest console output introduces a DoS " +
+                    "security problem on the host and should not be used " +
+                    "in production.",
+                file=sys.stderr
             )
-        if unsafe_caching:
-            disk_driver = E.driver(
-                name='qemu', type=disk_format_type, cache='unsafe')
+            devices.append(E.serial(E.target(port='0'), type='stdio'))
         else:
-            disk_driver = E.driver(name='qemu', type=disk_format_type)
-        devices.append(
-            E.disk(
-                disk_driver,
-                E.source(file=vol.path()),
-                E.target(dev=disk_device),
-                type='file',
-                device='disk',
-                )
+            devices.extend(self._serials)
+
+        if seed is not None:
+            os_element.append(E.smbios(mode='sysinfo'))
+            domain.append(E.sysinfo(
+                E.system(E.entry(NOCLOUD_FW_CFG_SERIAL, name='serial')),
+                type='smbios',
+            ))
+            domain.append(E.sysinfo(
+                *[E.entry(text, name=FW_CFG_SEED_PREFIX + name)
+                    for name, text in sorted(seed.items())],
+                type='fwcfg'
+            ))
+        else:
+            os_element.extend(self._smbios)
+            domain.extend(self._sysinfo)
+
+        if ssh_known_hosts:
+            EX = ElementMaker(
+                namespace=LIBVIRT_METADATA_XMLNS,
+                nsmap={'uvt': LIBVIRT_METADATA_XMLNS}
+            )
+            metadata.append(EX.ssh_known_hosts(ssh_known_hosts))
+
+        slots = dict(zip(
+            [slot.encode('ascii') for slot in self._SLOTS],
+            [domain, os_element, devices, metadata]
+        ))
+        xml = [self._fragments[0]]
+        for slot, fragment in zip(
+                self._fragments[1::2], self._fragments[2::2]):
+            xml.extend(
+                element if isinstance(element, bytes)
+                else etree.tostring(element)
+                for element in slots[slot]
             )
+            xml.append(fragment)
+        return b''.join(xml)
 
-    if bridge:
-        etree.strip_elements(devices, 'interface')
-        devices.append(E.interface(
-                         E.source(bridge=bridge),
-                         E.model(type='virtio'),
-                         type='bridge'),
-                      )
 
-    if log_console_output:
-        print(
-            "Warning: logging guest console output introduces a DoS " +
-                "security problem on the host and should not be used in " +
-                "production.",
-            file=sys.stderr
-        )
-        etree.strip_elements(devices, 'serial')
-        devices.append(E.serial(E.target(port='0'), type='stdio'))
-
-    if ssh_known_hosts:
-        metadata = domain.find('metadata')
-        if metadata is None:
-            metadata = E.metadata()
-            domain.append(metadata)
-        EX = ElementMaker(
-            namespace=LIBVIRT_METADATA_XMLNS,
-            nsmap={'uvt': LIBVIRT_METADATA_XMLNS}
-        )
-        metadata.append(EX.ssh_known_hosts(ssh_known_hosts))
+# Compiled templates by path, with the modification time of each when it was
+# compiled.
+_templates = {}
+
+
+def load_template(path):
+    """Return the DomainTemplate for the template file at path.
+
+    The template is only parsed and compiled again if the file has changed.
+
+    """
+    mtime = os.stat(path).st_mtime
+    cached = _templates.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    template = DomainTemplate(etree.parse(path), path=path)
+    _templates[path] = (mtime, template)
+    return template
+
+
+def compose_domain_xml(name, disks, cpu=1, memory=512, unsafe_caching=False,
+        template_path=DEFAULT_TEMPLATE, log_console_output=False, bridge=None,
+        ssh_known_hosts=None, template=None, seed=None):
+    """Return the XML for a new domain.
+
+    disks is a list of (path, format) for its disks in order. template, if
+    given, is the DomainTemplate to use instead of loading template_path.
+    seed, if given, is the cloud-init seed to pass to the guest through
+    firmware, as returned by firmware_seed().
+
+    """
+    if template is None:
+        template = load_template(template_path)
+    return template.render(
+        name, disks,
+        bridge=bridge,
+        cpu=cpu,
+        log_console_output=log_console_output,
+        memory=memory,
+        unsafe_caching=unsafe_caching,
+        ssh_known_hosts=ssh_known_hosts,
+        seed=seed,
+    )
+
 
-    return etree.tostring(tree)
+def get_base_image(filters, conn=None):
+    """Return (volume name, path) of the one image that filters match.
 
+    What filters resolve to is remembered until the next change to the image
+    metadata, such as by a sync or purge, so that creating many domains from
+    the same image does not query the metadata again. The volume is still
+    looked up in the pool each time.
 
-def get_base_image(filters):
+    """
+    import uvtool.libvirt.poolgc
+    import uvtool.libvirt.simplestreams
+    if conn is None:
+        conn = uvtool.libvirt.get_connection()
+    pool_metadata = uvtool.libvirt.simplestreams.get_pool_metadata()
+    key = json.dumps(sorted(set(filters)))
+    cached = pool_metadata.get_resolution(key)
+    # The volume could still have been deleted behind our back.
+    if cached is not None and uvtool.libvirt.have_volume_by_name(
+            cached[0], pool_name=POOL_NAME, conn=conn):
+        uvtool.libvirt.counters['base_image_cache_hits'] += 1
+        return cached
+    uvtool.libvirt.counters['base_image_cache_misses'] += 1
+
+    generation = pool_metadata.generation()
     result = list(uvtool.libvirt.simplestreams.query(filters))
     if not result:
         raise CLIError(
@@ -354,15 +536,61 @@ def get_base_image(filters):
     elif len(result) != 1:
         raise CLIError(
             "multiple images found that match filters %s." % repr(filters))
-    return result[0]
+
+    pool = conn.storagePoolLookupByName(POOL_NAME)
+    try:
+        path = pool.storageVolLookupByName(result[0]).path()
+    except libvirt.libvirtError:
+        raise RuntimeError("Cannot find volume %s" % result[0])
+    try:
+        pool_metadata.set_resolution(key, result[0], path, generation)
+    except uvtool.libvirt.poolgc.DATABASE_ERRORS:
+        # Users who may create domains may still be unable to write to the
+        # metadata database; they just miss out on the cache.
+        pass
+    return result[0], path
 
 
 def create(hostname, filters, user_data_fobj, meta_data_fobj, memory=512,
            cpu=1, disk=2, unsafe_caching=False, template_path=DEFAULT_TEMPLATE,
            log_console_output=False, bridge=None, backing_image_file=None,
-           ssh_known_hosts=None):
+           ssh_known_hosts=None, conn=None, base_image=None, template=None,
+           datasource=None):
+    """Create and start a VM.
+
+    base_image, if given, is the (volume name, path) that filters resolve
+    to, as returned by get_base_image(). template, if given, is the
+    DomainTemplate to use instead of loading template_path. Both let many
+    calls share the work.
+
+    datasource is one of DATASOURCES. If it is None, then the template's
+    choice is used, or else DATASOURCE_VOLUME. A seed volume is still used
+    if the data cannot be passed through firmware.
+
+    """
+    if conn is None:
+        conn = uvtool.libvirt.get_connection()
+    if template is None:
+        template = load_template(template_path)
+    if datasource is None:
+        datasource = template.datasource or DATASOURCE_VOLUME
+    if datasource not in DATASOURCES:
+        raise CLIError("unknown datasource: %s" % datasource)
+    user_data = user_data_fobj.read()
+    meta_data = meta_data_fobj.read()
+    seed = None
+    if datasource == DATASOURCE_FIRMWARE:
+        seed = firmware_seed(user_data, meta_data)
+        if seed is None:
+            print(
+                "Warning: %s: cloud-init data is not text, so a seed " %
+                    hostname + "volume is used instead of firmware.",
+                file=sys.stderr
+            )
     if backing_image_file is None:
-        base_volume_name = get_base_image(filters)
+        if base_image is None:
+            base_image = get_base_image(filters, conn=conn)
+        base_volume_name, base_volume_path = base_image
     undo_volume_creation = []
     try:
         # cow image names must end in ".qcow" so that the current Apparmor
@@ -372,20 +600,23 @@ def create(hostname, filters, user_data_fobj, meta_data_fobj, memory=512,
         # directory is added to the virt-aa-helper profile, this requirement
         # can be dropped.
 
-        if backing_image_file:
-            main_vol = create_cow_volume_by_path(
-                backing_image_file, "%s.qcow" % hostname, disk)
-        else:
-            main_vol = create_cow_volume(
-                base_volume_name, "%s.qcow" % hostname, disk)
+        main_vol = create_cow_volume_by_path(
+            backing_image_file or base_volume_path, "%s.qcow" % hostname,
+            disk, conn=conn
+        )
         undo_volume_creation.append(main_vol)
+        disks = [(main_vol.path(), 'qcow2')]
 
-        ds_vol = create_ds_volume(
-            "%s-ds.qcow" % hostname, hostname, user_data_fobj, meta_data_fobj)
-        undo_volume_creation.append(ds_vol)
+        if seed is None:
+            ds_vol = create_ds_volume(
+                "%s-ds.qcow" % hostname, hostname, io.BytesIO(user_data),
+                io.BytesIO(meta_data), conn=conn,
+            )
+            undo_volume_creation.append(ds_vol)
+            disks.append((ds_vol.path(), 'raw'))
 
         xml = compose_domain_xml(
-            hostname, [main_vol, ds_vol],
+            hostname, disks,
             bridge=bridge,
             cpu=cpu,
             log_console_output=log_console_output,
@@ -393,8 +624,9 @@ def create(hostname, filters, user_data_fobj, meta_data_fobj, memory=512,
             template_path=template_path,
             unsafe_caching=unsafe_caching,
             ssh_known_hosts=ssh_known_hosts,
+            template=template,
+            seed=seed,
         )
-        conn = libvirt.open('qemu:///system')
         domain = conn.defineXML(xml)
         try:
             domain.create()
@@ -406,24 +638,87 @@ def create(hostname, filters, user_data_fobj, meta_data_fobj, memory=512,
             vol.delete(0)
         raise
 
+    references = dict((vol.name(), False) for vol in undo_volume_creation)
+    if backing_image_file is None:
+        references[base_volume_name] = True
+    _update_pool_references(
+        'add_domain', domain.UUIDString(), hostname, references)
+
+
+# VMs may be created and destroyed in parallel, but the collector's database
+# connection can only be in one transaction at a time.
+_pool_gc_lock = threading.Lock()
+
+
+def _update_pool_references(method_name, *args):
+    # Garbage collection of the pool notices new and vanished domains by
+    # itself, so this only saves it work, and must not stop the user if the
+    # metadata database is unavailable to them.
+    import uvtool.libvirt.poolgc
+    import uvtool.libvirt.simplestreams
+    try:
+        with _pool_gc_lock:
+            getattr(
+                uvtool.libvirt.simplestreams.get_pool_gc(), method_name
+            )(*args)
+    except uvtool.libvirt.poolgc.DATABASE_ERRORS:
+        pass
+
+
+def _domain_disk_files(domain, graph=None):
+    if graph is None:
+        domain_xml = etree.fromstring(domain.XMLDesc(0))
+        assert domain_xml.tag == 'domain'
+        return [
+            disk.find('source').get('file')
+            for disk in domain_xml.find('devices').iter('disk')
+        ]
+    else:
+        return graph.domain_disk_paths(domain.name())
 
-def delete_domain_volumes(conn, domain):
+
+def delete_domain_volumes(conn, domain, graph=None):
     """Delete all volumes associated with a domain.
 
     :param conn: libvirt connection object
     :param domain: libvirt domain object
+    :param graph: optional uvtool.libvirt.DomainVolumeGraph to find the
+        volumes in, which is kept up to date
 
     """
-    domain_xml = etree.fromstring(domain.XMLDesc(0))
-    assert domain_xml.tag == 'domain'
-    for disk in domain_xml.find('devices').iter('disk'):
-        disk_file = disk.find('source').get('file')
-        vol = conn.storageVolLookupByKey(disk_file)
+    for disk_file in _domain_disk_files(domain, graph):
+        node = graph.volume(disk_file) if graph else None
+        if node:
+            vol = node.volume
+            graph.remove_volume(disk_file)
+        else:
+            vol = conn.storageVolLookupByKey(disk_file)
         vol.delete(0)
 
 
-def destroy(hostname):
-    conn = libvirt.open('qemu:///system')
+def _queue_domain_volumes(domain, graph=None):
+    """Queue a domain's volumes for reaping, and return whether this was
+    possible."""
+    import uvtool.libvirt.poolgc
+    import uvtool.libvirt.simplestreams
+    try:
+        with _pool_gc_lock:
+            uvtool.libvirt.simplestreams.get_pool_gc().queue_reap(
+                _domain_disk_files(domain, graph))
+    except uvtool.libvirt.poolgc.DATABASE_ERRORS:
+        return False
+    return True
+
+
+def destroy(hostname, conn=None, graph=None, reap_later=False):
+    """Stop and undefine a domain, and delete its volumes.
+
+    If reap_later is True, then the volumes are instead queued for reap()
+    to delete, unless the queue is unavailable. Return whether they were.
+
+    """
+    if conn is None:
+        conn = uvtool.libvirt.get_connection()
     try:
         domain = conn.lookupByName(hostname)
     except libvirt.libvirtError as e:
@@ -435,14 +730,28 @@ def destroy(hostname):
     if state != libvirt.VIR_DOMAIN_SHUTOFF:
         domain.destroy()
 
-    delete_domain_volumes(conn, domain)
+    # Queued volumes are only deleted once no domain uses them, so they must
+    # be queued before the domain is undefined.
+    reap_later = reap_later and _queue_domain_volumes(domain, graph)
+    if not reap_later:
+        delete_domain_volumes(conn, domain, graph=graph)
 
+    uuid = domain.UUIDString()
     domain.undefine()
+    if graph:
+        graph.remove_domain(hostname)
+    _update_pool_references('remove_domain', uuid)
+    return reap_later
+
+
+def reap(conn=None):
+    """Delete the volumes queued by destroy(), and return their paths."""
+    import uvtool.libvirt.simplestreams
+    return uvtool.libvirt.simplestreams.get_pool_gc().reap(conn)
 
 
 def get_lts_series():
-    output = subprocess.check_output(['distro-info', '--lts'], close_fds=True)
-    return output.strip()
+    return uvtool.facts.lts_series()
 
 
 def apply_default_fobj(args, key, create_default_data_fn):
@@ -479,8 +788,8 @@ def check_kvm_ok():
     return (False, stdout) if process.returncode else (True, None)
 
 
-def name_to_ips(name):
-    macs = uvtool.libvirt.get_domain_macs(name)
+def name_to_ips(name, conn=None):
+    macs = uvtool.libvirt.get_domain_macs(name, conn=conn)
     return [
         ip for ip
         in (uvtool.libvirt.mac_to_ip(mac) for mac in macs)
@@ -508,6 +817,7 @@ def ssh(name, login_name, arguments, stdin=None, checked=False, sysexit=True,
             name, prefix=('%s ' % ip)
         )
         if ssh_known_hosts:
+            import tempfile
             ssh_known_hosts_file = tempfile.NamedTemporaryFile(
                 prefix='uvt-kvm.known_hoststmp')
             objects_to_close.append(ssh_known_hosts_file)
@@ -546,42 +856,59 @@ def ssh(name, login_name, arguments, stdin=None, checked=False, sysexit=True,
         [x.close() for x in objects_to_close]
 
 
-def main_create(parser, args):
-    if args.user_data and args.password:
-        parser.error("--password cannot be used with --user-data.")
-    if args.password:
-        print(
-            "Warning: using --password from the command line is " +
-                "not secure and should be used for debugging only.",
-            file=sys.stderr
-        )
+def batch_hostnames(hostname, count=None, name_pattern=DEFAULT_NAME_PATTERN):
+    """Return the names of the VMs that "uvt-kvm create" is to create.
 
-    kvm_ok, is_kvm_ok_output = check_kvm_ok()
-    if not kvm_ok:
-        print(
-            "KVM not available. kvm-ok returned:", is_kvm_ok_output,
-            sep="\n", end="", file=sys.stderr
-        )
-        return
+    hostname may be a comma separated list of names. Otherwise, if count is
+    given, then count names are made from name_pattern, formatted with name
+    as hostname and index counting from 1.
 
-    ssh_host_keys, ssh_known_hosts = uvtool.ssh.generate_ssh_host_keys()
+    """
+    if count is None:
+        hostnames = hostname.split(',')
+    else:
+        hostnames = [
+            name_pattern.format(name=hostname, index=index)
+            for index in range(1, count + 1)
+        ]
+    if not all(hostnames):
+        raise CLIError("empty VM name in %s." % repr(hostname))
+    if len(set(hostnames)) != len(hostnames):
+        raise CLIError("VM names are not unique: %s." % ', '.join(hostnames))
+    return hostnames
+
+
+def _create_one(args, hostname, user_data, meta_data, base_image, conn,
+        template, datasource, ssh_authorized_keys, used_key_pool):
+    """Create one VM for main_create(), appending to used_key_pool if its
+    host keys came from the key pool."""
+    args = copy.copy(args)
+    args.hostname = hostname
+
+    keys = uvtool.ssh.default_key_pool().take(args.ssh_host_key_types)
+    if keys is None:
+        keys = uvtool.ssh.generate_ssh_host_keys(args.ssh_host_key_types)
+    else:
+        used_key_pool.append(hostname)
+    ssh_host_keys, ssh_known_hosts = keys
 
+    # Each VM reads its own copy of any user-data or meta-data given.
+    args.user_data = None if user_data is None else io.BytesIO(user_data)
+    args.meta_data = None if meta_data is None else io.BytesIO(meta_data)
     user_data_fobj = apply_default_fobj(
         args, 'user_data', functools.partial(
             create_default_user_data,
-            ssh_host_keys=ssh_host_keys
+            ssh_host_keys=ssh_host_keys,
+            ssh_authorized_keys=ssh_authorized_keys,
         )
     )
     meta_data_fobj = apply_default_fobj(
         args, 'meta_data', create_default_meta_data
     )
-    if args.backing_image_file:
-        abs_image_backing_file = os.path.abspath(args.backing_image_file)
-    else:
-        abs_image_backing_file = None
+
     create(
-        args.hostname, args.filters, user_data_fobj, meta_data_fobj,
-        backing_image_file=abs_image_backing_file,
+        hostname, args.filters, user_data_fobj, meta_data_fobj,
+        backing_image_file=args.backing_image_file,
         bridge=args.bridge,
         cpu=args.cpu,
         disk=args.disk,
@@ -590,18 +917,178 @@ def main_create(parser, args):
         template_path=args.template,
         unsafe_caching=args.unsafe_caching,
         ssh_known_hosts=ssh_known_hosts,
+        conn=conn,
+        base_image=base_image,
+        template=template,
+        datasource=datasource,
     )
 
 
+def main_create(parser, args):
+    if args.user_data and args.password:
+        parser.error("--password cannot be used with --user-data.")
+    if args.count is not None and args.count < 1:
+        parser.error("--count must be at least 1.")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if args.password:
+        print(
+            "Warning: using --password from the command line is " +
+                "not secure and should be used for debugging only.",
+            file=sys.stderr
+        )
+    hostnames = batch_hostnames(args.hostname, args.count, args.name_pattern)
+
+    kvm_ok, is_kvm_ok_output = check_kvm_ok()
+    if not kvm_ok:
+        print(
+            "KVM not available. kvm-ok returned:", is_kvm_ok_output,
+            sep="\n", end="", file=sys.stderr
+        )
+        return
+
+    # Everything that all the VMs have in common is worked out once.
+    if not args.filters:
+        args.filters = ["release=%s" % get_lts_series()]
+    conn = uvtool.libvirt.get_connection()
+    if args.backing_image_file:
+        args.backing_image_file = os.path.abspath(args.backing_image_file)
+        base_image = None
+    else:
+        base_image = get_base_image(args.filters, conn=conn)
+    template = load_template(args.template)
+    user_data = args.user_data.read() if args.user_data else None
+    meta_data = args.meta_data.read() if args.meta_data else None
+    if user_data is None:
+        ssh_authorized_keys = get_ssh_authorized_keys(
+            args.ssh_public_key_file)
+    else:
+        ssh_authorized_keys = None
+    datasource = args.datasource or template.datasource
+    # The default data is always text, so only what was given is checked.
+    if (datasource == DATASOURCE_FIRMWARE and
+            (user_data is not None or meta_data is not None) and
+            firmware_seed(user_data or b'', meta_data or b'') is None):
+        print(
+            "Warning: cloud-init data is not text, so a seed volume is " +
+                "used instead of firmware.",
+            file=sys.stderr
+        )
+        datasource = DATASOURCE_VOLUME
+    used_key_pool = []
+    create_one = functools.partial(
+        _create_one, args, user_data=user_data, meta_data=meta_data,
+        base_image=base_image, conn=conn, template=template,
+        datasource=datasource, ssh_authorized_keys=ssh_authorized_keys,
+        used_key_pool=used_key_pool
+    )
+    try:
+        if len(hostnames) == 1:
+            create_one(hostnames[0])
+        else:
+            # Each VM is created, or rolled back if that fails,
+            # independently of the others.
+            _run_in_worker_pool(create_one, hostnames, args.jobs, 'create')
+    finally:
+        if used_key_pool:
+            _fill_key_pool_in_background()
+
+
+def _run_in_background(*subcommand):
+    """Run uvt-kvm with the arguments given, detached from this one."""
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', 'uvtool.libvirt.kvm'] + list(subcommand),
+            stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+            preexec_fn=os.setsid,
+        )
+
+
+def _fill_key_pool_in_background():
+    _run_in_background('keypool', 'fill')
+
+
+def main_keypool_fill(parser, args):
+    generated = uvtool.ssh.default_key_pool().fill(args.size)
+    if args.verbose:
+        print("Generated %d ssh host key sets" % generated, file=sys.stderr)
+
+
+def _run_in_worker_pool(function, names, jobs, description):
+    """Call function on each of names, up to jobs at a time.
+
+    Each call succeeds or fails independently. Failures are reported, and
+    then raise a single CLIError. Return the results of the calls that
+    succeeded.
+
+    """
+    import multiprocessing.pool
+    worker_pool = multiprocessing.pool.ThreadPool(min(jobs, len(names)))
+    try:
+        async_results = [
+            (name, worker_pool.apply_async(function, (name,)))
+            for name in names
+        ]
+        results = []
+        failed = []
+        for name, async_result in async_results:
+            try:
+                results.append(async_result.get())
+            except (CLIError, EnvironmentError, RuntimeError,
+                    subprocess.CalledProcessError,
+                    libvirt.libvirtError) as e:
+                if isinstance(e, libvirt.libvirtError):
+                    e = "libvirt: %s" % e.get_error_message()
+                print(
+                    "%s: error: failed to %s %s: %s" % (
+                        os.path.basename(sys.argv[0]), description, name, e),
+                    file=sys.stderr
+                )
+                failed.append(name)
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+    if failed:
+        raise CLIError("failed to %s %d of %d VMs: %s." % (
+            description, len(failed), len(names), ', '.join(failed)))
+    return results
+
+
 def main_destroy(parser, args):
-    for h in args.hostname:
-        destroy(h)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    conn = uvtool.libvirt.get_connection()
+    # Listing every volume up front only pays off when there are several
+    # domains to look them up for.
+    if len(args.hostname) > 1:
+        graph = uvtool.libvirt.DomainVolumeGraph(conn)
+        graph.load()
+    else:
+        graph = None
+    destroy_one = functools.partial(
+        destroy, conn=conn, graph=graph, reap_later=args.no_wait)
+    try:
+        if len(args.hostname) == 1:
+            destroy_one(args.hostname[0])
+        else:
+            _run_in_worker_pool(
+                destroy_one, args.hostname, args.jobs, 'destroy')
+    finally:
+        # Even if some failed, others may have queued volumes.
+        if args.no_wait:
+            _run_in_background('reap')
+
+
+def main_reap(parser, args):
+    deleted = reap()
+    if args.verbose:
+        print("Deleted %d volumes" % len(deleted), file=sys.stderr)
 
 
 def main_list(parser, args):
-    # Hack for now. In time this should properly use the API and list
-    # only instances created with this tool.
-    subprocess.check_call('virsh -q list --all|awk \'{print $2}\'', shell=True)
+    # In time this should list only instances created with this tool.
+    for name in uvtool.libvirt.DomainVolumeGraph().domain_names():
+        print(name)
 
 
 def main_ip(parser, args):
@@ -665,14 +1152,15 @@ def main_wait_remote(parser, args):
 
 
 def main_wait(parser, args):
-    conn = libvirt.open('qemu:///system')
+    import uvtool.wait
+    conn = uvtool.libvirt.get_connection()
     domain = conn.lookupByName(args.name)
     state = domain.state(0)[0]
     if state != libvirt.VIR_DOMAIN_RUNNING:
         raise CLIError(
             "libvirt domain %s is not running." % repr(args.name))
 
-    macs = list(uvtool.libvirt.get_domain_macs(args.name))
+    macs = list(uvtool.libvirt.get_domain_macs(args.name, conn=conn))
     if not macs:
         raise CLIError(
             "libvirt domain %s has no NIC MACs available." % repr(args.name))
@@ -695,6 +1183,17 @@ def main_wait(parser, args):
         main_wait_remote(parser, args)
 
 
+def ssh_host_key_types(value):
+    key_types = [key_type for key_type in value.split(',') if key_type]
+    unknown = set(key_types) - set(uvtool.ssh.KEY_TYPES)
+    if unknown or not key_types:
+        raise argparse.ArgumentTypeError(
+            "key types must be a comma separated list of %s" %
+            ', '.join(uvtool.ssh.KEY_TYPES)
+        )
+    return key_types
+
+
 class DeveloperOptionAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         namespace.unsafe_caching = True
@@ -702,11 +1201,8 @@ class DeveloperOptionAction(argparse.Action):
 
 
 def main(args):
-    # Workaround for https://bugzilla.redhat.com/show_bug.cgi?id=1063766
-    # (LP: #1228231)
-    libvirt.registerErrorHandler(lambda _: None, None)
-
     parser = argparse.ArgumentParser()
+    parser.add_argument('--verbose', '-v', action='store_true')
     subparsers = parser.add_subparsers()
     create_subparser = subparsers.add_parser('create')
     create_subparser.set_defaults(func=main_create)
@@ -718,6 +1214,7 @@ def main(args):
     create_subparser.add_argument('--disk', default=8, type=int)
     create_subparser.add_argument('--bridge')
     create_subparser.add_argument('--unsafe-caching', action='store_true')
+    create_subparser.add_argument('--datasource', choices=DATASOURCES)
     create_subparser.add_argument(
         '--user-data', type=argparse.FileType('rb'))
     create_subparser.add_argument(
@@ -727,15 +1224,24 @@ def main(args):
     create_subparser.add_argument('--backing-image-file')
     create_subparser.add_argument('--run-script-once', action='append')
     create_subparser.add_argument('--ssh-public-key-file')
+    create_subparser.add_argument(
+        '--ssh-host-key-types', type=ssh_host_key_types,
+        default=uvtool.ssh.KEY_TYPES)
     create_subparser.add_argument('--packages', action='append')
+    create_subparser.add_argument('--count', type=int)
+    create_subparser.add_argument(
+        '--name-pattern', default=DEFAULT_NAME_PATTERN)
+    create_subparser.add_argument('--jobs', '-j', type=int, default=4)
     create_subparser.add_argument('hostname')
     create_subparser.add_argument(
-        'filters', nargs='*', metavar='filter',
-        default=["release=%s" % get_lts_series()],
-    )
+        'filters', nargs='*', metavar='filter')
     destroy_subparser = subparsers.add_parser('destroy')
     destroy_subparser.set_defaults(func=main_destroy)
+    destroy_subparser.add_argument('--jobs', '-j', type=int, default=4)
+    destroy_subparser.add_argument('--no-wait', action='store_true')
     destroy_subparser.add_argument('hostname', nargs='+')
+    reap_subparser = subparsers.add_parser('reap')
+    reap_subparser.set_defaults(func=main_reap)
     list_subparser = subparsers.add_parser('list')
     list_subparser.set_defaults(func=main_list)
     ip_subparser = subparsers.add_parser('ip')
@@ -747,6 +1253,11 @@ def main(args):
     ssh_subparser.add_argument('--login-name', '-l')
     ssh_subparser.add_argument('name')
     ssh_subparser.add_argument('ssh_arguments', nargs='*')
+    keypool_subparser = subparsers.add_parser('keypool')
+    keypool_subparsers = keypool_subparser.add_subparsers()
+    keypool_fill_subparser = keypool_subparsers.add_parser('fill')
+    keypool_fill_subparser.set_defaults(func=main_keypool_fill)
+    keypool_fill_subparser.add_argument('--size', type=int)
     wait_subparser = subparsers.add_parser('wait')
     wait_subparser.set_defaults(func=main_wait)
     wait_subparser.add_argument('--timeout', type=float, default=120.0)
@@ -759,7 +1270,20 @@ def main(args):
     wait_subparser.add_argument('--ssh-private-key-file')
     wait_subparser.add_argument('name')
     args = parser.parse_args(args)
-    args.func(parser, args)
+
+    # Workaround for https://bugzilla.redhat.com/show_bug.cgi?id=1063766
+    # (LP: #1228231). This is only done once the arguments have been parsed,
+    # so that --help does not import libvirt.
+    libvirt.registerErrorHandler(lambda _: None, None)
+    try:
+        args.func(parser, args)
+    finally:
+        uvtool.libvirt.session.close()
+        if args.verbose:
+            print(
+                "libvirt: %s" % uvtool.libvirt.format_counters(),
+                file=sys.stderr
+            )
 
 
 def main_cli_wrapper(*args, **kwargs):
@@ -771,7 +1295,11 @@ def main_cli_wrapper(*args, **kwargs):
             file=sys.stderr
         )
         sys.exit(1)
-    except libvirt.libvirtError as e:
+    except Exception as e:
+        # Checked here rather than in an except clause of its own, which
+        # would import libvirt on the way out of even "--help".
+        if not isinstance(e, libvirt.libvirtError):
+            raise
         libvirt_message = e.get_error_message()
         print(
             "%s: error: libvirt: %s" % (
@@ -0,0 +1,236 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Mirror images from simplestreams into the libvirt pool. This is only
+# needed by "uvt-simplestreams-libvirt sync", so it is kept apart from
+# uvtool.libvirt.simplestreams to save the other commands from importing
+# simplestreams.
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing.pool
+
+import simplestreams.filters
+import simplestreams.mirrors
+import simplestreams.util
+
+import uvtool.libvirt
+from uvtool.libvirt.simplestreams import (
+    ChecksumError,
+    HashingReader,
+    LIBVIRT_POOL_NAME,
+    RateLimitedReader,
+    TokenBucket,
+    VERIFIED_CHECKSUM_PREFIX,
+    VOLUME_FIELD,
+    _checksum_algorithm,
+    _content_volume_name,
+    _copy_verification,
+    _encode_libvirt_pool_name,
+    _load_products,
+    _remove_metadata,
+    _verify,
+    _volume_name,
+    get_pool_metadata,
+)
+
+
+class LibvirtMirror(simplestreams.mirrors.BasicMirrorWriter):
+    """Mirror images into the libvirt pool.
+
+    With jobs greater than one, images are downloaded and imported by a pool
+    of that many worker threads, and the metadata changes that a serial sync
+    would have made are queued. Call finish() once sync() returns to wait
+    for the workers and then apply the queued changes in their original
+    order. If any image fails, the changes queued before it are applied and
+    the rest are not, exactly as if the sync had run serially, and the
+    error from the earliest failing image is raised.
+
+    If bandwidth_limit is set, the total rate of all downloads is limited to
+    that many bytes per second.
+
+    If download_cache is a uvtool.download.DownloadCache, then each download
+    is also written to it as it streams into the pool, so that an
+    interrupted one is resumed by the next sync. An entry is removed once
+    its image has been imported.
+
+    """
+    def __init__(self, filters, verbose=False, block_size=None, jobs=1,
+            bandwidth_limit=None, download_cache=None):
+        super(LibvirtMirror, self).__init__({'max_items': 1})
+        self.filters = filters
+        self.verbose = verbose
+        self.block_size = block_size
+        self.download_cache = download_cache
+        if bandwidth_limit:
+            self.bucket = TokenBucket(bandwidth_limit)
+        else:
+            self.bucket = None
+        if jobs > 1:
+            self.worker_pool = multiprocessing.pool.ThreadPool(jobs)
+        else:
+            self.worker_pool = None
+        # (encoded_libvirt_name, get_metadata or None) in sync order.
+        # get_metadata returns the metadata to be set once the image has been
+        # imported. None means that the metadata is to be deleted.
+        self.pending = []
+        # Volume name to the async_result of the worker importing it
+        self.importing = {}
+
+    def load_products(self, path=None, content_id=None):
+        return _load_products(path=path, content_id=content_id, clean=True)
+
+    def filter_index_entry(self, data, src, pedigree):
+        return data['datatype'] == 'image-downloads'
+
+    def filter_item(self, data, src, target, pedigree):
+        return simplestreams.filters.filter_item(
+            self.filters, data, src, pedigree)
+
+    def insert_item(self, data, src, target, pedigree, contentsource):
+        product_name, version_name, item_name = pedigree
+        assert(item_name == 'disk1.img')
+        if self.verbose:
+            print("Adding: %s %s" % (product_name, version_name))
+        encoded_libvirt_name = _encode_libvirt_pool_name(
+            product_name, version_name)
+        metadata = simplestreams.util.products_exdata(src, pedigree)
+        volume_name = _content_volume_name(metadata)
+        metadata[VOLUME_FIELD] = volume_name
+        if not self.worker_pool:
+            get_pool_metadata()[encoded_libvirt_name] = self._import_item(
+                volume_name, metadata, contentsource)
+            return
+        importing = self.importing.get(volume_name)
+        if importing:
+            # The same image is already being imported for another product
+            # or version in this sync.
+            get_metadata = lambda: _copy_verification(
+                metadata, [importing.get()])
+        else:
+            importing = self.worker_pool.apply_async(
+                self._import_item, (volume_name, metadata, contentsource))
+            self.importing[volume_name] = importing
+            get_metadata = importing.get
+        self.pending.append((encoded_libvirt_name, get_metadata))
+
+    def _import_item(self, volume_name, metadata, contentsource):
+        """Make sure that the image is in the pool and return its metadata."""
+        algorithm = _checksum_algorithm(metadata)
+        if not uvtool.libvirt.have_volume_by_name(
+                volume_name, pool_name=LIBVIRT_POOL_NAME):
+            if self.bucket:
+                wrap_source = lambda fobj: RateLimitedReader(fobj, self.bucket)
+            else:
+                wrap_source = lambda fobj: fobj
+            url = getattr(contentsource, 'url', None)
+            cache_key = None
+            fobj = None
+            if self.download_cache and url:
+                cache_key = self._cache_key(metadata)
+                size = metadata.get('size')
+                fobj = self.download_cache.open(
+                    cache_key, url, source=contentsource,
+                    size=int(size) if size is not None else None,
+                    wrap_source=wrap_source
+                )
+            if fobj is None:
+                cache_key = None
+                fobj = wrap_source(contentsource)
+            if algorithm:
+                reader = HashingReader(fobj, algorithm)
+            else:
+                reader = fobj
+            try:
+                # Hash the image as it streams into the pool rather than
+                # reading it a second time afterwards. A cache entry is
+                # written in the same pass, and is only there to resume
+                # from if this is interrupted.
+                self._create_volume(volume_name, reader)
+                if algorithm:
+                    try:
+                        _verify(reader, metadata)
+                    except ChecksumError:
+                        uvtool.libvirt.delete_volume_by_name(
+                            volume_name, pool_name=LIBVIRT_POOL_NAME)
+                        if cache_key:
+                            # Don't resume a bad download next time
+                            self.download_cache.discard(cache_key)
+                        raise
+                if cache_key:
+                    self.download_cache.discard(cache_key)
+            finally:
+                fobj.close()
+            if algorithm:
+                metadata[VERIFIED_CHECKSUM_PREFIX + algorithm] = (
+                    reader.hexdigest())
+        else:
+            # The image is already in the pool, so keep any earlier
+            # verification of it.
+            pool_metadata = get_pool_metadata()
+            _copy_verification(metadata, (
+                other_metadata
+                for other_name, other_metadata in pool_metadata.items()
+                if _volume_name(other_name, other_metadata) == volume_name
+            ))
+        return metadata
+
+    def _create_volume(self, volume_name, fobj):
+        upload_stats = uvtool.libvirt.UploadStats()
+        kwargs = {}
+        if self.block_size:
+            kwargs['block_size'] = self.block_size
+        uvtool.libvirt.create_volume_from_fobj(
+            volume_name, fobj, image_type='qcow2',
+            pool_name=LIBVIRT_POOL_NAME, stats=upload_stats, **kwargs
+        )
+        if self.verbose:
+            print("Uploaded: %s" % upload_stats)
+
+    def _cache_key(self, metadata):
+        algorithm = _checksum_algorithm(metadata)
+        return self.download_cache.key(
+            metadata['product_name'], metadata['version_name'],
+            metadata['item_name'],
+            metadata[algorithm] if algorithm else None
+        )
+
+    def remove_version(self, data, src, target, pedigree):
+        product_name, version_name = pedigree
+        if self.verbose:
+            print("Removing: %s %s" % (product_name, version_name))
+        encoded_libvirt_name = _encode_libvirt_pool_name(
+            product_name, version_name)
+        if self.worker_pool:
+            self.pending.append((encoded_libvirt_name, None))
+        else:
+            _remove_metadata(encoded_libvirt_name)
+
+    def finish(self):
+        """Wait for any workers and apply their queued metadata changes."""
+        if not self.worker_pool:
+            return
+        self.worker_pool.close()
+        self.worker_pool.join()
+        pending, self.pending = self.pending, []
+        for encoded_libvirt_name, get_metadata in pending:
+            if get_metadata is None:
+                _remove_metadata(encoded_libvirt_name)
+            else:
+                # Raises the worker's exception if it failed
+                get_pool_metadata()[encoded_libvirt_name] = get_metadata()
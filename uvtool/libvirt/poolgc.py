@@ -0,0 +1,426 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reference counted garbage collection of the uvtool volume pool.
+#
+# A volume in the pool is needed while a domain uses it, directly or as a
+# backing store, or while image metadata holds it. The volumes used by each
+# domain are recorded in the metadata database, and updated as domains are
+# created and destroyed. A volume becomes a candidate for collection only
+# when one of its references is dropped, and an incremental collection only
+# examines candidates, so it takes time in proportion to what changed rather
+# than to the number of domains or volumes.
+#
+# Domains defined or undefined by other tools are noticed by comparing one
+# listing of domain UUIDs against the recorded ones, and only new domains
+# are scanned. Likewise, one listing of the pool catches volumes that
+# nothing ever recorded a reference to, such as the staging volume or the
+# unregistered image left behind by an interrupted sync. Disks attached to
+# a domain after it was first seen are not noticed until a full collection,
+# which rebuilds every reference from scratch.
+#
+# The volumes of domains destroyed with "uvt-kvm destroy --no-wait" are
+# queued in the same database, and deleted later by reap().
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sqlite3
+import threading
+import time
+
+import libvirt
+
+import uvtool.libvirt
+from uvtool.libvirt.store import connect, has_tables, transaction
+
+# What add_domain() and friends may raise if the database is unavailable,
+# such as when it isn't writable by the current user.
+DATABASE_ERRORS = (EnvironmentError, sqlite3.Error)
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS gc_domains (
+        uuid TEXT PRIMARY KEY,
+        name TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS gc_refs (
+        uuid TEXT NOT NULL,
+        volume TEXT NOT NULL,
+        image INTEGER NOT NULL,
+        PRIMARY KEY (uuid, volume)
+    )''',
+    'CREATE INDEX IF NOT EXISTS gc_refs_volume ON gc_refs (volume)',
+    '''CREATE TABLE IF NOT EXISTS gc_candidates (
+        volume TEXT PRIMARY KEY,
+        released REAL NOT NULL,
+        image INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS gc_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )''',
+    "INSERT OR IGNORE INTO gc_state (name, value) VALUES ('seeded', 0)",
+    '''CREATE TABLE IF NOT EXISTS reap_queue (
+        path TEXT PRIMARY KEY,
+        queued REAL NOT NULL
+    )''',
+]
+_TABLES = [
+    'gc_domains', 'gc_refs', 'gc_candidates', 'gc_state', 'reap_queue']
+
+
+class GCReport(object):
+    """What a collection removed, or would have removed, and what it kept.
+
+    collected and retained are lists of (volume name, bytes).
+
+    """
+    def __init__(self):
+        self.collected = []
+        self.retained = []
+
+    @property
+    def reclaimable(self):
+        return sum(size for _, size in self.collected)
+
+    def __str__(self):
+        return "%d bytes reclaimable in %d volumes, %d bytes retained" % (
+            self.reclaimable, len(self.collected),
+            sum(size for _, size in self.retained)
+        )
+
+
+def _domain_references(graph, domain_name, filter_by_dir):
+    """Return {volume name: is base image} for what a domain needs."""
+    disk_paths = graph.domain_disk_paths(domain_name)
+    references = {}
+    for path in graph.domain_dependency_paths(domain_name):
+        node = graph.volume(path)
+        if node is None:
+            continue
+        if filter_by_dir and not node.path.startswith(filter_by_dir):
+            continue
+        references[node.name] = path not in disk_paths
+    return references
+
+
+class PoolGarbageCollector(object):
+    """Track what refers to the volumes in a pool, and delete those that
+    nothing refers to any more.
+
+    The records are kept in the metadata database in metadata_dir.
+
+    """
+    def __init__(self, metadata_dir):
+        self.metadata_dir = metadata_dir
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        with self._lock:
+            if self._conn is None:
+                conn = connect(self.metadata_dir)
+                if not has_tables(conn, _TABLES):
+                    with transaction(conn):
+                        for statement in _SCHEMA:
+                            conn.execute(statement)
+                self._conn = conn
+            return self._conn
+
+    @staticmethod
+    def _add_domain(conn, uuid, name, references):
+        conn.execute(
+            'INSERT OR REPLACE INTO gc_domains (uuid, name) VALUES (?, ?)',
+            [uuid, name]
+        )
+        conn.execute('DELETE FROM gc_refs WHERE uuid = ?', [uuid])
+        for volume, image in references.items():
+            conn.execute(
+                'INSERT INTO gc_refs (uuid, volume, image) VALUES (?, ?, ?)',
+                [uuid, volume, int(image)]
+            )
+            conn.execute(
+                'DELETE FROM gc_candidates WHERE volume = ?', [volume])
+
+    @staticmethod
+    def _release(conn, volume, image, now):
+        conn.execute(
+            'INSERT OR IGNORE INTO gc_candidates (volume, released, image) '
+            'VALUES (?, ?, ?)',
+            [volume, now, int(image)]
+        )
+        conn.execute(
+            'UPDATE gc_candidates SET released = ?, image = MAX(image, ?) '
+            'WHERE volume = ?',
+            [now, int(image), volume]
+        )
+
+    def add_domain(self, uuid, name, references):
+        """Record the volumes that a domain uses.
+
+        references maps each volume name to whether it is a base image rather
+        than one of the domain's own volumes.
+
+        """
+        conn = self._connect()
+        with transaction(conn):
+            self._add_domain(conn, uuid, name, references)
+
+    def remove_domain(self, uuid, now=None):
+        """Drop the references of a domain that no longer exists."""
+        if now is None:
+            now = time.time()
+        conn = self._connect()
+        with transaction(conn):
+            released = conn.execute(
+                'SELECT volume, image FROM gc_refs WHERE uuid = ?', [uuid]
+            ).fetchall()
+            conn.execute('DELETE FROM gc_refs WHERE uuid = ?', [uuid])
+            conn.execute('DELETE FROM gc_domains WHERE uuid = ?', [uuid])
+            for volume, image in released:
+                self._release(conn, volume, image, now)
+
+    def release_image(self, volume, now=None):
+        """Note that image metadata no longer holds a volume."""
+        if now is None:
+            now = time.time()
+        conn = self._connect()
+        with transaction(conn):
+            self._release(conn, volume, True, now)
+
+    def clear(self):
+        """Forget everything, so that the next collection is a full one."""
+        conn = self._connect()
+        with transaction(conn):
+            conn.execute('DELETE FROM gc_domains')
+            conn.execute('DELETE FROM gc_refs')
+            conn.execute('DELETE FROM gc_candidates')
+            conn.execute("UPDATE gc_state SET value = 0 WHERE name = 'seeded'")
+
+    def queue_reap(self, paths, now=None):
+        """Queue the volumes at paths for deletion by reap().
+
+        This is for the volumes of a domain that is about to be undefined,
+        so that it can be undefined without waiting for them. Queue them
+        before undefining the domain, so that they are not lost if that is
+        interrupted.
+
+        """
+        if now is None:
+            now = time.time()
+        conn = self._connect()
+        with transaction(conn):
+            for path in paths:
+                conn.execute(
+                    'INSERT OR REPLACE INTO reap_queue (path, queued) '
+                    'VALUES (?, ?)',
+                    [path, now]
+                )
+
+    def reap(self, conn=None):
+        """Delete the volumes queued by queue_reap(), and return their paths.
+
+        A volume that some domain still uses is left queued without being
+        deleted, and tried again by the next reap(). This covers a domain
+        that has been queued but not yet undefined by a concurrent destroy,
+        as well as one that was never undefined after all, whose volumes
+        are dropped from the queue once they are gone. Volumes queued while
+        this runs are left for the next reap(), since the domains using
+        them are only looked up once, after the queue is read. Entries are
+        only dropped once dealt with, so an interrupted reap() just leaves
+        the rest for the next one.
+
+        """
+        if conn is None:
+            conn = uvtool.libvirt.get_connection()
+        db = self._connect()
+        paths = [path for path, in db.execute(
+            'SELECT path FROM reap_queue ORDER BY queued').fetchall()]
+        if not paths:
+            return []
+        # Volumes are queued before their domain is undefined, so any
+        # domain still using a path read above is still defined now.
+        in_use = uvtool.libvirt.DomainVolumeGraph(conn).volume_paths_in_use()
+        deleted = []
+        failed = []
+        for path in paths:
+            if path in in_use:
+                # Leave it queued to try again next time
+                continue
+            try:
+                conn.storageVolLookupByKey(path).delete(0)
+            except libvirt.libvirtError as e:
+                if not uvtool.libvirt._is_missing_error(e):
+                    # Leave it queued to try again next time
+                    failed.append(e)
+                    continue
+            else:
+                deleted.append(path)
+            with transaction(db):
+                db.execute('DELETE FROM reap_queue WHERE path = ?', [path])
+        if failed:
+            raise failed[0]
+        return deleted
+
+    def _rescan(self, graph, volume_names, filter_by_dir, now):
+        conn = self._connect()
+        with transaction(conn):
+            conn.execute('DELETE FROM gc_domains')
+            conn.execute('DELETE FROM gc_refs')
+            for name in graph.domain_names():
+                self._add_domain(
+                    conn, graph.domain_uuid(name), name,
+                    _domain_references(graph, name, filter_by_dir)
+                )
+            # Everything is suspect; references are checked in collect().
+            for volume in volume_names:
+                conn.execute(
+                    'INSERT OR IGNORE INTO gc_candidates '
+                    '(volume, released, image) VALUES (?, ?, 0)',
+                    [volume, now]
+                )
+            conn.execute(
+                "UPDATE gc_state SET value = 1 WHERE name = 'seeded'")
+
+    def _update_domains(self, graph, filter_by_dir, now):
+        current = dict(
+            (graph.domain_uuid(name), name) for name in graph.domain_names())
+        known = dict(self._connect().execute(
+            'SELECT uuid, name FROM gc_domains').fetchall())
+        for uuid in set(known) - set(current):
+            self.remove_domain(uuid, now)
+        for uuid in set(current) - set(known):
+            self.add_domain(
+                uuid, current[uuid],
+                _domain_references(graph, current[uuid], filter_by_dir)
+            )
+
+    def _sweep(self, volume_names, held_volumes, now):
+        """Make candidates of the volumes that nothing refers to."""
+        conn = self._connect()
+        referenced = frozenset(volume for volume, in conn.execute(
+            'SELECT DISTINCT volume FROM gc_refs').fetchall())
+        unreferenced = set(volume_names) - referenced - held_volumes
+        if not unreferenced:
+            return
+        with transaction(conn):
+            for volume in unreferenced:
+                conn.execute(
+                    'INSERT OR IGNORE INTO gc_candidates '
+                    '(volume, released, image) VALUES (?, ?, 0)',
+                    [volume, now]
+                )
+
+    def _drop_candidates(self, volumes):
+        if not volumes:
+            return
+        conn = self._connect()
+        with transaction(conn):
+            conn.executemany(
+                'DELETE FROM gc_candidates WHERE volume = ?',
+                [[volume] for volume in volumes]
+            )
+
+    def collect(self, held_volumes, pool_name, filter_by_dir=None, conn=None,
+            full=False, dry_run=False, retain_size=None, retain_age=None,
+            now=None):
+        """Delete the volumes in pool_name that nothing needs any more.
+
+        held_volumes are the names of volumes that image metadata refers to.
+        Only volumes with filter_by_dir as their path prefix are considered
+        to be in the pool; it must end in '/'.
+
+        If full is True, or no full collection has happened yet, then every
+        reference is found again from scratch first. Otherwise only new and
+        removed domains are looked at, along with any volume in the pool
+        that nothing refers to. If dry_run is True, nothing is deleted.
+
+        Base images that have lost their last reference are retained while
+        they were released less than retain_age seconds ago, and while the
+        total retained is at most retain_size bytes, keeping the most
+        recently released first. With neither set, none are retained.
+
+        Return a GCReport.
+
+        """
+        if conn is None:
+            conn = uvtool.libvirt.get_connection()
+        if now is None:
+            now = time.time()
+        db = self._connect()
+        seeded, = db.execute(
+            "SELECT value FROM gc_state WHERE name = 'seeded'").fetchone()
+        if full or not seeded:
+            graph = uvtool.libvirt.DomainVolumeGraph(conn)
+            self._rescan(
+                graph,
+                uvtool.libvirt.volume_names_in_pool(pool_name, conn=conn),
+                filter_by_dir, now
+            )
+        else:
+            # Only the domains that are new to us are looked at, so look
+            # their volumes up one at a time rather than listing them all.
+            graph = uvtool.libvirt.DomainVolumeGraph(conn, bulk=False)
+            self._update_domains(graph, filter_by_dir, now)
+            self._sweep(
+                uvtool.libvirt.volume_names_in_pool(pool_name, conn=conn),
+                held_volumes, now
+            )
+
+        report = GCReport()
+        images = []
+        dropped = []
+        for volume, released, image in db.execute(
+                'SELECT volume, released, image FROM gc_candidates'
+                ).fetchall():
+            referenced = db.execute(
+                'SELECT 1 FROM gc_refs WHERE volume = ? LIMIT 1', [volume]
+            ).fetchone()
+            if volume in held_volumes or referenced:
+                dropped.append(volume)
+                continue
+            size = uvtool.libvirt.volume_allocation(
+                volume, pool_name=pool_name, conn=conn)
+            if size is None:
+                dropped.append(volume)
+            elif image:
+                images.append((released, volume, size))
+            else:
+                report.collected.append((volume, size))
+
+        retaining = retain_size is not None or retain_age is not None
+        retained_size = 0
+        for released, volume, size in sorted(images, reverse=True):
+            if (retaining and
+                    (retain_age is None or now - released <= retain_age) and
+                    (retain_size is None or
+                        retained_size + size <= retain_size)):
+                retained_size += size
+                report.retained.append((volume, size))
+            else:
+                report.collected.append((volume, size))
+
+        if not dry_run:
+            # A volume deleted here but still a candidate after an
+            # interruption is dropped by the next collection, when it is
+            # found to be gone.
+            for volume, _ in report.collected:
+                uvtool.libvirt.delete_volume_by_name(
+                    volume, pool_name=pool_name, conn=conn)
+                dropped.append(volume)
+        self._drop_candidates(dropped)
+        return report
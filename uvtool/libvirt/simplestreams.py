@@ -27,80 +27,162 @@ from __future__ import unicode_literals
 
 import argparse
 import base64
-import codecs
 import collections
-import errno
+import hashlib
 import json
 import os
-import subprocess
 import sys
+import threading
+import time
 
-import libvirt
-
-import simplestreams.filters
-import simplestreams.mirrors
-import simplestreams.util
-
+import uvtool.facts
 import uvtool.libvirt
+from uvtool.lazy import LazyModule
+
+libvirt = LazyModule('libvirt')
 
 LIBVIRT_POOL_NAME = 'uvtool'
 IMAGE_DIR = '/var/lib/uvtool/libvirt/images/' # must end in '/'; see use
 METADATA_DIR = '/var/lib/uvtool/libvirt/metadata'
+DOWNLOAD_CACHE_DIR = '/var/lib/uvtool/libvirt/download-cache'
+DOWNLOAD_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+DOWNLOAD_CACHE_MAX_AGE_DAYS = 30
 USEFUL_FIELD_NAMES = ['release', 'arch', 'label']
 
+# Checksum fields that simplestreams may publish for an item, strongest
+# first. Only the strongest one available is computed during a sync.
+CHECKSUM_ALGORITHMS = ['sha512', 'sha384', 'sha256', 'sha1', 'md5']
+
+# Once an image has been verified, its digest is recorded in its metadata
+# under this prefix followed by the algorithm name.
+VERIFIED_CHECKSUM_PREFIX = 'verified_'
+
+# Images with one of these checksums published are stored in a volume named
+# by it, so that products and versions with identical images share one
+# volume. Weaker checksums are not trusted to tell images apart.
+CONTENT_ADDRESS_ALGORITHMS = ['sha512', 'sha384', 'sha256']
+CONTENT_ADDRESS_PREFIX = 'x-uvt-'
+
+# The metadata of each product version names the volume holding its image
+# in this field. Older metadata without it refers to a volume with the same
+# name as the metadata itself.
+VOLUME_FIELD = 'libvirt_volume'
+
+
+class ChecksumError(RuntimeError):
+    """Image data does not match the checksum published for it."""
+    pass
+
+
+# These are only created when first needed by get_pool_metadata() and
+# get_pool_gc(), so that commands that don't need them start quickly.
+_pool_metadata = None
+_pool_gc = None
+
+
+def get_pool_metadata():
+    """Return the MetadataStore of the images in the pool."""
+    global _pool_metadata
+    if _pool_metadata is None:
+        import uvtool.libvirt.store
+        _pool_metadata = uvtool.libvirt.store.MetadataStore(METADATA_DIR)
+    return _pool_metadata
+
+
+def get_pool_gc():
+    """Return the PoolGarbageCollector of the pool."""
+    global _pool_gc
+    if _pool_gc is None:
+        import uvtool.libvirt.poolgc
+        _pool_gc = uvtool.libvirt.poolgc.PoolGarbageCollector(METADATA_DIR)
+    return _pool_gc
+
+
+class HashingReader(object):
+    """Wrap a file object to hash and count data as it is read through it."""
+    def __init__(self, fobj, algorithm):
+        self._fobj = fobj
+        self._hash = hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._fobj.read(size)
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class TokenBucket(object):
+    """Limit the combined rate of reads made by many threads.
+
+    Up to one second's worth of unused allowance is kept, so that short
+    stalls in one download don't hold back the total.
+
+    """
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self._tokens = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Go into debt for the whole request, and have the caller wait
+            # until it is paid off. Holding the lock while sleeping queues
+            # the other threads behind us fairly.
+            self._tokens -= count
+            if self._tokens < 0:
+                time.sleep(-self._tokens / self.rate)
+
+
+class RateLimitedReader(object):
+    """Wrap a file object so that reads through it share a TokenBucket."""
+    def __init__(self, fobj, bucket):
+        self._fobj = fobj
+        self._bucket = bucket
+
+    def read(self, size=-1):
+        data = self._fobj.read(size)
+        self._bucket.consume(len(data))
+        return data
+
+    def close(self):
+        self._fobj.close()
+
+
+def _checksum_algorithm(item):
+    for algorithm in CHECKSUM_ALGORITHMS:
+        if item.get(algorithm):
+            return algorithm
+    return None
+
+
+def _verify(reader, item):
+    """Check the data read through reader against its published checksum."""
+    if 'size' in item and reader.size != int(item['size']):
+        raise ChecksumError(
+            "%s %s: expected %s bytes but got %d." % (
+                item['product_name'], item['version_name'],
+                item['size'], reader.size
+            )
+        )
+    digest = reader.hexdigest()
+    if digest != item[reader.algorithm]:
+        raise ChecksumError(
+            "%s %s: expected %s %s but got %s." % (
+                item['product_name'], item['version_name'],
+                reader.algorithm, item[reader.algorithm], digest
+            )
+        )
 
-def mkdir_p(path):
-    """Create path if it doesn't exist already"""
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
-
-
-class Metadata(object):
-    def __init__(self, metadata_dir=METADATA_DIR):
-        self.metadata_dir = metadata_dir
-        # Deliberately do not create metadata_dir as a side-effect here, since
-        # this class is instantiated below when the module is loaded, and we
-        # want to be able to test this module without the side-effect of it
-        # affecting the system metadata directory.
-
-    def _metadata_path(self, encoded_libvirt_image_name):
-        return os.path.join(self.metadata_dir, encoded_libvirt_image_name)
-
-    def __contains__(self, encoded_libvirt_image_name):
-        return os.path.exists(self._metadata_path(encoded_libvirt_image_name))
-
-    def __delitem__(self, encoded_libvirt_image_name):
-        os.unlink(self._metadata_path(encoded_libvirt_image_name))
-
-    def __setitem__(self, encoded_libvirt_image_name, metadata):
-        mkdir_p(self.metadata_dir)
-        with codecs.open(
-                self._metadata_path(encoded_libvirt_image_name), 'wb',
-                encoding='utf-8') as f:
-            json.dump(metadata, f, indent=4)
-
-    def __getitem__(self, encoded_libvirt_image_name):
-        with codecs.open(
-                self._metadata_path(encoded_libvirt_image_name), 'rb',
-                encoding='utf-8') as f:
-            return json.load(f)
-
-    def keys(self):
-        try:
-            return os.listdir(self.metadata_dir)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise
-            return []
-
-    def items(self):
-        return [(key, self[key]) for key in self.keys()]
-
-
-pool_metadata = Metadata(METADATA_DIR)
 
 BASE64_PREFIX = 'x-uvt-b64-'
 
@@ -122,6 +204,39 @@ def _decode_libvirt_pool_name(encoded_pool_name):
     ).split(None, 1)
 
 
+def _content_volume_name(metadata):
+    """Return the name of the volume to store the image described by metadata.
+
+    This is derived from the image's checksum where possible, and from its
+    product and version otherwise.
+
+    """
+    for algorithm in CONTENT_ADDRESS_ALGORITHMS:
+        if metadata.get(algorithm):
+            return '%s%s-%s' % (
+                CONTENT_ADDRESS_PREFIX, algorithm, metadata[algorithm])
+    return _encode_libvirt_pool_name(
+        metadata['product_name'], metadata['version_name'])
+
+
+def _volume_name(encoded_libvirt_name, metadata):
+    """Return the name of the volume that metadata refers to."""
+    return metadata.get(VOLUME_FIELD, encoded_libvirt_name)
+
+
+def _copy_verification(metadata, others):
+    """Record a verification of the same image from any of others."""
+    algorithm = _checksum_algorithm(metadata)
+    if not algorithm:
+        return metadata
+    verified_key = VERIFIED_CHECKSUM_PREFIX + algorithm
+    for other in others:
+        if other.get(verified_key) == metadata[algorithm]:
+            metadata[verified_key] = other[verified_key]
+            break
+    return metadata
+
+
 def purge_pool(conn=None):
     '''Delete all volumes and metadata with prejudice.
 
@@ -130,32 +245,48 @@ def purge_pool(conn=None):
     '''
     # Remove all metadata first. If this is interrupted, then it just looks
     # like there are volumes waiting to be cleaned up.
-    for key in pool_metadata.keys():
-        del pool_metadata[key]
+    get_pool_metadata().clear()
+    get_pool_gc().clear()
 
     # Remove actual volumes themselves
     if conn is None:
-        conn = libvirt.open('qemu:///system')
+        conn = uvtool.libvirt.get_connection()
     pool = uvtool.libvirt.get_libvirt_pool_object(conn, LIBVIRT_POOL_NAME)
     for volume_name in pool.listVolumes():
         volume = pool.storageVolLookupByName(volume_name)
         volume.delete(0)
 
 
-def clean_extraneous_images():
-    conn = libvirt.open('qemu:///system')
-    pool = uvtool.libvirt.get_libvirt_pool_object(conn, LIBVIRT_POOL_NAME)
-    encoded_libvirt_pool_names = uvtool.libvirt.volume_names_in_pool(
-        LIBVIRT_POOL_NAME)
-    volume_names_in_use = frozenset(
-        uvtool.libvirt.get_all_domain_volume_names(
-            filter_by_dir=IMAGE_DIR)
+def collect_garbage(conn=None, **kwargs):
+    """Delete the volumes in the pool that nothing needs any more.
+
+    Keyword arguments are passed to PoolGarbageCollector.collect(). Return a
+    GCReport.
+
+    """
+    # A volume may be shared by several product versions, so it can only go
+    # once none of them refer to it.
+    held_volumes = frozenset(
+        _volume_name(encoded_libvirt_name, metadata)
+        for encoded_libvirt_name, metadata in get_pool_metadata().items()
     )
-    for encoded_libvirt_name in encoded_libvirt_pool_names:
-        if (encoded_libvirt_name not in volume_names_in_use and
-                not encoded_libvirt_name in pool_metadata):
-            uvtool.libvirt.delete_volume_by_name(
-                encoded_libvirt_name, pool_name=LIBVIRT_POOL_NAME)
+    return get_pool_gc().collect(
+        held_volumes, LIBVIRT_POOL_NAME, filter_by_dir=IMAGE_DIR, conn=conn,
+        **kwargs
+    )
+
+
+def clean_extraneous_images(conn=None):
+    """Delete unneeded volumes, checking every reference from scratch."""
+    collect_garbage(conn, full=True)
+
+
+def _remove_metadata(encoded_libvirt_name):
+    pool_metadata = get_pool_metadata()
+    volume_name = _volume_name(
+        encoded_libvirt_name, pool_metadata[encoded_libvirt_name])
+    del pool_metadata[encoded_libvirt_name]
+    get_pool_gc().release_image(volume_name)
 
 
 def _load_products(path=None, content_id=None, clean=False):
@@ -164,11 +295,16 @@ def _load_products(path=None, content_id=None, clean=False):
     def new_product():
         return {'versions': {}}
     products = collections.defaultdict(new_product)
+    pool_metadata = get_pool_metadata()
+    # Check for volumes against one listing of the pool, rather than looking
+    # each one up over its own libvirt connection.
+    volume_names_in_pool = frozenset(
+        uvtool.libvirt.volume_names_in_pool(LIBVIRT_POOL_NAME))
     for encoded_libvirt_name_string, metadata in pool_metadata.items():
         encoded_libvirt_name_bytes = encoded_libvirt_name_string.encode(
             'utf-8')
-        if not uvtool.libvirt.have_volume_by_name(
-                encoded_libvirt_name_bytes, pool_name=LIBVIRT_POOL_NAME):
+        if (_volume_name(encoded_libvirt_name_string, metadata) not in
+                volume_names_in_pool):
             if clean:
                 del pool_metadata[encoded_libvirt_name_string]
             continue
@@ -182,73 +318,42 @@ def _load_products(path=None, content_id=None, clean=False):
     return {'content_id': content_id, 'products': products}
 
 
-class LibvirtQuery(simplestreams.mirrors.BasicMirrorWriter):
-    def __init__(self, filters):
-        super(LibvirtQuery, self).__init__()
-        self.filters = filters
-        self.result = []
+def _query(filter_args):
+    """Return (metadata key, volume name) for each matching image.
 
-    def load_products(self, path=None, content_id=None):
-        return {'content_id': content_id, 'products': {}}
+    Filters have the same meaning as for a sync, but are answered from an
+    index of the stored metadata rather than by walking every product.
 
-    def filter_item(self, data, src, target, pedigree):
-        return simplestreams.filters.filter_item(
-            self.filters, data, src, pedigree)
-
-    def insert_item(self, data, src, target, pedigree, contentsource):
-        product_name, version_name, item_name = pedigree
-        self.result.append((product_name, version_name))
+    """
+    import simplestreams.filters
+    filters = simplestreams.filters.get_filters(filter_args)
+    pool_metadata = get_pool_metadata()
+    keys = pool_metadata.index().select(filters)
+    if not keys:
+        return []
+    volume_names_in_pool = frozenset(
+        uvtool.libvirt.volume_names_in_pool(LIBVIRT_POOL_NAME))
+    result = []
+    for encoded_libvirt_name in sorted(keys):
+        volume_name = _volume_name(
+            encoded_libvirt_name, pool_metadata[encoded_libvirt_name])
+        if volume_name in volume_names_in_pool:
+            result.append((encoded_libvirt_name, volume_name))
+    return result
 
 
 def query(filter_args):
-    query = LibvirtQuery(simplestreams.filters.get_filters(filter_args))
-    query.sync_products(None, src=_load_products())
-    return (_encode_libvirt_pool_name(product_name, version_name)
-        for product_name, version_name in query.result)
-
-class LibvirtMirror(simplestreams.mirrors.BasicMirrorWriter):
-    def __init__(self, filters, verbose=False):
-        super(LibvirtMirror, self).__init__({'max_items': 1})
-        self.filters = filters
-        self.verbose = verbose
-
-    def load_products(self, path=None, content_id=None):
-        return _load_products(path=path, content_id=content_id, clean=True)
-
-    def filter_index_entry(self, data, src, pedigree):
-        return data['datatype'] == 'image-downloads'
-
-    def filter_item(self, data, src, target, pedigree):
-        return simplestreams.filters.filter_item(
-            self.filters, data, src, pedigree)
-
-    def insert_item(self, data, src, target, pedigree, contentsource):
-        product_name, version_name, item_name = pedigree
-        assert(item_name == 'disk1.img')
-        if self.verbose:
-            print("Adding: %s %s" % (product_name, version_name))
-        encoded_libvirt_name = _encode_libvirt_pool_name(
-            product_name, version_name)
-        if not uvtool.libvirt.have_volume_by_name(
-                encoded_libvirt_name, pool_name=LIBVIRT_POOL_NAME):
-            uvtool.libvirt.create_volume_from_fobj(
-                encoded_libvirt_name, contentsource, image_type='qcow2',
-                pool_name=LIBVIRT_POOL_NAME
-            )
-        pool_metadata[encoded_libvirt_name] = (
-            simplestreams.util.products_exdata(src, pedigree)
-        )
-
-    def remove_version(self, data, src, target, pedigree):
-        product_name, version_name = pedigree
-        if self.verbose:
-            print("Removing: %s %s" % (product_name, version_name))
-        encoded_libvirt_name = _encode_libvirt_pool_name(
-            product_name, version_name)
-        del pool_metadata[encoded_libvirt_name]
-
+    return (volume_name for _, volume_name in _query(filter_args))
 
 def main_sync(args):
+    import simplestreams.filters
+    import simplestreams.mirrors
+    import simplestreams.util
+    import uvtool.download
+    from uvtool.libvirt.mirror import LibvirtMirror
+
+    if not args.filters:
+        args.filters = ["arch=%s" % uvtool.facts.system_arch()]
     (mirror_url, initial_path) = simplestreams.util.path_from_mirror_url(
         args.mirror_url, args.path)
 
@@ -265,20 +370,53 @@ def main_sync(args):
     filter_list = simplestreams.filters.get_filters(
         ['datatype=image-downloads', 'ftype=disk1.img'] + args.filters
     )
-    tmirror = LibvirtMirror(filter_list, verbose=args.verbose)
+    # A sync can spend a long time downloading between libvirt calls, so
+    # make sure that the shared connection is still alive when it resumes.
+    uvtool.libvirt.session.keepalive = True
+    if args.download_cache:
+        download_cache = uvtool.download.DownloadCache(args.download_cache)
+    else:
+        download_cache = None
+    tmirror = LibvirtMirror(
+        filter_list, verbose=args.verbose, block_size=args.block_size,
+        jobs=args.jobs, bandwidth_limit=args.bandwidth_limit,
+        download_cache=download_cache
+    )
     tmirror.sync(smirror, initial_path)
-    clean_extraneous_images()
+    tmirror.finish()
+    if download_cache:
+        removed = download_cache.evict(
+            max_size=args.download_cache_max_size,
+            max_age=args.download_cache_max_age * 24 * 60 * 60
+        )
+        if args.verbose and removed:
+            print("Evicted %d bytes from the download cache" % removed)
+    report = collect_garbage(
+        retain_size=args.retain_size, retain_age=_days(args.retain_age))
+    if args.verbose:
+        print("Garbage collection: %s" % report)
 
 
 def libvirt_pool_name_to_useful_description_string(libvirt_pool_name):
-    volume_metadata = pool_metadata[libvirt_pool_name]
+    volume_metadata = get_pool_metadata()[libvirt_pool_name]
     filters = ' '.join('='.join((key, volume_metadata[key])) for key in USEFUL_FIELD_NAMES)
     return ' '.join([filters, '(%s)' % volume_metadata['version_name']])
 
 
 def main_query(args):
-    result = query(args.filters)
-    useful_result = sorted(libvirt_pool_name_to_useful_description_string(r) for r in result)
+    result = _query(args.filters)
+    if args.format == 'json':
+        metadata_list = []
+        for encoded_libvirt_name, volume_name in result:
+            metadata = get_pool_metadata()[encoded_libvirt_name]
+            metadata[VOLUME_FIELD] = volume_name
+            metadata_list.append(metadata)
+        print(json.dumps(metadata_list, indent=2, sort_keys=True))
+        return
+    useful_result = sorted(
+        libvirt_pool_name_to_useful_description_string(encoded_libvirt_name)
+        for encoded_libvirt_name, _ in result
+    )
     print(*useful_result, sep="\n")
 
 
@@ -286,13 +424,38 @@ def main_purge(args):
     purge_pool()
 
 
-def main(argv=None):
-    # Workaround for https://bugzilla.redhat.com/show_bug.cgi?id=1063766
-    # (LP: #1228231)
-    libvirt.registerErrorHandler(lambda _: None, None)
+def _days(days):
+    return None if days is None else days * 24 * 60 * 60
+
 
-    system_arch = subprocess.check_output(
-        ['dpkg', '--print-architecture']).decode().strip()
+def main_gc(args):
+    report = collect_garbage(
+        full=args.full, dry_run=args.dry_run, retain_size=args.retain_size,
+        retain_age=_days(args.retain_age)
+    )
+    if args.verbose:
+        for volume_name, size in report.collected:
+            print("%s %s (%d bytes)" % (
+                "Reclaimable:" if args.dry_run else "Deleted:",
+                volume_name, size
+            ))
+        for volume_name, size in report.retained:
+            print("Retained: %s (%d bytes)" % (volume_name, size))
+    print(report)
+
+
+def _add_gc_arguments(subparser):
+    subparser.add_argument(
+        '--retain-size', type=int, default=None, metavar='BYTES',
+        help='keep up to BYTES of unused images, most recently used first'
+    )
+    subparser.add_argument(
+        '--retain-age', type=int, default=None, metavar='DAYS',
+        help='keep unused images for DAYS after they were last used'
+    )
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true')
     subparsers = parser.add_subparsers()
@@ -311,19 +474,78 @@ def main(argv=None):
     sync_subparser.add_argument('--source', dest='mirror_url',
         default='https://cloud-images.ubuntu.com/releases/')
     sync_subparser.add_argument('--no-authentication', action='store_true')
-    sync_subparser.add_argument('filters', nargs='*', metavar='filter',
-        default=["arch=%s" % system_arch])
+    sync_subparser.add_argument(
+        '--block-size', type=int, default=None,
+        help='bytes to read and send to libvirt at a time when uploading'
+    )
+    sync_subparser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='number of images to download and import at once'
+    )
+    sync_subparser.add_argument(
+        '--bandwidth-limit', type=int, default=None, metavar='BYTES',
+        help='limit the total download rate to BYTES per second'
+    )
+    sync_subparser.add_argument(
+        '--download-cache', default=DOWNLOAD_CACHE_DIR, metavar='DIR',
+        help='keep downloads in DIR so that interrupted ones can resume'
+    )
+    sync_subparser.add_argument(
+        '--no-download-cache', dest='download_cache', action='store_const',
+        const=None, help='do not keep downloads'
+    )
+    sync_subparser.add_argument(
+        '--download-cache-max-size', type=int,
+        default=DOWNLOAD_CACHE_MAX_SIZE, metavar='BYTES',
+        help='evict least recently used downloads beyond this total size'
+    )
+    sync_subparser.add_argument(
+        '--download-cache-max-age', type=int,
+        default=DOWNLOAD_CACHE_MAX_AGE_DAYS, metavar='DAYS',
+        help='evict downloads not used for this many days'
+    )
+    _add_gc_arguments(sync_subparser)
+    sync_subparser.add_argument('filters', nargs='*', metavar='filter')
 
     query_subparser = subparsers.add_parser('query')
     query_subparser.set_defaults(func=main_query)
+    query_subparser.add_argument(
+        '--format', choices=['text', 'json'], default='text',
+        help='print a summary line for each image, or all of its metadata'
+    )
     query_subparser.add_argument(
         'filters', nargs='*', default=[], metavar='filter')
 
     purge_subparser = subparsers.add_parser('purge')
     purge_subparser.set_defaults(func=main_purge)
 
+    gc_subparser = subparsers.add_parser('gc')
+    gc_subparser.set_defaults(func=main_gc)
+    gc_subparser.add_argument(
+        '--dry-run', action='store_true',
+        help='report what would be deleted without deleting it'
+    )
+    gc_subparser.add_argument(
+        '--full', action='store_true',
+        help='check every domain and volume rather than only what changed'
+    )
+    _add_gc_arguments(gc_subparser)
+
     args = parser.parse_args(argv)
-    args.func(args)
+
+    # Workaround for https://bugzilla.redhat.com/show_bug.cgi?id=1063766
+    # (LP: #1228231). This is only done once the arguments have been parsed,
+    # so that --help does not import libvirt.
+    libvirt.registerErrorHandler(lambda _: None, None)
+    try:
+        args.func(args)
+    finally:
+        uvtool.libvirt.session.close()
+        if args.verbose:
+            print(
+                "libvirt: %s" % uvtool.libvirt.format_counters(),
+                file=sys.stderr
+            )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,390 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Image metadata storage in a single SQLite database.
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import collections
+import contextlib
+import errno
+import json
+import os
+import sqlite3
+import threading
+
+DATABASE_NAME = '.index.sqlite'
+
+# Metadata fields that have their own indexed columns, for select().
+INDEXED_FIELDS = ['release', 'arch', 'label']
+
+# How long to wait for another process to finish writing, in seconds.
+LOCK_TIMEOUT = 30
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY,
+        release TEXT,
+        arch TEXT,
+        label TEXT,
+        json TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS metadata_release ON metadata (release)',
+    'CREATE INDEX IF NOT EXISTS metadata_arch ON metadata (arch)',
+    'CREATE INDEX IF NOT EXISTS metadata_label ON metadata (label)',
+    '''CREATE TABLE IF NOT EXISTS state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )''',
+    "INSERT OR IGNORE INTO state (name, value) VALUES ('generation', 0)",
+    '''CREATE TABLE IF NOT EXISTS resolutions (
+        key TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL,
+        volume TEXT NOT NULL,
+        path TEXT NOT NULL
+    )''',
+]
+_TABLES = ['metadata', 'state', 'resolutions']
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def has_tables(conn, tables):
+    """Return True if every one of tables exists in the database.
+
+    This only reads, so a schema that is already in place can be checked
+    for without taking the write lock, or write access at all.
+
+    """
+    existing = frozenset(name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    return existing.issuperset(tables)
+
+
+def _share_with_directory_group(directory, path):
+    # The metadata directory is shared by the members of its group, so
+    # the database must be too.
+    try:
+        os.chown(path, -1, os.stat(directory).st_gid)
+        os.chmod(path, 0o664)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            raise
+
+
+def connect(directory):
+    """Open the database in directory, creating both if necessary.
+
+    Other users of the database, such as uvtool.libvirt.poolgc, keep their
+    own tables in it alongside the metadata.
+
+    """
+    _mkdir_p(directory)
+    path = os.path.join(directory, DATABASE_NAME)
+    is_new = not os.path.exists(path)
+    conn = sqlite3.connect(
+        path, timeout=LOCK_TIMEOUT, isolation_level=None,
+        check_same_thread=False
+    )
+    if is_new:
+        _share_with_directory_group(directory, path)
+    return conn
+
+
+class FieldIndex(object):
+    """An inverted index of metadata by the value of each field.
+
+    select() takes filters in the form of simplestreams.filters.ItemFilter:
+    objects with a key attribute naming a field, and a matches() method
+    taking a dict. Each filter is evaluated once per distinct value of its
+    field rather than once per item, with the same result as calling it on
+    every item; an item without the field is matched as an empty dict.
+
+    """
+    def __init__(self, items):
+        self.keys = frozenset()
+        # field -> value -> set of keys
+        self._values = collections.defaultdict(
+            lambda: collections.defaultdict(set))
+        # field -> key -> value, for values that cannot be dict keys
+        self._unhashable = collections.defaultdict(dict)
+        keys = set()
+        for key, metadata in items:
+            keys.add(key)
+            for field, value in metadata.items():
+                try:
+                    self._values[field][value].add(key)
+                except TypeError:
+                    self._unhashable[field][key] = value
+        self.keys = frozenset(keys)
+
+    def _matching(self, item_filter):
+        field = item_filter.key
+        present = set()
+        matching = set()
+        for value, keys in self._values.get(field, {}).items():
+            present.update(keys)
+            if item_filter.matches({field: value}):
+                matching.update(keys)
+        for key, value in self._unhashable.get(field, {}).items():
+            present.add(key)
+            if item_filter.matches({field: value}):
+                matching.add(key)
+        if item_filter.matches({}):
+            matching.update(self.keys - present)
+        return matching
+
+    def select(self, filters):
+        """Return the set of keys whose metadata matches every filter."""
+        result = set(self.keys)
+        for item_filter in filters:
+            if not result:
+                break
+            result.intersection_update(self._matching(item_filter))
+        return result
+
+
+class MetadataStore(object):
+    """A dict-like store of image metadata, keyed by encoded volume name.
+
+    Everything lives in one SQLite database in metadata_dir, so updates are
+    atomic and each read is a single query. Every write bumps a generation
+    number stored alongside the data; a copy of all metadata is kept in
+    memory and only reloaded when the generation has changed, whether by
+    this process or another one.
+
+    What filters last resolved to, for uvt-kvm create, is kept alongside
+    and is only valid until the generation next changes.
+
+    Metadata from older versions of uvtool, kept as one JSON file per key in
+    metadata_dir, is moved into the database the first time it is opened.
+    Otherwise, opening a database that is already set up only reads, so
+    users without write access to it can still query it.
+
+    """
+    def __init__(self, metadata_dir):
+        self.metadata_dir = metadata_dir
+        self._lock = threading.RLock()
+        self._conn = None
+        self._generation = None
+        self._cache = None
+        self._index = None
+        self._index_generation = None
+        # Deliberately do not create metadata_dir or the database until they
+        # are first used, since this class is instantiated when
+        # uvtool.libvirt.simplestreams is loaded, and we want to be able to
+        # test that module without affecting the system metadata directory.
+
+    @property
+    def database_path(self):
+        return os.path.join(self.metadata_dir, DATABASE_NAME)
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        conn = connect(self.metadata_dir)
+        legacy_keys = self._legacy_keys()
+        if legacy_keys or not has_tables(conn, _TABLES):
+            with transaction(conn):
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+                migrated_keys = self._migrate_json_files(conn)
+        else:
+            migrated_keys = []
+        # Only remove the old files once they are all in the database. If
+        # this is interrupted, then the next migration just repeats the
+        # writes for the files that remain.
+        for key in migrated_keys:
+            try:
+                os.unlink(os.path.join(self.metadata_dir, key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self._conn = conn
+        return conn
+
+    def _legacy_keys(self):
+        return [
+            name for name in os.listdir(self.metadata_dir)
+            if not name.startswith('.')
+        ]
+
+    def _migrate_json_files(self, conn):
+        """Copy any metadata files into the database and return their keys.
+        """
+        legacy_keys = self._legacy_keys()
+        for key in legacy_keys:
+            with codecs.open(
+                    os.path.join(self.metadata_dir, key), 'rb',
+                    encoding='utf-8') as f:
+                self._put(conn, key, json.load(f))
+        if legacy_keys:
+            self._bump_generation(conn)
+        return legacy_keys
+
+    @staticmethod
+    def _put(conn, key, metadata):
+        conn.execute(
+            'INSERT OR REPLACE INTO metadata '
+            '(key, release, arch, label, json) VALUES (?, ?, ?, ?, ?)',
+            [key] + [metadata.get(field) for field in INDEXED_FIELDS] +
+            [json.dumps(metadata)]
+        )
+
+    @staticmethod
+    def _bump_generation(conn):
+        conn.execute(
+            "UPDATE state SET value = value + 1 WHERE name = 'generation'")
+
+    def generation(self):
+        """Return the current generation, which every write changes."""
+        with self._lock:
+            generation, = self._connect().execute(
+                "SELECT value FROM state WHERE name = 'generation'"
+            ).fetchone()
+            return generation
+
+    def _load(self):
+        """Return all metadata, reloading it only if it has changed."""
+        with self._lock:
+            conn = self._connect()
+            generation = self.generation()
+            if generation != self._generation:
+                self._cache = collections.OrderedDict(
+                    (key, json.loads(data)) for key, data in conn.execute(
+                        'SELECT key, json FROM metadata ORDER BY key')
+                )
+                self._generation = generation
+            return self._cache
+
+    def _write(self, statement, parameters):
+        with self._lock:
+            conn = self._connect()
+            with transaction(conn):
+                cursor = conn.execute(statement, parameters)
+                self._bump_generation(conn)
+            return cursor.rowcount
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __getitem__(self, key):
+        return dict(self._load()[key])
+
+    def __setitem__(self, key, metadata):
+        with self._lock:
+            conn = self._connect()
+            with transaction(conn):
+                self._put(conn, key, metadata)
+                self._bump_generation(conn)
+
+    def __delitem__(self, key):
+        if not self._write('DELETE FROM metadata WHERE key = ?', [key]):
+            raise KeyError(key)
+
+    def __len__(self):
+        return len(self._load())
+
+    def keys(self):
+        return list(self._load().keys())
+
+    def values(self):
+        return [dict(metadata) for metadata in self._load().values()]
+
+    def items(self):
+        return [
+            (key, dict(metadata)) for key, metadata in self._load().items()]
+
+    def clear(self):
+        self._write('DELETE FROM metadata', [])
+
+    def index(self):
+        """Return a FieldIndex of all metadata, which is only rebuilt when
+        the metadata has changed."""
+        with self._lock:
+            cache = self._load()
+            if self._index_generation != self._generation:
+                self._index = FieldIndex(cache.items())
+                self._index_generation = self._generation
+            return self._index
+
+    def get_resolution(self, key):
+        """Return the (volume name, path) recorded for key, or None if there
+        is none or the metadata has changed since it was recorded.
+
+        This is a single query that does not load any metadata.
+
+        """
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT volume, path FROM resolutions, state '
+                "WHERE key = ? AND name = 'generation' AND generation = value",
+                [key]
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def set_resolution(self, key, volume, path, generation):
+        """Record what key resolved to when the metadata was at generation.
+        """
+        with self._lock:
+            conn = self._connect()
+            with transaction(conn):
+                conn.execute(
+                    'DELETE FROM resolutions WHERE generation != ?',
+                    [generation]
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO resolutions '
+                    '(key, generation, volume, path) VALUES (?, ?, ?, ?)',
+                    [key, generation, volume, path]
+                )
+
+    def select(self, **fields):
+        """Return the items whose indexed fields equal those given."""
+        for field in fields:
+            if field not in INDEXED_FIELDS:
+                raise ValueError("%s is not an indexed field" % field)
+        if not fields:
+            return self.items()
+        with self._lock:
+            conn = self._connect()
+            keys = [row[0] for row in conn.execute(
+                'SELECT key FROM metadata WHERE ' + ' AND '.join(
+                    '%s = ?' % field for field in fields),
+                list(fields.values())
+            )]
+            cache = self._load()
+        return [(key, dict(cache[key])) for key in keys if key in cache]
@@ -18,21 +18,35 @@
 
 KEY_TYPES = ['rsa', 'dsa', 'ecdsa', 'ed25519']
 
+import errno
+import fcntl
 import os
 import shutil
 import subprocess
-import tempfile
 
+import uvtool.facts
 
-def _keygen(key_type, private_path):
-    subprocess.check_call([
+# How many key sets "uvt-kvm keypool fill" keeps ready unless told otherwise.
+DEFAULT_KEY_POOL_SIZE = 4
+
+
+def _keygen_args(key_type, private_path):
+    return [
         'ssh-keygen',
         '-q',
         '-f', private_path,
         '-N', '',
         '-t', key_type,
         '-C', 'root@localhost'
-    ])
+    ]
+
+
+def _keygen(key_type, private_path):
+    subprocess.check_call(_keygen_args(key_type, private_path))
+
+
+def _start_keygen(key_type, private_path):
+    return subprocess.Popen(_keygen_args(key_type, private_path))
 
 
 def read_file(path):
@@ -40,30 +54,161 @@ def read_file(path):
         return f.read()
 
 
-def generate_ssh_host_keys():
+def _generate_key_set(directory, key_types=KEY_TYPES):
+    # Each ssh-keygen runs in its own process, so run them all at once and
+    # take only as long as the slowest key type.
+    processes = [
+        (key_type, _start_keygen(key_type, os.path.join(directory, key_type)))
+        for key_type in key_types
+    ]
+    failure = None
+    for key_type, process in processes:
+        returncode = process.wait()
+        if returncode and failure is None:
+            failure = subprocess.CalledProcessError(
+                returncode,
+                _keygen_args(key_type, os.path.join(directory, key_type))
+            )
+    if failure:
+        raise failure
+
+
+def _read_key_set(directory, key_types=KEY_TYPES):
     cloud_init_result = {}
     known_hosts_result = []
-    tmp_dir = tempfile.mkdtemp(prefix='uvt-kvm.sshtmp')
-    try:
-        for key_type in KEY_TYPES:
-            private_path = os.path.join(tmp_dir, key_type)
-            _keygen(key_type, private_path)
+    for key_type in key_types:
+        private_path = os.path.join(directory, key_type)
+
+        # ssh-keygen(1) defines that ".pub" is appended
+        public_path = private_path + ".pub"
 
-            # ssh-keygen(1) defines that ".pub" is appended
-            public_path = private_path + ".pub"
+        key_type_utf8 = key_type.encode('utf-8')
+        private_ci_key = key_type_utf8 + b'_private'
+        public_ci_key = key_type_utf8 + b'_public'
 
-            key_type_utf8 = key_type.encode('utf-8')
-            private_ci_key = key_type_utf8 + b'_private'
-            public_ci_key = key_type_utf8 + b'_public'
+        private_key = read_file(private_path)
+        public_key = read_file(public_path)
 
-            private_key = read_file(private_path)
-            public_key = read_file(public_path)
+        cloud_init_result[private_ci_key] = private_key
+        cloud_init_result[public_ci_key] = public_key
 
-            cloud_init_result[private_ci_key] = private_key
-            cloud_init_result[public_ci_key] = public_key
+        known_hosts_result.append(public_key)
 
-            known_hosts_result.append(public_key)
+    return cloud_init_result, b''.join(known_hosts_result)
+
+
+def generate_ssh_host_keys(key_types=KEY_TYPES):
+    import tempfile
+    tmp_dir = tempfile.mkdtemp(prefix='uvt-kvm.sshtmp')
+    try:
+        _generate_key_set(tmp_dir, key_types)
+        return _read_key_set(tmp_dir, key_types)
     finally:
         shutil.rmtree(tmp_dir)
 
-    return cloud_init_result, b''.join(known_hosts_result)
+
+class KeyPool(object):
+    """A spool of host key sets generated ahead of time.
+
+    Each set is a directory of ssh-keygen output. Sets are generated under a
+    name starting with '.' and renamed into place when complete, and are
+    taken by renaming them away, so that however many processes share the
+    pool, every set is used at most once.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _names(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(name for name in names if not name.startswith('.'))
+
+    def __len__(self):
+        return len(self._names())
+
+    def take(self, key_types=KEY_TYPES):
+        """Remove a key set that has all of key_types from the pool and
+        return those keys in the same form as generate_ssh_host_keys(), or
+        return None if the pool has no such set."""
+        for name in self._names():
+            path = os.path.join(self.directory, name)
+            # A set is complete before it appears, so this cannot change.
+            if not all(os.path.exists(os.path.join(path, key_type))
+                    for key_type in key_types):
+                continue
+            taken_path = os.path.join(self.directory, '.taken-' + name)
+            try:
+                os.rename(path, taken_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Another process took it first
+                continue
+            try:
+                return _read_key_set(taken_path, key_types)
+            finally:
+                shutil.rmtree(taken_path)
+        return None
+
+    @property
+    def _size_path(self):
+        return os.path.join(self.directory, '.size')
+
+    def _read_size(self):
+        try:
+            return int(read_file(self._size_path))
+        except (IOError, ValueError):
+            return DEFAULT_KEY_POOL_SIZE
+
+    def fill(self, size=None):
+        """Generate key sets until the pool holds size of them.
+
+        size is remembered for later calls that do not give one. If another
+        process is already filling the pool, return at once. Return the
+        number of key sets generated.
+
+        """
+        import tempfile
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        with open(os.path.join(self.directory, '.lock'), 'wb') as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    raise
+                return 0
+            # Holding the lock, anything still being generated was left by
+            # a fill that did not finish.
+            for name in os.listdir(self.directory):
+                if name.startswith('.new-'):
+                    shutil.rmtree(os.path.join(self.directory, name))
+            if size is None:
+                size = self._read_size()
+            else:
+                with open(self._size_path, 'wb') as f:
+                    f.write(str(size).encode('ascii'))
+            generated = 0
+            while len(self) < size:
+                tmp_dir = tempfile.mkdtemp(prefix='.new-', dir=self.directory)
+                try:
+                    _generate_key_set(tmp_dir)
+                except:
+                    shutil.rmtree(tmp_dir)
+                    raise
+                os.rename(tmp_dir, os.path.join(
+                    self.directory,
+                    'keys-' + os.path.basename(tmp_dir)[len('.new-'):]
+                ))
+                generated += 1
+            return generated
+
+
+def default_key_pool():
+    return KeyPool(os.path.join(uvtool.facts.cache_dir(), 'keypool'))
+
@@ -0,0 +1,68 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare generating ssh host keys one type after another with generating
+# them all at once, as uvtool.ssh does. Run from the top of the source tree
+# with:
+#
+#     PYTHONPATH=. python -m uvtool.tests.bench_keygen [runs]
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import uvtool.ssh
+
+
+def generate_serially(directory, key_types):
+    for key_type in key_types:
+        uvtool.ssh._keygen(key_type, os.path.join(directory, key_type))
+
+
+def time_generation(generate, key_types, runs):
+    """Return the sorted times taken by runs calls of generate."""
+    times = []
+    for _ in range(runs):
+        directory = tempfile.mkdtemp(prefix='uvt-bench-keygen.')
+        try:
+            start = time.time()
+            generate(directory, key_types)
+            times.append(time.time() - start)
+        finally:
+            shutil.rmtree(directory)
+    return sorted(times)
+
+
+def main(argv):
+    runs = int(argv[0]) if argv else 5
+    print("%-28s %-10s %8s %8s" % ('key types', 'method', 'min ms', 'median ms'))
+    for key_types in [uvtool.ssh.KEY_TYPES, ['ecdsa', 'ed25519'], ['ed25519']]:
+        for method, generate in [
+                ('serial', generate_serially),
+                ('parallel', uvtool.ssh._generate_key_set)]:
+            times = time_generation(generate, key_types, runs)
+            print("%-28s %-10s %8.1f %8.1f" % (
+                ','.join(key_types), method,
+                times[0] * 1000, times[len(times) // 2] * 1000
+            ))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure how long the command line tools take to start.
+#
+# Each subcommand is run with --help, so that everything up to parsing its
+# arguments is timed without needing libvirt or any domains. Run from the
+# top of the source tree with:
+#
+#     PYTHONPATH=. python -m uvtool.tests.bench_startup [runs]
+#
+# This exits with an error if any median is over MAX_STARTUP_MS, which
+# leaves a margin below the 100ms at which a command stops feeling instant.
+# The tree is byte-compiled first, as an installed package is, so that
+# compiling the sources is not timed on every run.
+
+from __future__ import print_function
+
+import compileall
+import os
+import subprocess
+import sys
+import time
+
+MAX_STARTUP_MS = 80
+
+COMMANDS = [
+    ['uvt-kvm', 'ip'],
+    ['uvt-kvm', 'ssh'],
+    ['uvt-kvm', 'list'],
+    ['uvt-kvm', 'destroy'],
+    ['uvt-kvm', 'create'],
+    ['uvt-kvm', 'wait'],
+    ['uvt-simplestreams-libvirt', 'query'],
+    ['uvt-simplestreams-libvirt', 'sync'],
+]
+
+
+def time_command(command, runs):
+    """Return the sorted times taken by runs invocations of command."""
+    if command is None:
+        args = [sys.executable, '-c', 'pass']
+    else:
+        args = [sys.executable, os.path.join('bin', command[0])] + \
+            command[1:] + ['--help']
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def main(argv):
+    runs = int(argv[0]) if argv else 10
+    compileall.compile_dir('uvtool', quiet=True)
+    print("%-40s %8s %8s" % ('command', 'min ms', 'median ms'))
+    slow = []
+    for command in [None] + COMMANDS:
+        times = time_command(command, runs)
+        median_ms = times[len(times) // 2] * 1000
+        print("%-40s %8.1f %8.1f" % (
+            ' '.join(command) if command else '(python alone)',
+            times[0] * 1000, median_ms
+        ))
+        if command and median_ms > MAX_STARTUP_MS:
+            slow.append(' '.join(command))
+    if slow:
+        print("Slower than %dms: %s" % (MAX_STARTUP_MS, ', '.join(slow)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
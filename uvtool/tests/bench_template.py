@@ -0,0 +1,64 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measure how long it takes to compose domain XML from a template, compiling
+# the template every time against using the cached compiled template. Run
+# from the top of the source tree with:
+#
+#     PYTHONPATH=. python -m uvtool.tests.bench_template [runs [template]]
+
+from __future__ import print_function
+
+import sys
+import time
+
+from lxml import etree
+
+import uvtool.libvirt.kvm
+
+DISKS = [('/pool/foo.qcow', 'qcow2'), ('/pool/foo-ds.qcow', 'raw')]
+
+
+def compose_uncached(path):
+    template = uvtool.libvirt.kvm.DomainTemplate(etree.parse(path), path)
+    return template.render('foo', DISKS, ssh_known_hosts='known')
+
+
+def compose_cached(path):
+    return uvtool.libvirt.kvm.compose_domain_xml(
+        'foo', DISKS, template_path=path, ssh_known_hosts='known')
+
+
+def time_compose(compose, path, runs):
+    """Return the mean time taken by runs calls of compose."""
+    start = time.time()
+    for _ in range(runs):
+        compose(path)
+    return (time.time() - start) / runs
+
+
+def main(argv):
+    runs = int(argv[0]) if argv else 10000
+    path = argv[1] if len(argv) > 1 else 'template.xml'
+    print("%-10s %10s" % ('template', 'mean us'))
+    for method, compose in [
+            ('uncached', compose_uncached), ('cached', compose_cached)]:
+        print("%-10s %10.1f" % (
+            method, time_compose(compose, path, runs) * 1000000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+import unittest
+
+import uvtool.cidata
+
+SECTOR_SIZE = uvtool.cidata.SECTOR_SIZE
+
+
+def sector(image, n):
+    return image[n * SECTOR_SIZE:(n + 1) * SECTOR_SIZE]
+
+
+def read_directory(image, record):
+    """Return {identifier: (flags, data)} for the directory that record
+    points to, in the way that a reader of the image would find them."""
+    extent, size = struct.unpack('<I4xI', record[2:14])
+    data = image[extent * SECTOR_SIZE:extent * SECTOR_SIZE + size]
+    entries = {}
+    offset = 0
+    while offset < len(data):
+        length = ord(data[offset:offset + 1])
+        if length == 0:
+            # Records continue in the next sector
+            offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+            continue
+        record = data[offset:offset + length]
+        file_extent, file_size = struct.unpack('<I4xI', record[2:14])
+        flags = ord(record[25:26])
+        identifier = record[33:33 + ord(record[32:33])]
+        entries[identifier] = (flags, image[
+            file_extent * SECTOR_SIZE:file_extent * SECTOR_SIZE + file_size
+        ])
+        offset += length
+    return entries
+
+
+class TestMakeSeedImage(unittest.TestCase):
+    def setUp(self):
+        self.image = uvtool.cidata.make_seed_image(
+            b'#cloud-config\n', b'instance-id: i-1\n', now=0)
+
+    def testSize(self):
+        self.assertEqual(len(self.image) % SECTOR_SIZE, 0)
+        volume_size, = struct.unpack('<I', sector(self.image, 16)[80:84])
+        self.assertEqual(volume_size * SECTOR_SIZE, len(self.image))
+
+    def testDescriptors(self):
+        primary = sector(self.image, 16)
+        self.assertEqual(primary[:7], b'\x01CD001\x01')
+        self.assertEqual(primary[40:72].rstrip(b' '), b'cidata')
+        joliet = sector(self.image, 17)
+        self.assertEqual(joliet[:7], b'\x02CD001\x01')
+        self.assertEqual(joliet[88:91], b'%/E')
+        self.assertEqual(
+            joliet[40:72].decode('utf-16-be').rstrip(' '), 'cidata')
+        self.assertEqual(sector(self.image, 18)[:7], b'\xffCD001\x01')
+
+    def testPrimaryTree(self):
+        root = read_directory(self.image, sector(self.image, 16)[156:190])
+        self.assertEqual(root[b'\0'][0], 2)
+        self.assertEqual(root[b'USER_DAT.;1'], (0, b'#cloud-config\n'))
+        self.assertEqual(root[b'META_DAT.;1'], (0, b'instance-id: i-1\n'))
+
+    def testJolietTree(self):
+        root = read_directory(self.image, sector(self.image, 17)[156:190])
+        self.assertEqual(
+            root['user-data;1'.encode('utf-16-be')],
+            (0, b'#cloud-config\n')
+        )
+        self.assertEqual(
+            root['meta-data;1'.encode('utf-16-be')],
+            (0, b'instance-id: i-1\n')
+        )
+
+    def testLargeFile(self):
+        user_data = b'x' * (SECTOR_SIZE * 2 + 1)
+        image = uvtool.cidata.make_seed_image(user_data, b'', now=0)
+        root = read_directory(image, sector(image, 17)[156:190])
+        self.assertEqual(root['user-data;1'.encode('utf-16-be')][1], user_data)
+        self.assertEqual(root['meta-data;1'.encode('utf-16-be')][1], b'')
+
+    def testReproducible(self):
+        self.assertEqual(
+            self.image,
+            uvtool.cidata.make_seed_image(
+                b'#cloud-config\n', b'instance-id: i-1\n', now=0)
+        )
+
+
+class TestMakeIso(unittest.TestCase):
+    def testNameClash(self):
+        self.assertRaises(
+            ValueError, uvtool.cidata.make_iso,
+            [('user-data', b''), ('user_data', b'')]
+        )
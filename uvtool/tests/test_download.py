@@ -0,0 +1,182 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+import uvtool.download
+
+DATA = b'0123456789abcdef'
+
+
+class TestDownloadCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.source_path = os.path.join(self.tmpdir, 'source')
+        with open(self.source_path, 'wb') as f:
+            f.write(DATA)
+        self.cache = uvtool.download.DownloadCache(
+            os.path.join(self.tmpdir, 'cache'))
+        self.key = self.cache.key('product', 'version', 'item', 'checksum')
+
+    def write_partial(self, data):
+        os.mkdir(self.cache.cache_dir)
+        with open(self.cache.path(self.key), 'wb') as f:
+            f.write(data)
+
+    def read_partial(self):
+        with open(self.cache.path(self.key), 'rb') as f:
+            return f.read()
+
+    def testDownload(self):
+        fobj = self.cache.open(
+            self.key, self.source_path, source=io.BytesIO(DATA),
+            size=len(DATA)
+        )
+        self.assertEqual(fobj.read(), DATA)
+        self.assertEqual(self.read_partial(), DATA)
+        # The entry stays locked until the download has been used
+        self.assertIsNone(self.cache.open(self.key, self.source_path))
+        fobj.close()
+        self.cache.discard(self.key)
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+    def testComplete(self):
+        self.write_partial(DATA)
+        fobj = self.cache.open(
+            self.key, 'http://example.com/unused', size=len(DATA))
+        self.assertEqual(fobj.read(), DATA)
+        fobj.close()
+
+    def testResumeFromFile(self):
+        self.write_partial(DATA[:5])
+        source = mock.Mock()
+        fobj = self.cache.open(
+            self.key, 'file://' + self.source_path, source=source)
+        self.assertEqual(b''.join(iter(lambda: fobj.read(3), b'')), DATA)
+        fobj.close()
+        self.assertFalse(source.read.called)
+        self.assertEqual(self.read_partial(), DATA)
+
+    def testInterrupted(self):
+        fobj = self.cache.open(
+            self.key, self.source_path, source=io.BytesIO(DATA))
+        fobj.read(4)
+        fobj.close()
+        self.assertEqual(self.read_partial(), DATA[:4])
+
+    def testShort(self):
+        fobj = self.cache.open(
+            self.key, self.source_path, source=io.BytesIO(DATA[:4]),
+            size=len(DATA)
+        )
+        self.assertRaises(uvtool.download.DownloadError, fobj.read)
+        fobj.close()
+        # Kept to be resumed
+        self.assertEqual(self.read_partial(), DATA[:4])
+
+    def testLong(self):
+        fobj = self.cache.open(
+            self.key, self.source_path, source=io.BytesIO(DATA + b'x'),
+            size=len(DATA)
+        )
+        self.assertRaises(uvtool.download.DownloadError, fobj.read)
+        fobj.close()
+        self.assertEqual(self.read_partial(), b'')
+
+    def testLongPartialRestarts(self):
+        self.write_partial(DATA + b'x')
+        fobj = self.cache.open(
+            self.key, self.source_path, source=io.BytesIO(DATA),
+            size=len(DATA)
+        )
+        self.assertEqual(fobj.read(), DATA)
+        fobj.close()
+        self.assertEqual(self.read_partial(), DATA)
+
+    @mock.patch('uvtool.download.urllib2.urlopen')
+    def testResumeWithRange(self, urlopen):
+        self.write_partial(DATA[:5])
+        urlopen.return_value = mock.Mock()
+        urlopen.return_value.getcode.return_value = 206
+        urlopen.return_value.info.return_value.getheader.return_value = (
+            str(len(DATA) - 5))
+        urlopen.return_value.read.side_effect = [DATA[5:], b'']
+        fobj = self.cache.open(self.key, 'http://example.com/image')
+        self.assertEqual(fobj.read(), DATA)
+        fobj.close()
+        request = urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('Range'), 'bytes=5-')
+
+    @mock.patch('uvtool.download.urllib2.urlopen')
+    def testShortAgainstContentLength(self, urlopen):
+        urlopen.return_value = mock.Mock()
+        urlopen.return_value.getcode.return_value = 200
+        urlopen.return_value.info.return_value.getheader.return_value = (
+            str(len(DATA)))
+        urlopen.return_value.read.side_effect = [DATA[:5], b'']
+        fobj = self.cache.open(self.key, 'http://example.com/image')
+        self.assertRaises(uvtool.download.DownloadError, fobj.read)
+        fobj.close()
+        self.assertEqual(self.read_partial(), DATA[:5])
+
+    @mock.patch('uvtool.download.urllib2.urlopen')
+    def testRangeIgnored(self, urlopen):
+        self.write_partial(b'stale')
+        urlopen.return_value = mock.Mock()
+        urlopen.return_value.getcode.return_value = 200
+        urlopen.return_value.info.return_value.getheader.return_value = (
+            str(len(DATA)))
+        urlopen.return_value.read.side_effect = [DATA, b'']
+        fobj = self.cache.open(self.key, 'http://example.com/image')
+        self.assertEqual(fobj.read(), DATA)
+        fobj.close()
+        self.assertEqual(self.read_partial(), DATA)
+
+    def testLockedEntryBypassesCache(self):
+        self.write_partial(b'')
+        with open(self.cache.path(self.key), 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self.assertIsNone(self.cache.open(
+                self.key, self.source_path, source=io.BytesIO(DATA)))
+
+    @mock.patch('uvtool.download.os.open')
+    def testUnwritableEntryBypassesCache(self, os_open):
+        os_open.side_effect = OSError(errno.EACCES, 'Permission denied')
+        self.assertIsNone(self.cache.open(
+            self.key, self.source_path, source=io.BytesIO(DATA)))
+
+    def testEvict(self):
+        os.mkdir(self.cache.cache_dir)
+        now = time.time()
+        for name, age in [('old', 100), ('older', 200), ('new', 0)]:
+            path = self.cache.path(name)
+            with open(path, 'wb') as f:
+                f.write(DATA)
+            os.utime(path, (now - age, now - age))
+        self.assertEqual(self.cache.evict(max_age=150), len(DATA))
+        self.assertEqual(
+            self.cache.evict(max_size=len(DATA) + 1), len(DATA))
+        self.assertEqual(os.listdir(self.cache.cache_dir), ['new.partial'])
@@ -0,0 +1,68 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import uvtool.facts
+
+
+class TestCached(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.tmpdir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dependency = os.path.join(self.tmpdir, 'dependency')
+        open(self.dependency, 'w').close()
+        self.compute = mock.Mock(return_value='trusty')
+
+    def cached(self, **kwargs):
+        return uvtool.facts.cached(
+            'series', self.compute, depends=[self.dependency], **kwargs)
+
+    def testCached(self):
+        self.assertEqual(self.cached(), 'trusty')
+        self.assertEqual(self.cached(), 'trusty')
+        self.assertEqual(self.compute.call_count, 1)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'uvtool', uvtool.facts.FACTS_FILE)))
+
+    def testDependencyChanged(self):
+        self.cached()
+        os.utime(self.dependency, (0, 0))
+        self.cached()
+        self.assertEqual(self.compute.call_count, 2)
+
+    def testExpired(self):
+        with mock.patch('time.time', return_value=1000):
+            self.cached(max_age=100)
+        with mock.patch('time.time', return_value=1050):
+            self.cached(max_age=100)
+        self.assertEqual(self.compute.call_count, 1)
+        with mock.patch('time.time', return_value=1100):
+            self.cached(max_age=100)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def testUnwritable(self):
+        os.chmod(self.tmpdir, 0o500)
+        self.addCleanup(os.chmod, self.tmpdir, 0o700)
+        self.assertEqual(self.cached(), 'trusty')
@@ -14,11 +14,30 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 import mock
+from lxml import etree
 
-from uvtool.libvirt.kvm import main_ssh
+import uvtool.libvirt
+import uvtool.libvirt.store
+import uvtool.libvirt.kvm
+from uvtool.libvirt.kvm import (
+    CLIError,
+    DomainTemplate,
+    batch_hostnames,
+    compose_domain_xml,
+    create,
+    create_default_user_data,
+    get_base_image,
+    main_ssh,
+)
 
 
 class TestKVM(unittest.TestCase):
@@ -57,3 +76,435 @@ class TestKVM(unittest.TestCase):
         # In this obtuse case, the hostname has an '@' in it, so this should be
         # passed through.
         self.check_ssh('bar@foo', 'baz', 'bar@foo', 'baz')
+
+
+class TestCreateDefaultUserData(unittest.TestCase):
+    @mock.patch('uvtool.libvirt.kvm.get_ssh_authorized_keys')
+    @mock.patch('uvtool.ssh.generate_ssh_host_keys')
+    def testGivenHostKeysAreUsed(self, generate_ssh_host_keys,
+            get_ssh_authorized_keys):
+        get_ssh_authorized_keys.return_value = []
+        args = mock.Mock(
+            hostname='foo', password=None, run_script_once=None,
+            packages=None
+        )
+        fobj = mock.Mock()
+        create_default_user_data(
+            fobj, args, ssh_host_keys={b'rsa_private': b'key'})
+        self.assertFalse(generate_ssh_host_keys.called)
+        self.assertIn(b'rsa_private', fobj.write.call_args[0][0])
+
+
+class TestBatchCreate(unittest.TestCase):
+    def testHostnames(self):
+        self.assertEqual(batch_hostnames('foo'), ['foo'])
+        self.assertEqual(batch_hostnames('foo,bar'), ['foo', 'bar'])
+        self.assertEqual(
+            batch_hostnames('node', 3), ['node-1', 'node-2', 'node-3'])
+        self.assertEqual(
+            batch_hostnames('node', 2, '{name}{index:02d}'),
+            ['node01', 'node02']
+        )
+        self.assertRaises(CLIError, batch_hostnames, 'foo,foo')
+        self.assertRaises(CLIError, batch_hostnames, 'foo,')
+
+    @mock.patch('uvtool.libvirt.kvm._fill_key_pool_in_background')
+    @mock.patch('uvtool.ssh.default_key_pool')
+    @mock.patch('uvtool.libvirt.kvm.create')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image')
+    @mock.patch('uvtool.libvirt.kvm.check_kvm_ok')
+    @mock.patch('uvtool.libvirt.get_connection')
+    def testOnlyFailuresAreReported(self, get_connection, check_kvm_ok,
+            get_base_image, create, default_key_pool,
+            fill_key_pool_in_background):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        template = os.path.join(tmpdir, 'template.xml')
+        user_data = os.path.join(tmpdir, 'user-data')
+        with open(template, 'w') as f:
+            f.write('<domain/>')
+        with open(user_data, 'w') as f:
+            f.write('#cloud-config\n')
+        check_kvm_ok.return_value = (True, '')
+        get_base_image.return_value = ('vol', '/pool/vol')
+        default_key_pool.return_value.take.return_value = ({}, b'')
+        user_datas = []
+
+        def fake_create(hostname, filters, user_data_fobj, meta_data_fobj,
+                **kwargs):
+            user_datas.append(user_data_fobj.read())
+            if hostname == 'node-2':
+                raise RuntimeError("no space")
+        create.side_effect = fake_create
+
+        with mock.patch('sys.stderr'):
+            self.assertRaises(
+                CLIError, uvtool.libvirt.kvm.main, [
+                    'create', '--count', '3', '--template', template,
+                    '--user-data', user_data, 'node', 'release=trusty',
+                ]
+            )
+        self.assertEqual(get_base_image.call_count, 1)
+        self.assertEqual(
+            sorted(call[0][0] for call in create.call_args_list),
+            ['node-1', 'node-2', 'node-3']
+        )
+        for call in create.call_args_list:
+            self.assertEqual(call[1]['base_image'], ('vol', '/pool/vol'))
+            self.assertIs(call[1]['conn'], get_connection.return_value)
+        self.assertEqual(user_datas, [b'#cloud-config\n'] * 3)
+        fill_key_pool_in_background.assert_called_once_with()
+
+    @mock.patch('uvtool.libvirt.kvm._fill_key_pool_in_background')
+    @mock.patch('uvtool.ssh.default_key_pool')
+    @mock.patch('uvtool.libvirt.kvm.get_ssh_authorized_keys')
+    @mock.patch('uvtool.libvirt.kvm.create')
+    @mock.patch('uvtool.libvirt.kvm.get_base_image')
+    @mock.patch('uvtool.libvirt.kvm.check_kvm_ok')
+    @mock.patch('uvtool.libvirt.get_connection')
+    def testBatchSharesKeysAndWarnings(self, get_connection, check_kvm_ok,
+            get_base_image, create, get_ssh_authorized_keys,
+            default_key_pool, fill_key_pool_in_background):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        template = os.path.join(tmpdir, 'template.xml')
+        meta_data = os.path.join(tmpdir, 'meta-data')
+        with open(template, 'w') as f:
+            f.write('<domain/>')
+        with open(meta_data, 'wb') as f:
+            f.write(b'\x1f\x8b\x08\0')
+        check_kvm_ok.return_value = (True, '')
+        get_base_image.return_value = ('vol', '/pool/vol')
+        get_ssh_authorized_keys.return_value = ['ssh-rsa key']
+        default_key_pool.return_value.take.return_value = ({}, b'')
+        user_datas = []
+        create.side_effect = (
+            lambda hostname, filters, user_data_fobj, meta_data_fobj,
+                **kwargs: user_datas.append(user_data_fobj.read()))
+
+        with mock.patch('sys.stderr') as stderr:
+            uvtool.libvirt.kvm.main([
+                'create', '--count', '3', '--template', template,
+                '--meta-data', meta_data, '--datasource', 'firmware',
+                'node', 'release=trusty',
+            ])
+        self.assertEqual(get_ssh_authorized_keys.call_count, 1)
+        for user_data in user_datas:
+            self.assertIn(b'ssh-rsa key', user_data)
+        warnings = [
+            call for call in stderr.write.call_args_list
+            if 'not text' in call[0][0]
+        ]
+        self.assertEqual(len(warnings), 1)
+        self.assertEqual(
+            [call[1]['datasource'] for call in create.call_args_list],
+            ['volume'] * 3
+        )
+
+
+TEMPLATE = b"""<domain>
+  <os><type>hvm</type></os>
+  <metadata>%s</metadata>
+  <devices/>
+</domain>"""
+FIRMWARE_METADATA = (
+    b'<uvt:datasource xmlns:uvt="https://launchpad.net/uvtool/libvirt/1">' +
+    b'firmware</uvt:datasource>'
+)
+
+
+def fake_volume(path):
+    return mock.Mock(**{
+        'path.return_value': path,
+        'name.return_value': os.path.basename(path),
+    })
+
+
+class TestDomainTemplate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'template.xml')
+        self.write_template(b"""<domain type='kvm'>
+  <name>template</name>
+  <memory>1</memory>
+  <os><type>hvm</type><smbios mode='host'/></os>
+  <devices>
+    <disk type='file'/>
+    <interface type='network'><source network='default'/></interface>
+    <serial type='pty'><target port='0'/></serial>
+    <video/>
+  </devices>
+</domain>""")
+
+    def write_template(self, xml, mtime=0):
+        with open(self.path, 'wb') as f:
+            f.write(xml)
+        os.utime(self.path, (mtime, mtime))
+
+    def compose(self, **kwargs):
+        return etree.fromstring(compose_domain_xml(
+            'foo', [('/pool/foo.qcow', 'qcow2')], template_path=self.path,
+            **kwargs))
+
+    def testRender(self):
+        domain = self.compose(memory=256, ssh_known_hosts='known')
+        self.assertEqual(domain.get('type'), 'kvm')
+        self.assertEqual(domain.xpath('name/text()'), ['foo'])
+        self.assertEqual(domain.xpath('memory/text()'), ['262144'])
+        self.assertEqual(domain.xpath('os/smbios/@mode'), ['host'])
+        self.assertEqual(
+            domain.xpath('devices/disk/source/@file'), ['/pool/foo.qcow'])
+        self.assertEqual(
+            domain.xpath('devices/interface/source/@network'), ['default'])
+        self.assertEqual(domain.xpath('devices/serial/@type'), ['pty'])
+        self.assertEqual(len(domain.findall('devices/video')), 1)
+        self.assertEqual(
+            domain.xpath(
+                'metadata/uvt:ssh_known_hosts/text()',
+                namespaces={'uvt': uvtool.libvirt.LIBVIRT_METADATA_XMLNS}
+            ),
+            ['known']
+        )
+        # No slot is left behind
+        self.assertNotIn(b'uvt-slot', etree.tostring(domain))
+
+    def testOptionsReplaceTemplateElements(self):
+        with mock.patch('sys.stderr'):
+            domain = self.compose(bridge='br0', log_console_output=True)
+        self.assertEqual(
+            domain.xpath('devices/interface/source/@bridge'), ['br0'])
+        self.assertEqual(domain.xpath('devices/serial/@type'), ['stdio'])
+
+    def testCached(self):
+        with mock.patch('uvtool.libvirt.kvm.DomainTemplate') as template:
+            uvtool.libvirt.kvm.load_template(self.path)
+            uvtool.libvirt.kvm.load_template(self.path)
+            self.assertEqual(template.call_count, 1)
+
+    def testReloadedWhenChanged(self):
+        self.compose()
+        self.write_template(b"<domain type='qemu'/>", mtime=1)
+        self.assertEqual(self.compose().get('type'), 'qemu')
+
+    def testInvalid(self):
+        self.write_template(b'<network/>')
+        self.assertRaises(CLIError, self.compose)
+
+    def testEmptyDatasource(self):
+        self.write_template(
+            b"<domain><os/><devices/><metadata>"
+            b"<uvt:datasource xmlns:uvt='%s'/>"
+            b"</metadata></domain>" %
+            uvtool.libvirt.LIBVIRT_METADATA_XMLNS.encode('ascii'))
+        with self.assertRaisesRegexp(CLIError, 'unknown datasource'):
+            self.compose()
+
+
+# Where the guest kernel shows fw_cfg entries
+FW_CFG_SYSFS_DIR = '/sys/firmware/qemu_fw_cfg/by_name/'
+
+
+def resolve_nocloud_seed(serial, name):
+    """Return the path that cloud-init's NoCloud datasource reads the seed
+    file name from, given the SMBIOS serial number of a domain."""
+    fields = serial.split(';')
+    assert fields[0] == 'ds=nocloud', serial
+    url = dict(field.split('=', 1) for field in fields[1:])['s']
+    # As cloudinit.util.read_seeded() does
+    if '%s' in url:
+        url = url.replace('%s', name)
+    else:
+        url += name
+    assert url.startswith('file://'), url
+    return url[len('file://'):]
+
+
+@mock.patch('uvtool.libvirt.kvm._update_pool_references')
+@mock.patch('uvtool.libvirt.kvm.create_ds_volume')
+@mock.patch('uvtool.libvirt.kvm.create_cow_volume_by_path')
+class TestDatasource(unittest.TestCase):
+    def create(self, template_metadata=b'', user_data=b'#cloud-config\n',
+            **kwargs):
+        """Create a VM and return the domain XML defined."""
+        conn = mock.Mock()
+        create(
+            'foo', [], io.BytesIO(user_data), io.BytesIO(b'instance-id: i\n'),
+            conn=conn, base_image=('base', '/pool/base'),
+            template=DomainTemplate(etree.ElementTree(
+                etree.fromstring(TEMPLATE % template_metadata))),
+            **kwargs
+        )
+        return etree.fromstring(conn.defineXML.call_args[0][0])
+
+    def testVolumeByDefault(self, create_cow_volume_by_path,
+            create_ds_volume, update_pool_references):
+        create_cow_volume_by_path.return_value = fake_volume('/pool/foo.qcow')
+        create_ds_volume.return_value = fake_volume('/pool/foo-ds.qcow')
+        domain = self.create()
+        self.assertEqual(
+            domain.xpath('devices/disk/source/@file'),
+            ['/pool/foo.qcow', '/pool/foo-ds.qcow']
+        )
+        self.assertEqual(
+            domain.xpath('devices/disk/driver/@type'), ['qcow2', 'raw'])
+        self.assertEqual(domain.findall('sysinfo'), [])
+
+    def testFirmwareFromTemplate(self, create_cow_volume_by_path,
+            create_ds_volume, update_pool_references):
+        create_cow_volume_by_path.return_value = fake_volume('/pool/foo.qcow')
+        domain = self.create(FIRMWARE_METADATA)
+        self.assertFalse(create_ds_volume.called)
+        self.assertEqual(
+            domain.xpath('devices/disk/source/@file'), ['/pool/foo.qcow'])
+        self.assertEqual(domain.xpath('os/smbios/@mode'), ['sysinfo'])
+        serial, = domain.xpath(
+            'sysinfo[@type="smbios"]/system/entry[@name="serial"]/text()')
+        entries = dict(
+            (entry.get('name'), entry.text)
+            for entry in domain.xpath('sysinfo[@type="fwcfg"]/entry')
+        )
+        # Each file that cloud-init reads is the data of an entry
+        for name, data in [
+                ('user-data', '#cloud-config\n'),
+                ('meta-data', 'instance-id: i\n')]:
+            path = resolve_nocloud_seed(serial, name)
+            self.assertTrue(path.startswith(FW_CFG_SYSFS_DIR), path)
+            self.assertTrue(path.endswith('/raw'), path)
+            self.assertEqual(
+                entries.get(path[len(FW_CFG_SYSFS_DIR):-len('/raw')]), data)
+        # The choice is not passed on to libvirt
+        self.assertEqual(domain.find('metadata').getchildren(), [])
+
+    def testFlagOverridesTemplate(self, create_cow_volume_by_path,
+            create_ds_volume, update_pool_references):
+        create_cow_volume_by_path.return_value = fake_volume('/pool/foo.qcow')
+        create_ds_volume.return_value = fake_volume('/pool/foo-ds.qcow')
+        domain = self.create(FIRMWARE_METADATA, datasource='volume')
+        self.assertTrue(create_ds_volume.called)
+        self.assertEqual(domain.findall('sysinfo'), [])
+
+    def testBinaryDataUsesVolume(self, create_cow_volume_by_path,
+            create_ds_volume, update_pool_references):
+        create_cow_volume_by_path.return_value = fake_volume('/pool/foo.qcow')
+        create_ds_volume.return_value = fake_volume('/pool/foo-ds.qcow')
+        with mock.patch('sys.stderr'):
+            domain = self.create(
+                user_data=b'\x1f\x8b\x08\0', datasource='firmware')
+        self.assertEqual(
+            create_ds_volume.call_args[0][2].read(), b'\x1f\x8b\x08\0')
+        self.assertEqual(domain.findall('sysinfo'), [])
+
+
+@mock.patch('uvtool.libvirt.kvm._update_pool_references')
+@mock.patch('uvtool.libvirt.kvm.delete_domain_volumes')
+@mock.patch('uvtool.libvirt.kvm._queue_domain_volumes')
+class TestDestroy(unittest.TestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.domain = self.conn.lookupByName.return_value
+        self.domain.state.return_value = [
+            uvtool.libvirt.kvm.libvirt.VIR_DOMAIN_SHUTOFF]
+
+    def testNoWait(self, queue_domain_volumes, delete_domain_volumes,
+            update_pool_references):
+        order = []
+        queue_domain_volumes.side_effect = (
+            lambda *args: order.append('queue') or True)
+        self.domain.undefine.side_effect = lambda: order.append('undefine')
+        self.assertTrue(uvtool.libvirt.kvm.destroy(
+            'foo', conn=self.conn, reap_later=True))
+        self.assertFalse(delete_domain_volumes.called)
+        # The volumes must be queued before the domain is undefined
+        self.assertEqual(order, ['queue', 'undefine'])
+
+    def testNoWaitWithoutQueue(self, queue_domain_volumes,
+            delete_domain_volumes, update_pool_references):
+        queue_domain_volumes.return_value = False
+        self.assertFalse(uvtool.libvirt.kvm.destroy(
+            'foo', conn=self.conn, reap_later=True))
+        delete_domain_volumes.assert_called_once_with(
+            self.conn, self.domain, graph=None)
+
+
+class TestGetBaseImage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'vol')
+        open(self.path, 'w').close()
+        self.store = uvtool.libvirt.store.MetadataStore(
+            os.path.join(self.tmpdir, 'metadata'))
+        patcher = mock.patch(
+            'uvtool.libvirt.simplestreams._pool_metadata', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('uvtool.libvirt.simplestreams.query')
+        self.query = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query.side_effect = lambda filters: iter(['vol'])
+        self.conn = mock.Mock()
+        self.pool = self.conn.storagePoolLookupByName.return_value
+        self.pool.storageVolLookupByName.return_value.path.return_value = (
+            self.path)
+
+    def testCached(self):
+        self.assertEqual(
+            get_base_image(['arch=amd64', 'release=trusty'], conn=self.conn),
+            ('vol', self.path)
+        )
+        self.query.reset_mock()
+        self.conn.reset_mock()
+        hits = uvtool.libvirt.counters['base_image_cache_hits']
+        self.assertEqual(
+            get_base_image(['release=trusty', 'arch=amd64'], conn=self.conn),
+            ('vol', self.path)
+        )
+        self.assertEqual(
+            uvtool.libvirt.counters['base_image_cache_hits'], hits + 1)
+        self.assertFalse(self.query.called)
+        # Only the volume is looked up
+        self.pool.storageVolLookupByName.assert_called_once_with('vol')
+
+    def testInvalidated(self):
+        get_base_image(['release=trusty'], conn=self.conn)
+        self.store['foo'] = {'release': 'trusty'}
+        self.query.reset_mock()
+        get_base_image(['release=trusty'], conn=self.conn)
+        self.assertTrue(self.query.called)
+        # A volume that has gone from the pool is not trusted either
+        self.pool.storageVolLookupByName.side_effect = [
+            uvtool.libvirt.kvm.libvirt.libvirtError("missing"), mock.DEFAULT]
+        self.query.reset_mock()
+        get_base_image(['release=trusty'], conn=self.conn)
+        self.assertTrue(self.query.called)
+
+
+class TestStartup(unittest.TestCase):
+    def testQuickSubcommandsImportLittle(self):
+        # Run in a fresh interpreter, since other tests import everything.
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, uvtool.libvirt.kvm; '
+            'print(" ".join(sorted(sys.modules)))'
+        ])
+        modules = output.split()
+        for module in [
+                'yaml', 'pyinotify', 'simplestreams', 'uuid', 'ctypes',
+                'libvirt', 'lxml', 'tempfile',
+                'uvtool.libvirt.simplestreams', 'uvtool.wait']:
+            self.assertNotIn(module, modules)
+
+    def testHelpDoesNotImportLibvirt(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, uvtool.libvirt.kvm\n'
+            'try:\n'
+            '    uvtool.libvirt.kvm.main_cli_wrapper(["ip", "--help"])\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'sys.stderr.write(" ".join(sorted(sys.modules)))\n'
+        ], stderr=subprocess.STDOUT)
+        modules = output.split()
+        self.assertNotIn('libvirt', modules)
+        self.assertNotIn('lxml', modules)
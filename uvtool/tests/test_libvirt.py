@@ -0,0 +1,487 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import uvtool.libvirt
+
+
+class TestBoundedReader(unittest.TestCase):
+    def testReadsEverythingInOrder(self):
+        data = bytes(bytearray(i % 256 for i in range(10000)))
+        reader = uvtool.libvirt._BoundedReader(
+            io.BytesIO(data), block_size=7, queue_depth=2)
+        result = []
+        buffers = set()
+        for buf, length in reader.blocks():
+            result.append(bytes(buf[:length]))
+            buffers.add(id(buf))
+        reader.close()
+        self.assertEqual(b''.join(result), data)
+        self.assertLessEqual(len(buffers), 2)
+
+    def testSourceErrorIsRaised(self):
+        fobj = mock.Mock(spec=['read'])
+        fobj.read.side_effect = IOError('broken')
+        reader = uvtool.libvirt._BoundedReader(fobj)
+        self.assertRaises(IOError, list, reader.blocks())
+        reader.close()
+
+
+class TestOpenReader(unittest.TestCase):
+    def testInMemoryIsReadDirectly(self):
+        reader = uvtool.libvirt._open_reader(io.BytesIO(b'data'), 1024 * 1024)
+        self.assertIsInstance(reader, uvtool.libvirt._DirectReader)
+        self.assertEqual(
+            [bytes(buf[:length]) for buf, length in reader.blocks()],
+            [b'data']
+        )
+
+    def testSmallIsReadDirectly(self):
+        fobj = mock.Mock(spec=['read'])
+        fobj.read.side_effect = [b'data', b'']
+        reader = uvtool.libvirt._open_reader(fobj, 1024 * 1024, size=4)
+        self.assertIsInstance(reader, uvtool.libvirt._DirectReader)
+        self.assertEqual(
+            [bytes(buf[:length]) for buf, length in reader.blocks()],
+            [b'data']
+        )
+        # No more buffer than the data is allocated
+        fobj.read.assert_any_call(4)
+
+    def testBuffersAreBoundedBySize(self):
+        fobj = mock.Mock(spec=['read'])
+        with mock.patch('uvtool.libvirt._BoundedReader') as bounded_reader:
+            uvtool.libvirt._open_reader(fobj, 8, size=20)
+            uvtool.libvirt._open_reader(fobj, 8)
+        self.assertEqual(bounded_reader.call_args_list, [
+            mock.call(fobj, block_size=8, queue_depth=3),
+            mock.call(
+                fobj, block_size=8,
+                queue_depth=uvtool.libvirt.STREAM_QUEUE_DEPTH
+            ),
+        ])
+
+
+class TestFobjSize(unittest.TestCase):
+    def testRegularFile(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'0123456789')
+            f.seek(4)
+            self.assertEqual(uvtool.libvirt._fobj_size(f), 6)
+
+    def testSeekable(self):
+        f = io.BytesIO(b'0123456789')
+        f.seek(1)
+        self.assertEqual(uvtool.libvirt._fobj_size(f), 9)
+        self.assertEqual(f.tell(), 1)
+
+    def testUnknown(self):
+        self.assertIsNone(uvtool.libvirt._fobj_size(mock.Mock(spec=['read'])))
+
+
+@mock.patch('uvtool.libvirt.libvirt')
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        uvtool.libvirt.counters.clear()
+
+    def testConnectionIsShared(self, libvirt):
+        session = uvtool.libvirt.Session()
+        conn = session.get_connection()
+        self.assertIs(session.get_connection(), conn)
+        libvirt.open.assert_called_once_with('qemu:///system')
+        self.assertEqual(uvtool.libvirt.counters['connections'], 1)
+        self.assertEqual(uvtool.libvirt.counters['connection_reuses'], 1)
+        session.close()
+        conn.close.assert_called_once_with()
+
+    def testDeadConnectionIsReplaced(self, libvirt):
+        libvirt.open.side_effect = [mock.Mock(), mock.Mock()]
+        session = uvtool.libvirt.Session()
+        conn = session.get_connection()
+        conn.isAlive.return_value = False
+        self.assertIsNot(session.get_connection(), conn)
+        self.assertEqual(uvtool.libvirt.counters['connections'], 2)
+
+    @mock.patch('uvtool.libvirt._start_event_loop')
+    def testKeepAlive(self, start_event_loop, libvirt):
+        session = uvtool.libvirt.Session(keepalive=True)
+        conn = session.get_connection()
+        start_event_loop.assert_called_once_with()
+        conn.setKeepAlive.assert_called_once_with(
+            uvtool.libvirt.KEEPALIVE_INTERVAL, uvtool.libvirt.KEEPALIVE_COUNT)
+
+
+@mock.patch('uvtool.libvirt.libvirt')
+class TestCreateVolumeFromFobj(unittest.TestCase):
+    def setUp(self):
+        # Don't reuse a connection from another test's mock libvirt
+        uvtool.libvirt.session.close()
+        self.addCleanup(uvtool.libvirt.session.close)
+
+    def testQcow2IsConvertedFromStagingVolume(self, libvirt):
+        libvirt.open.return_value.newStream.return_value.send.side_effect = len
+        pool = libvirt.open.return_value.storagePoolLookupByName.return_value
+        staging_vol = pool.createXML.return_value
+        result = uvtool.libvirt.create_volume_from_fobj(
+            'foo', io.BytesIO(b'data'), image_type='qcow2')
+        self.assertIn(b'foo.partial', pool.createXML.call_args[0][0])
+        self.assertIn(b'<name>foo</name>', pool.createXMLFrom.call_args[0][0])
+        self.assertIs(pool.createXMLFrom.call_args[0][1], staging_vol)
+        self.assertIs(result, pool.createXMLFrom.return_value)
+        staging_vol.delete.assert_called_once_with(flags=0)
+
+    @mock.patch('uvtool.libvirt.subprocess.check_call')
+    def testQcow2LocalFileIsConvertedDirectly(self, check_call, libvirt):
+        conn = libvirt.open.return_value
+        conn.getURI.return_value = 'qemu:///system'
+        pool = conn.storagePoolLookupByName.return_value
+        pool.XMLDesc.return_value = "<pool type='dir'/>"
+        vol = pool.createXML.return_value
+        dst = tempfile.NamedTemporaryFile()
+        self.addCleanup(dst.close)
+        vol.path.return_value = dst.name
+        src = tempfile.TemporaryFile()
+        self.addCleanup(src.close)
+        src.write(b'image')
+        src.seek(0)
+        stats = uvtool.libvirt.UploadStats()
+        result = uvtool.libvirt.create_volume_from_fobj(
+            'foo', src, image_type='qcow2', stats=stats)
+        self.assertIs(result, vol)
+        self.assertIn(b'<name>foo</name>', pool.createXML.call_args[0][0])
+        self.assertEqual(check_call.call_args[0][0][-2:], [
+            '/dev/fd/%d' % src.fileno(), dst.name])
+        self.assertFalse(pool.createXMLFrom.called)
+        self.assertFalse(vol.delete.called)
+        pool.refresh.assert_called_once_with(0)
+        self.assertEqual(stats.method, 'qemu-img convert')
+        self.assertEqual(stats.bytes_sent, 5)
+
+    def testRawIsUploadedDirectly(self, libvirt):
+        libvirt.open.return_value.newStream.return_value.send.side_effect = len
+        pool = libvirt.open.return_value.storagePoolLookupByName.return_value
+        vol = pool.createXML.return_value
+        result = uvtool.libvirt.create_volume_from_fobj(
+            'foo', io.BytesIO(b'data'))
+        self.assertIs(result, vol)
+        self.assertIn(b'<capacity>4</capacity>', pool.createXML.call_args[0][0])
+        vol.upload.assert_called_once_with(
+            libvirt.open.return_value.newStream.return_value, 0, 4,
+            libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM
+        )
+        self.assertFalse(pool.createXMLFrom.called)
+
+    def testSparseFallback(self, libvirt):
+        class FakeLibvirtError(Exception):
+            def get_error_code(self):
+                return libvirt.VIR_ERR_INVALID_ARG
+        libvirt.libvirtError = FakeLibvirtError
+        pool = libvirt.open.return_value.storagePoolLookupByName.return_value
+        vol = pool.createXML.return_value
+        stream = libvirt.open.return_value.newStream.return_value
+        vol.upload.side_effect = [FakeLibvirtError(), None]
+        stream.send.side_effect = len
+        stats = uvtool.libvirt.UploadStats()
+        uvtool.libvirt.create_volume_from_fobj(
+            'foo', io.BytesIO(b'data'), stats=stats)
+        vol.upload.assert_called_with(stream, 0, 4, 0)
+        self.assertFalse(stats.sparse)
+        self.assertEqual(stats.bytes_sent, 4)
+        self.assertFalse(vol.delete.called)
+
+
+class TestFillLocalVolume(unittest.TestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.conn.getURI.return_value = 'qemu:///system'
+        self.pool = mock.Mock()
+        self.pool.XMLDesc.return_value = "<pool type='dir'/>"
+        self.dst = tempfile.NamedTemporaryFile()
+        self.vol = mock.Mock()
+        self.vol.path.return_value = self.dst.name
+        self.src = tempfile.TemporaryFile()
+        self.src.write(b'a')
+        self.src.seek(16 * 1024 * 1024)
+        self.src.write(b'b')
+        self.src.flush()
+        self.src.seek(0)
+        self.stats = uvtool.libvirt.UploadStats()
+
+    def tearDown(self):
+        self.src.close()
+        self.dst.close()
+
+    def fill(self, fobj=None):
+        return uvtool.libvirt._fill_local_volume(
+            self.conn, self.pool, self.vol, fobj or self.src, True,
+            self.stats
+        )
+
+    def assertCopied(self):
+        with open(self.dst.name, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data, b'a' + b'\0' * (16 * 1024 * 1024 - 1) + b'b')
+        self.pool.refresh.assert_called_once_with(0)
+
+    def testCopy(self):
+        self.assertTrue(self.fill())
+        self.assertCopied()
+        self.assertIn(
+            self.stats.method, ['reflink', 'copy_file_range', 'sendfile'])
+
+    @mock.patch('uvtool.libvirt.fcntl.ioctl')
+    @mock.patch('uvtool.libvirt._copy_file_range')
+    def testSendfileFallback(self, copy_file_range, ioctl):
+        ioctl.side_effect = IOError(errno.EOPNOTSUPP, 'not supported')
+        copy_file_range.side_effect = OSError(errno.EXDEV, 'cross device')
+        self.assertTrue(self.fill())
+        self.assertCopied()
+        self.assertEqual(self.stats.method, 'sendfile')
+
+    def testRemoteConnection(self):
+        self.conn.getURI.return_value = 'qemu+ssh://host/system'
+        self.assertFalse(self.fill())
+        self.assertFalse(self.pool.refresh.called)
+
+    def testNotDirPool(self):
+        self.pool.XMLDesc.return_value = "<pool type='logical'/>"
+        self.assertFalse(self.fill())
+
+    def testNotRegularFile(self):
+        self.assertFalse(self.fill(io.BytesIO(b'data')))
+
+
+class TestSendToStream(unittest.TestCase):
+    def send(self, fobj, sparse=True, block_size=8):
+        sent = []
+        stream = mock.Mock()
+
+        def send(data):
+            sent.append(bytes(data))
+            return len(data)
+
+        stream.send.side_effect = send
+        stream.sendHole.side_effect = (
+            lambda length, flags: sent.append(length))
+        stats = uvtool.libvirt.UploadStats()
+        uvtool.libvirt._send_to_stream(stream, fobj, sparse, stats, block_size)
+        return sent, stats
+
+    def testZeroScan(self):
+        data = b'a' * 3 + b'\0' * 8 + b'b'
+        with mock.patch('uvtool.libvirt.SPARSE_SCAN_BLOCK_SIZE', 4):
+            sent, stats = self.send(io.BytesIO(data))
+        self.assertEqual(sent, [b'aaa\0', 4, b'\0\0\0b'])
+        self.assertEqual(stats.bytes_sent, 8)
+        self.assertEqual(stats.bytes_skipped, 4)
+        self.assertEqual(stats.send_calls, 2)
+        self.assertEqual(stats.hole_calls, 1)
+
+    def testNotSparse(self):
+        data = b'a' * 3 + b'\0' * 8 + b'b'
+        sent, stats = self.send(io.BytesIO(data), sparse=False)
+        self.assertEqual(b''.join(sent), data)
+        self.assertEqual(stats.bytes_skipped, 0)
+
+    def testSeekHole(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'a')
+            f.seek(16 * 1024 * 1024)
+            f.write(b'b')
+            f.flush()
+            f.seek(0)
+            sent, stats = self.send(f, block_size=1024 * 1024)
+        # Hole detection granularity depends on the filesystem, but the
+        # data must come out the same either way.
+        data = b''.join(
+            s if isinstance(s, bytes) else b'\0' * s for s in sent)
+        self.assertEqual(data, b'a' + b'\0' * (16 * 1024 * 1024 - 1) + b'b')
+        self.assertEqual(
+            stats.bytes_sent + stats.bytes_skipped, 16 * 1024 * 1024 + 1)
+
+
+def _domain_xml(*paths):
+    return '<domain><devices>%s</devices></domain>' % ''.join(
+        "<disk type='file'><source file='%s'/></disk>" % path
+        for path in paths
+    )
+
+
+def _volume_xml(name, path, backing_path=None):
+    xml = '<volume><name>%s</name><target><path>%s</path></target>' % (
+        name, path)
+    if backing_path:
+        xml += '<backingStore><path>%s</path></backingStore>' % backing_path
+    return xml + '</volume>'
+
+
+@mock.patch('uvtool.libvirt.libvirt')
+class TestDomainVolumeGraph(unittest.TestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        running = mock.Mock()
+        running.name.return_value = 'running'
+        running.XMLDesc.return_value = _domain_xml('/p/running.qcow')
+        stopped = mock.Mock()
+        stopped.name.return_value = 'stopped'
+        stopped.XMLDesc.return_value = _domain_xml(
+            '/p/stopped.qcow', '/elsewhere/disk.img')
+        self.domains = [running, stopped]
+        self.conn.listAllDomains.side_effect = [[running], [stopped]]
+        pool = mock.Mock()
+        pool.name.return_value = 'uvtool'
+        self.volumes = []
+        for name, backing_path in [
+                ('running.qcow', '/p/base'),
+                ('stopped.qcow', '/p/middle'),
+                ('middle', '/p/base'),
+                ('base', None),
+                ('unused', None)]:
+            volume = mock.Mock()
+            volume.XMLDesc.return_value = _volume_xml(
+                name, '/p/' + name, backing_path)
+            self.volumes.append(volume)
+        pool.listAllVolumes.return_value = self.volumes
+        self.conn.listAllStoragePools.return_value = [pool]
+
+    def testVolumeNamesInUse(self, libvirt):
+        graph = uvtool.libvirt.DomainVolumeGraph(self.conn)
+        self.assertEqual(
+            sorted(uvtool.libvirt.get_all_domain_volume_names(graph=graph)),
+            ['base', 'middle', 'running.qcow', 'stopped.qcow']
+        )
+        self.assertEqual(graph.domains_using('/p/base'), ['running', 'stopped'])
+        self.assertEqual(graph.domains_using('/p/middle'), ['stopped'])
+        # Everything comes from the listings and one description of each
+        # object; nothing is looked up individually.
+        self.assertEqual(self.domains[0].XMLDesc.call_count, 2)
+        self.assertEqual(self.domains[1].XMLDesc.call_count, 1)
+        for volume in self.volumes:
+            self.assertEqual(volume.XMLDesc.call_count, 1)
+        self.assertFalse(self.conn.storageVolLookupByKey.called)
+        self.assertFalse(self.conn.lookupByName.called)
+
+    def testFallbackWithoutListAll(self, libvirt):
+        conn = mock.Mock(spec=[
+            'listDomainsID', 'listDefinedDomains', 'lookupByID',
+            'lookupByName', 'listStoragePools', 'storagePoolLookupByName',
+        ])
+        conn.listDomainsID.return_value = [1]
+        conn.lookupByID.return_value = self.domains[0]
+        conn.listDefinedDomains.return_value = ['stopped']
+        conn.lookupByName.return_value = self.domains[1]
+        pool = mock.Mock(spec=['name', 'listVolumes', 'storageVolLookupByName'])
+        pool.name.return_value = 'uvtool'
+        pool.listVolumes.return_value = ['running.qcow', 'base']
+        pool.storageVolLookupByName.side_effect = [
+            self.volumes[0], self.volumes[3]]
+        conn.listStoragePools.return_value = ['uvtool']
+        conn.storagePoolLookupByName.return_value = pool
+        graph = uvtool.libvirt.DomainVolumeGraph(conn)
+        self.assertEqual(graph.domain_names(), ['running', 'stopped'])
+        self.assertEqual(
+            graph.domain_dependency_paths('running'),
+            frozenset(['/p/running.qcow', '/p/base'])
+        )
+
+    def testLookupWithoutBulk(self, libvirt):
+        volumes = dict(
+            ('/p/' + name, volume) for name, volume in
+            zip(['running.qcow', 'base'], [self.volumes[0], self.volumes[3]])
+        )
+        self.conn.storageVolLookupByKey.side_effect = volumes.get
+        graph = uvtool.libvirt.DomainVolumeGraph(self.conn, bulk=False)
+        self.assertEqual(
+            graph.domain_dependency_paths('running'),
+            frozenset(['/p/running.qcow', '/p/base'])
+        )
+        self.assertFalse(self.conn.listAllStoragePools.called)
+
+
+class TestLeaseIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'default.leases')
+        self.index = uvtool.libvirt.LeaseIndex(self.path)
+        patcher = mock.patch.dict(uvtool.libvirt.counters, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_leases(self, text, path=None):
+        with open(path or self.path, 'w') as f:
+            f.write(text)
+
+    def testLookup(self):
+        self.write_leases(
+            '1000 52:54:00:aa:bb:cc 192.168.122.10 foo *\n'
+            '0 52:54:00:dd:ee:ff 192.168.122.11 bar *\n'
+        )
+        self.assertEqual(
+            self.index.lookup('52:54:00:AA:BB:CC', now=500), '192.168.122.10')
+        self.assertEqual(
+            self.index.lookup('52:54:00:dd:ee:ff', now=500), '192.168.122.11')
+        self.assertIsNone(self.index.lookup('52:54:00:00:00:00', now=500))
+
+    def testExpired(self):
+        self.write_leases('1000 52:54:00:aa:bb:cc 192.168.122.10 foo *\n')
+        self.assertIsNone(self.index.lookup('52:54:00:aa:bb:cc', now=1000))
+        # Infinite leases never expire
+        self.write_leases('0 52:54:00:aa:bb:cc 192.168.122.10 foo *\n')
+        self.assertEqual(
+            self.index.lookup('52:54:00:aa:bb:cc', now=1000),
+            '192.168.122.10'
+        )
+
+    def testParsedOnlyWhenChanged(self):
+        self.write_leases('0 52:54:00:aa:bb:cc 192.168.122.10 foo *\n')
+        for _ in range(3):
+            self.index.lookup('52:54:00:aa:bb:cc')
+        self.assertEqual(uvtool.libvirt.counters['lease_file_parses'], 1)
+        with open(self.path, 'a') as f:
+            f.write('0 52:54:00:dd:ee:ff 192.168.122.11 bar *\n')
+        self.assertEqual(
+            self.index.lookup('52:54:00:dd:ee:ff'), '192.168.122.11')
+        self.assertEqual(uvtool.libvirt.counters['lease_file_parses'], 2)
+
+    def testReplaced(self):
+        self.write_leases('0 52:54:00:aa:bb:cc 192.168.122.10 foo *\n')
+        self.index.lookup('52:54:00:aa:bb:cc')
+        # The same size and mtime, but a new file
+        new_path = self.path + '.new'
+        self.write_leases(
+            '0 52:54:00:aa:bb:cc 192.168.122.20 foo *\n', path=new_path)
+        st = os.stat(self.path)
+        os.utime(new_path, (st.st_atime, st.st_mtime))
+        os.rename(new_path, self.path)
+        self.assertEqual(
+            self.index.lookup('52:54:00:aa:bb:cc'), '192.168.122.20')
+
+    def testMissing(self):
+        self.assertIsNone(self.index.lookup('52:54:00:aa:bb:cc'))
+        self.write_leases('0 52:54:00:aa:bb:cc 192.168.122.10 foo *\n')
+        self.assertEqual(
+            self.index.lookup('52:54:00:aa:bb:cc'), '192.168.122.10')
+        os.unlink(self.path)
+        self.assertIsNone(self.index.lookup('52:54:00:aa:bb:cc'))
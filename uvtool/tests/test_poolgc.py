@@ -0,0 +1,200 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import libvirt
+import mock
+
+import uvtool.libvirt.poolgc
+from uvtool.libvirt import poolgc
+
+POOL_DIR = '/pool/'
+
+
+class FakeGraph(object):
+    """Domains, each using its own volume backed by a base image."""
+    def __init__(self, domains):
+        self.domains = domains
+
+    def domain_names(self):
+        return list(self.domains)
+
+    def domain_uuid(self, name):
+        return name + '-uuid'
+
+    def domain_disk_paths(self, name):
+        return frozenset([POOL_DIR + name + '.qcow'])
+
+    def domain_dependency_paths(self, name):
+        return frozenset([
+            POOL_DIR + name + '.qcow', POOL_DIR + self.domains[name]])
+
+    def volume_paths_in_use(self):
+        return frozenset().union(*(
+            self.domain_dependency_paths(name) for name in self.domains))
+
+    def volume(self, path):
+        node = mock.Mock(path=path)
+        node.name = os.path.basename(path)
+        return node
+
+
+@mock.patch('uvtool.libvirt.poolgc.uvtool.libvirt')
+class TestPoolGarbageCollector(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.gc = uvtool.libvirt.poolgc.PoolGarbageCollector(self.tmpdir)
+        self.sizes = {
+            'foo.qcow': 1, 'bar.qcow': 1, 'base0': 100, 'base1': 200}
+
+    def collect(self, uvtool_libvirt, domains, **kwargs):
+        uvtool_libvirt.DomainVolumeGraph.return_value = FakeGraph(domains)
+        uvtool_libvirt.volume_names_in_pool.return_value = list(self.sizes)
+        uvtool_libvirt.volume_allocation.side_effect = (
+            lambda name, **kwargs: self.sizes.get(name))
+        uvtool_libvirt.delete_volume_by_name.reset_mock()
+        uvtool_libvirt.delete_volume_by_name.side_effect = (
+            lambda name, **kwargs: self.sizes.pop(name))
+        uvtool_libvirt.volume_allocation.reset_mock()
+        uvtool_libvirt.volume_names_in_pool.reset_mock()
+        return self.gc.collect(
+            frozenset(['base0']), 'uvtool', filter_by_dir=POOL_DIR, **kwargs)
+
+    def deleted(self, uvtool_libvirt):
+        return sorted(
+            call[0][0]
+            for call in uvtool_libvirt.delete_volume_by_name.call_args_list
+        )
+
+    def testFirstCollectionIsFull(self, uvtool_libvirt):
+        report = self.collect(
+            uvtool_libvirt, {'foo': 'base1'}, now=1000, dry_run=True)
+        self.assertEqual(report.collected, [('bar.qcow', 1)])
+        self.assertEqual(report.reclaimable, 1)
+        self.assertEqual(self.deleted(uvtool_libvirt), [])
+        self.collect(uvtool_libvirt, {'foo': 'base1'}, now=1000)
+        self.assertEqual(self.deleted(uvtool_libvirt), ['bar.qcow'])
+
+    def testIncremental(self, uvtool_libvirt):
+        self.collect(uvtool_libvirt, {'foo': 'base1', 'bar': 'base1'})
+        del self.sizes['foo.qcow']
+        # foo is destroyed by uvt-kvm, and bar by something else
+        self.gc.remove_domain('foo-uuid')
+        self.collect(uvtool_libvirt, {})
+        self.assertEqual(
+            self.deleted(uvtool_libvirt), ['bar.qcow', 'base1'])
+        # Only what was released is looked at
+        self.assertEqual(
+            sorted(call[0][0] for call in
+                uvtool_libvirt.volume_allocation.call_args_list),
+            ['bar.qcow', 'base1', 'foo.qcow']
+        )
+        self.assertEqual(uvtool_libvirt.volume_names_in_pool.call_count, 1)
+        self.collect(uvtool_libvirt, {})
+        self.assertFalse(uvtool_libvirt.volume_allocation.called)
+
+    def testIncrementalSweepsUnreferencedVolumes(self, uvtool_libvirt):
+        self.collect(uvtool_libvirt, {'foo': 'base1', 'bar': 'base1'})
+        # Left behind by an interrupted sync
+        self.sizes['base2.partial'] = 1
+        self.sizes['base2'] = 300
+        self.collect(uvtool_libvirt, {'foo': 'base1', 'bar': 'base1'})
+        self.assertEqual(
+            self.deleted(uvtool_libvirt), ['base2', 'base2.partial'])
+
+    def testCandidatesDroppedTogether(self, uvtool_libvirt):
+        self.collect(uvtool_libvirt, {'foo': 'base1', 'bar': 'base1'})
+        self.gc.remove_domain('foo-uuid')
+        self.gc.remove_domain('bar-uuid')
+        with mock.patch.object(
+                poolgc, 'transaction',
+                side_effect=poolgc.transaction) as mock_transaction:
+            self.collect(uvtool_libvirt, {})
+        self.assertEqual(
+            self.deleted(uvtool_libvirt), ['bar.qcow', 'base1', 'foo.qcow'])
+        # One to add the sweep's candidates, and one to drop them all
+        self.assertEqual(mock_transaction.call_count, 2)
+
+    def testNewDomainIsScanned(self, uvtool_libvirt):
+        self.collect(uvtool_libvirt, {})
+        self.gc.release_image('base0')
+        self.collect(uvtool_libvirt, {'baz': 'base0'})
+        self.assertEqual(self.deleted(uvtool_libvirt), [])
+
+    def testRetention(self, uvtool_libvirt):
+        self.sizes = {'base0': 100, 'base1': 200, 'base2': 300}
+        self.collect(uvtool_libvirt, {}, now=1000, dry_run=True)
+        for volume, released in [('base1', 1000), ('base2', 2000)]:
+            self.gc.release_image(volume, now=released)
+        report = self.collect(
+            uvtool_libvirt, {}, now=2500, retain_size=350, dry_run=True)
+        self.assertEqual(report.retained, [('base2', 300)])
+        self.assertEqual(report.collected, [('base1', 200)])
+        report = self.collect(
+            uvtool_libvirt, {}, now=2500, retain_age=1000, dry_run=True)
+        self.assertEqual(report.retained, [('base2', 300)])
+        report = self.collect(
+            uvtool_libvirt, {}, now=2500, retain_size=1000, retain_age=2000)
+        self.assertEqual(len(report.retained), 2)
+        self.assertEqual(self.deleted(uvtool_libvirt), [])
+
+    def queued(self):
+        return [path for path, in self.gc._connect().execute(
+            'SELECT path FROM reap_queue').fetchall()]
+
+    def testReap(self, uvtool_libvirt):
+        self.gc.queue_reap([
+            POOL_DIR + 'foo.qcow', POOL_DIR + 'bar.qcow',
+            POOL_DIR + 'gone.qcow'
+        ])
+        # bar has not been undefined yet
+        uvtool_libvirt.DomainVolumeGraph.return_value = FakeGraph(
+            {'bar': 'base0'})
+        conn = mock.Mock()
+        volumes = {POOL_DIR + 'foo.qcow': mock.Mock()}
+
+        def lookup(path):
+            try:
+                return volumes[path]
+            except KeyError:
+                raise libvirt.libvirtError("missing")
+        conn.storageVolLookupByKey.side_effect = lookup
+        uvtool_libvirt._is_missing_error.return_value = True
+        self.assertEqual(self.gc.reap(conn), [POOL_DIR + 'foo.qcow'])
+        self.assertEqual(uvtool_libvirt.DomainVolumeGraph.call_count, 1)
+        volumes[POOL_DIR + 'foo.qcow'].delete.assert_called_once_with(0)
+        self.assertEqual(self.queued(), [POOL_DIR + 'bar.qcow'])
+        # Once bar is undefined, the next reap deletes its volume
+        uvtool_libvirt.DomainVolumeGraph.return_value = FakeGraph({})
+        volumes[POOL_DIR + 'bar.qcow'] = mock.Mock()
+        self.assertEqual(self.gc.reap(conn), [POOL_DIR + 'bar.qcow'])
+        volumes[POOL_DIR + 'bar.qcow'].delete.assert_called_once_with(0)
+        self.assertEqual(self.queued(), [])
+
+    def testReapFailureStaysQueued(self, uvtool_libvirt):
+        self.gc.queue_reap([POOL_DIR + 'foo.qcow'])
+        uvtool_libvirt.DomainVolumeGraph.return_value = FakeGraph({})
+        conn = mock.Mock()
+        conn.storageVolLookupByKey.return_value.delete.side_effect = (
+            libvirt.libvirtError("busy"))
+        uvtool_libvirt._is_missing_error.return_value = False
+        self.assertRaises(libvirt.libvirtError, self.gc.reap, conn)
+        self.assertEqual(self.queued(), [POOL_DIR + 'foo.qcow'])
@@ -14,10 +14,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 import mock
 
+import uvtool.download
+import uvtool.libvirt
+import uvtool.libvirt.poolgc
+import uvtool.libvirt.store
 import uvtool.libvirt.simplestreams as simplestreams
 
 # Some tests use more recent features of mock that are not available with mock
@@ -37,17 +48,77 @@ ENCODED_FAKE_VOLUME_PRODUCT_NAME_0 = simplestreams._encode_libvirt_pool_name(
     FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0)
 ENCODED_FAKE_VOLUME_PRODUCT_NAME_1 = simplestreams._encode_libvirt_pool_name(
     FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_1)
+FAKE_IMAGE_0_SHA256 = (
+    '520e579da0a29a08f73aaa018eed12b6778460ea446f442dedaa8a950674afda')
+FAKE_IMAGE_1_SHA256 = (
+    'cc4dea38d5e5db5e60a919c4957842141a264116bb848577a5c1a7db6ca3459c')
+FAKE_VOLUME_NAME_0 = 'x-uvt-sha256-' + FAKE_IMAGE_0_SHA256
+FAKE_VOLUME_NAME_1 = 'x-uvt-sha256-' + FAKE_IMAGE_1_SHA256
+
+
+def _patch_metadata_dir(test_case):
+    """Keep metadata in a temporary directory for the rest of a test."""
+    metadata_dir = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, metadata_dir)
+    for name, value in [
+            ('_pool_metadata',
+                uvtool.libvirt.store.MetadataStore(metadata_dir)),
+            ('_pool_gc',
+                uvtool.libvirt.poolgc.PoolGarbageCollector(metadata_dir))]:
+        patcher = mock.patch.object(simplestreams, name, value)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+
+
+def _mock_domains(uvtool_libvirt, domains):
+    """Make a mock uvtool.libvirt report domains, a dict of the volume names
+    used by each domain name. The first volume is the domain's own and the
+    rest are its backing stores."""
+    def paths(domain_name):
+        return [
+            simplestreams.IMAGE_DIR + volume_name
+            for volume_name in domains[domain_name]
+        ]
+
+    def volume(path):
+        node = mock.Mock(path=path)
+        node.name = os.path.basename(path)
+        return node
+
+    graph = uvtool_libvirt.DomainVolumeGraph.return_value
+    graph.domain_names.return_value = list(domains)
+    graph.domain_uuid.side_effect = lambda name: name + '-uuid'
+    graph.domain_disk_paths.side_effect = (
+        lambda name: frozenset(paths(name)[:1]))
+    graph.domain_dependency_paths.side_effect = (
+        lambda name: frozenset(paths(name)))
+    graph.volume.side_effect = volume
+
+
+def fake_create_volume_from_fobj(new_volume_name, fobj, **kwargs):
+    # Consume the data as the real upload would
+    fobj.read()
 
 @unittest.skipIf(ON_PRECISE, 'mock version is too old')
 @mock.patch('uvtool.libvirt.simplestreams.uvtool.libvirt')
-@mock.patch('uvtool.libvirt.simplestreams.pool_metadata', new={})
 @mock.patch('uvtool.libvirt.simplestreams.libvirt')
 class TestSimpleStreams(unittest.TestCase):
+    def setUp(self):
+        self.download_cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_cache_dir)
+        patcher = mock.patch.object(
+            simplestreams, 'DOWNLOAD_CACHE_DIR', self.download_cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _patch_metadata_dir(self)
+
     def testSync(self, libvirt, uvtool_libvirt):
         uvtool_libvirt.have_volume_by_name.return_value = False
-        uvtool_libvirt.get_all_domain_volume_names.return_value = []
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            fake_create_volume_from_fobj)
+        _mock_domains(uvtool_libvirt, {})
         uvtool_libvirt.volume_names_in_pool.return_value = [
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            FAKE_VOLUME_NAME_0]
         simplestreams.main(
             'sync '
             '--no-authentication '
@@ -57,18 +128,24 @@ class TestSimpleStreams(unittest.TestCase):
             .split()
         )
         # Check that we have mocked libvirt correctly, which means that
-        # this test is working. We expect libvirt.open to have been called at
-        # least once by uvtool.libvirt.simplestreams directly. This is more of
-        # an assertion about the test being correct than part of the test
-        # itself.
-        libvirt.assert_has_calls(mock.call.open(u'qemu:///system'))
+        # this test is working. We expect the shared libvirt connection to
+        # have been requested at least once by uvtool.libvirt.simplestreams
+        # directly. This is more of an assertion about the test being correct
+        # than part of the test itself.
+        self.assertTrue(uvtool_libvirt.get_connection.called)
 
         # create_volume_from_fobj should have been called exactly once to
         # create the volume with the name that we expect
         self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 1)
         self.assertEqual(
             uvtool_libvirt.create_volume_from_fobj.call_args[0][0],
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0
+            FAKE_VOLUME_NAME_0
+        )
+        # The image should have been verified as it was uploaded
+        self.assertEqual(
+            simplestreams.get_pool_metadata()[
+                ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]['verified_sha256'],
+            FAKE_IMAGE_0_SHA256
         )
         # Make sure the only calls to uvtool.libvirt were ones that we have
         # either whitelisted to be query-only (no side effects), or that we
@@ -77,27 +154,260 @@ class TestSimpleStreams(unittest.TestCase):
         for call in uvtool_libvirt.mock_calls:
             name = call[0]
             self.assertIn(name, [
-                # side effects that we have checked already
-                'get_all_domain_volume_names',
-
                 # whitelist of query functions that produce no side effects
+                'UploadStats',
+                'DomainVolumeGraph',
+                'DomainVolumeGraph().domain_dependency_paths',
+                'DomainVolumeGraph().domain_disk_paths',
+                'DomainVolumeGraph().domain_names',
+                'DomainVolumeGraph().domain_uuid',
+                'DomainVolumeGraph().volume',
                 'create_volume_from_fobj',
+                'get_connection',
                 'get_libvirt_pool_object',
                 'have_volume_by_name',
+                'session.close',
+                'volume_allocation',
                 'volume_names_in_pool',
             ])
 
+    def testSyncChecksumMismatch(self, libvirt, uvtool_libvirt):
+        simplestreams.get_pool_metadata().clear()
+        uvtool_libvirt.have_volume_by_name.return_value = False
+        # Simulate a truncated download
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            lambda new_volume_name, fobj, **kwargs: fobj.read(4))
+        self.assertRaises(
+            simplestreams.ChecksumError,
+            simplestreams.main,
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            '--no-download-cache '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        # The bad volume must be removed and never registered
+        uvtool_libvirt.delete_volume_by_name.assert_called_once_with(
+            FAKE_VOLUME_NAME_0,
+            pool_name=simplestreams.LIBVIRT_POOL_NAME
+        )
+        self.assertNotIn(
+            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0,
+            simplestreams.get_pool_metadata()
+        )
+
+    def _cache_path(self):
+        cache = uvtool.download.DownloadCache(self.download_cache_dir)
+        return cache.path(cache.key(
+            FAKE_VOLUME_PRODUCT_NAME, FAKE_VOLUME_VERSION_0, 'disk1.img',
+            FAKE_IMAGE_0_SHA256
+        ))
+
+    def testSyncChecksumMismatchInCache(self, libvirt, uvtool_libvirt):
+        simplestreams.get_pool_metadata().clear()
+        uvtool_libvirt.have_volume_by_name.return_value = False
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            fake_create_volume_from_fobj)
+        image_path = 'uvtool/tests/streams/fake_stream_0/fake_image_0'
+        # A corrupt download of the right length
+        with open(self._cache_path(), 'wb') as f:
+            f.write(b'x' * os.stat(image_path).st_size)
+        self.assertRaises(
+            simplestreams.ChecksumError,
+            simplestreams.main,
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        uvtool_libvirt.delete_volume_by_name.assert_called_once_with(
+            FAKE_VOLUME_NAME_0,
+            pool_name=simplestreams.LIBVIRT_POOL_NAME
+        )
+        self.assertNotIn(
+            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0,
+            simplestreams.get_pool_metadata()
+        )
+        # Nor should the bad download be kept
+        self.assertEqual(os.listdir(self.download_cache_dir), [])
+
+    def testSyncInterruptedImportIsResumable(self, libvirt, uvtool_libvirt):
+        simplestreams.get_pool_metadata().clear()
+        uvtool_libvirt.have_volume_by_name.return_value = False
+        image_path = 'uvtool/tests/streams/fake_stream_0/fake_image_0'
+        with open(image_path, 'rb') as f:
+            image = f.read()
+        cache_path = self._cache_path()
+        cached = []
+
+        def create_volume_from_fobj(new_volume_name, fobj, **kwargs):
+            # The download goes straight into the pool, and is written to
+            # the cache in the same pass.
+            fobj.read(5)
+            with open(cache_path, 'rb') as f:
+                cached.append(f.read())
+            raise RuntimeError("interrupted")
+
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            create_volume_from_fobj)
+        self.assertRaises(
+            RuntimeError,
+            simplestreams.main,
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        self.assertEqual(cached, [image[:5]])
+        # Kept for the next sync to resume from
+        with open(cache_path, 'rb') as f:
+            self.assertEqual(f.read(), image[:5])
+
+    def testSyncResumesPartialDownload(self, libvirt, uvtool_libvirt):
+        simplestreams.get_pool_metadata().clear()
+        uvtool_libvirt.have_volume_by_name.return_value = False
+        imported = []
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            lambda new_volume_name, fobj, **kwargs: imported.append(
+                fobj.read()))
+        _mock_domains(uvtool_libvirt, {})
+        uvtool_libvirt.volume_names_in_pool.return_value = []
+        image_path = 'uvtool/tests/streams/fake_stream_0/fake_image_0'
+        with open(image_path, 'rb') as f:
+            image = f.read()
+        cache_path = self._cache_path()
+        with open(cache_path, 'wb') as f:
+            f.write(image[:5])
+        simplestreams.main(
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        self.assertEqual(
+            simplestreams.get_pool_metadata()[
+                ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]['verified_sha256'],
+            FAKE_IMAGE_0_SHA256
+        )
+        self.assertEqual(imported, [image])
+        # Nothing is kept once the image has been imported
+        self.assertEqual(os.listdir(self.download_cache_dir), [])
+
+    def _testSyncSharesIdenticalImages(self, uvtool_libvirt, extra_args=''):
+        simplestreams.get_pool_metadata().clear()
+        created = []
+
+        def create_volume_from_fobj(new_volume_name, fobj, **kwargs):
+            fobj.read()
+            created.append(new_volume_name)
+
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            create_volume_from_fobj)
+        uvtool_libvirt.have_volume_by_name.side_effect = (
+            lambda name, **kwargs: name in created)
+        _mock_domains(uvtool_libvirt, {})
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_0]
+        simplestreams.main((
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_2 '
+            '--path streams/v1/index.json '
+            'release=precise arch=amd64 ' + extra_args
+        ).split())
+        # Both products refer to the one volume, uploaded once
+        self.assertEqual(created, [FAKE_VOLUME_NAME_0])
+        self.assertEqual(len(simplestreams.get_pool_metadata()), 2)
+        for metadata in simplestreams.get_pool_metadata().values():
+            self.assertEqual(metadata['libvirt_volume'], FAKE_VOLUME_NAME_0)
+            self.assertEqual(metadata['verified_sha256'], FAKE_IMAGE_0_SHA256)
+        self.assertFalse(uvtool_libvirt.delete_volume_by_name.called)
+        self.assertEqual(
+            sorted(simplestreams.query(['release=precise'])),
+            [FAKE_VOLUME_NAME_0, FAKE_VOLUME_NAME_0]
+        )
+
+    def testSyncSharesIdenticalImages(self, libvirt, uvtool_libvirt):
+        self._testSyncSharesIdenticalImages(uvtool_libvirt)
+
+    def testSyncSharesIdenticalImagesWithJobs(self, libvirt, uvtool_libvirt):
+        self._testSyncSharesIdenticalImages(
+            uvtool_libvirt, extra_args='--jobs 2')
+
+    def testQuery(self, libvirt, uvtool_libvirt):
+        for encoded_name, version, release, volume_name in [
+                (ENCODED_FAKE_VOLUME_PRODUCT_NAME_0, FAKE_VOLUME_VERSION_0,
+                    'precise', FAKE_VOLUME_NAME_0),
+                (ENCODED_FAKE_VOLUME_PRODUCT_NAME_1, FAKE_VOLUME_VERSION_1,
+                    'trusty', FAKE_VOLUME_NAME_1)]:
+            simplestreams.get_pool_metadata()[encoded_name] = {
+                'product_name': FAKE_VOLUME_PRODUCT_NAME,
+                'version_name': version,
+                'release': release,
+                'arch': 'amd64',
+                'libvirt_volume': volume_name,
+            }
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_0, FAKE_VOLUME_NAME_1]
+        self.assertEqual(
+            list(simplestreams.query(['arch=amd64', 'release~^pre'])),
+            [FAKE_VOLUME_NAME_0]
+        )
+        self.assertEqual(
+            list(simplestreams.query(['release!=precise', 'label='])),
+            [FAKE_VOLUME_NAME_1]
+        )
+        self.assertEqual(list(simplestreams.query(['arch=armhf'])), [])
+        # Images whose volume has gone are not reported
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            FAKE_VOLUME_NAME_1]
+        self.assertEqual(list(simplestreams.query(['arch=amd64'])),
+            [FAKE_VOLUME_NAME_1])
+        with mock.patch('sys.stdout', new_callable=io.BytesIO) as stdout:
+            simplestreams.main(['query', '--format', 'json', 'arch=amd64'])
+        result = json.loads(stdout.getvalue().decode('utf-8'))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['release'], 'trusty')
+        self.assertEqual(result[0]['libvirt_volume'], FAKE_VOLUME_NAME_1)
+
+    def testCleanKeepsReferencedVolumes(self, libvirt, uvtool_libvirt):
+        simplestreams.get_pool_metadata().clear()
+        # Metadata from before volumes were shared refers to a volume of the
+        # same name as itself.
+        pool_metadata = simplestreams.get_pool_metadata()
+        pool_metadata[ENCODED_FAKE_VOLUME_PRODUCT_NAME_0] = {}
+        pool_metadata[ENCODED_FAKE_VOLUME_PRODUCT_NAME_1] = {
+            'libvirt_volume': FAKE_VOLUME_NAME_1}
+        _mock_domains(uvtool_libvirt, {})
+        uvtool_libvirt.volume_names_in_pool.return_value = [
+            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0,
+            FAKE_VOLUME_NAME_0,
+            FAKE_VOLUME_NAME_1,
+        ]
+        conn = mock.Mock()
+        simplestreams.clean_extraneous_images(conn)
+        uvtool_libvirt.delete_volume_by_name.assert_called_once_with(
+            FAKE_VOLUME_NAME_0, pool_name=simplestreams.LIBVIRT_POOL_NAME,
+            conn=conn
+        )
+
     def _testResync(self, libvirt, uvtool_libvirt, old_volume_delete_expected,
-            volumes_in_use=None):
+            volumes_in_use=None, extra_args=''):
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            fake_create_volume_from_fobj)
         uvtool_libvirt.have_volume_by_name.side_effect = (
-            lambda name, **kwargs: name == ENCODED_FAKE_VOLUME_PRODUCT_NAME_0)
-        if volumes_in_use:
-            uvtool_libvirt.get_all_domain_volume_names.return_value = list(
-                volumes_in_use)
-        else:
-            uvtool_libvirt.get_all_domain_volume_names.return_value = []
+            lambda name, **kwargs: name == FAKE_VOLUME_NAME_0)
+        _mock_domains(uvtool_libvirt, {'foo': volumes_in_use or []})
         uvtool_libvirt.volume_names_in_pool.return_value = [
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            FAKE_VOLUME_NAME_0]
         simplestreams.main(
             'sync '
             '--no-authentication '
@@ -108,21 +418,20 @@ class TestSimpleStreams(unittest.TestCase):
         )
         uvtool_libvirt.reset_mock()
         uvtool_libvirt.volume_names_in_pool.return_value = [
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
-        simplestreams.main(
+            FAKE_VOLUME_NAME_0]
+        simplestreams.main((
             'sync '
             '--no-authentication '
             '--source=uvtool/tests/streams/fake_stream_1 '
             '--path streams/v1/index.json '
-            'release=precise arch=amd64 '
-            .split()
-        )
+            'release=precise arch=amd64 ' + extra_args
+        ).split())
         # create_volume_from_fobj should have been called exactly once to
         # create the volume with the name that we expect
         self.assertEqual(uvtool_libvirt.create_volume_from_fobj.call_count, 1)
         self.assertEqual(
             uvtool_libvirt.create_volume_from_fobj.call_args[0][0],
-            ENCODED_FAKE_VOLUME_PRODUCT_NAME_1
+            FAKE_VOLUME_NAME_1
         )
 
         if old_volume_delete_expected:
@@ -132,7 +441,7 @@ class TestSimpleStreams(unittest.TestCase):
                 uvtool_libvirt.delete_volume_by_name.call_count, 1)
             self.assertEqual(
                 uvtool_libvirt.delete_volume_by_name.call_args[0][0],
-                ENCODED_FAKE_VOLUME_PRODUCT_NAME_0
+                FAKE_VOLUME_NAME_0
             )
         else:
             # delete_volume_by_name should not have been called at all
@@ -150,13 +459,20 @@ class TestSimpleStreams(unittest.TestCase):
                 'delete_volume_by_name',
                 #'get_libvirt_pool_object().storageVolLookupByName().delete',
 
-                # side effects that we have checked already
-                'get_all_domain_volume_names',
-
                 # whitelist of query functions that produce no side effects
+                'UploadStats',
+                'DomainVolumeGraph',
+                'DomainVolumeGraph().domain_dependency_paths',
+                'DomainVolumeGraph().domain_disk_paths',
+                'DomainVolumeGraph().domain_names',
+                'DomainVolumeGraph().domain_uuid',
+                'DomainVolumeGraph().volume',
                 'create_volume_from_fobj',
+                'get_connection',
                 'get_libvirt_pool_object',
                 'have_volume_by_name',
+                'session.close',
+                'volume_allocation',
                 'volume_names_in_pool',
                 #'get_libvirt_pool_object().storageVolLookupByName',
             ])
@@ -164,11 +480,105 @@ class TestSimpleStreams(unittest.TestCase):
     def testResync(self, libvirt, uvtool_libvirt):
         self._testResync(libvirt, uvtool_libvirt, True)
 
+    def testResyncWithJobs(self, libvirt, uvtool_libvirt):
+        self._testResync(libvirt, uvtool_libvirt, True,
+            extra_args='--jobs 2 --bandwidth-limit 1000000')
+        self.assertEqual(
+            list(simplestreams.get_pool_metadata().keys()),
+            [ENCODED_FAKE_VOLUME_PRODUCT_NAME_1]
+        )
+
+    def testSyncChecksumMismatchWithJobs(self, libvirt, uvtool_libvirt):
+        simplestreams.get_pool_metadata().clear()
+        uvtool_libvirt.have_volume_by_name.return_value = False
+        uvtool_libvirt.create_volume_from_fobj.side_effect = (
+            lambda new_volume_name, fobj, **kwargs: fobj.read(4))
+        self.assertRaises(
+            simplestreams.ChecksumError,
+            simplestreams.main,
+            'sync '
+            '--no-authentication '
+            '--source=uvtool/tests/streams/fake_stream_0 '
+            '--path streams/v1/index.json '
+            '--jobs 2 '
+            '--no-download-cache '
+            'release=precise arch=amd64 '
+            .split()
+        )
+        self.assertNotIn(
+            ENCODED_FAKE_VOLUME_PRODUCT_NAME_0,
+            simplestreams.get_pool_metadata()
+        )
+
     def testResyncWithDomainUsingOldVolume(self, libvirt, uvtool_libvirt):
         self._testResync(
             libvirt,
             uvtool_libvirt,
             False,
-            ['foo.qcow', 'foo-ds.qcow', ENCODED_FAKE_VOLUME_PRODUCT_NAME_0]
+            ['foo.qcow', 'foo-ds.qcow', FAKE_VOLUME_NAME_0]
         )
 
+
+
+@mock.patch('uvtool.libvirt.libvirt')
+class TestLoadProducts(unittest.TestCase):
+    def setUp(self):
+        _patch_metadata_dir(self)
+        uvtool.libvirt.session.close()
+        self.addCleanup(uvtool.libvirt.session.close)
+
+    def testOneConnection(self, libvirt):
+        conn = libvirt.open.return_value
+        pool = conn.storagePoolLookupByName.return_value
+        for i in range(20):
+            version_name = '2013%04d' % i
+            simplestreams.get_pool_metadata()[
+                simplestreams._encode_libvirt_pool_name(
+                    FAKE_VOLUME_PRODUCT_NAME, version_name)
+            ] = {
+                'product_name': FAKE_VOLUME_PRODUCT_NAME,
+                'version_name': version_name,
+                'libvirt_volume': 'volume-%d' % i,
+            }
+        pool.listVolumes.return_value = [
+            'volume-%d' % i for i in range(0, 20, 2)]
+        uvtool.libvirt.counters.clear()
+        products = simplestreams._load_products()
+        self.assertEqual(
+            len(products['products'][FAKE_VOLUME_PRODUCT_NAME]['versions']),
+            10
+        )
+        # However many images there are, the pool is listed once over a
+        # single connection.
+        self.assertEqual(uvtool.libvirt.counters['connections'], 1)
+        self.assertEqual(len(conn.mock_calls), 2)
+        self.assertEqual(pool.mock_calls, [mock.call.listVolumes()])
+
+
+class TestTokenBucket(unittest.TestCase):
+    @mock.patch('uvtool.libvirt.simplestreams.time')
+    def testConsume(self, time):
+        time.time.return_value = 100.0
+        bucket = simplestreams.TokenBucket(1000)
+        # A second's worth is available immediately
+        bucket.consume(1000)
+        self.assertFalse(time.sleep.called)
+        bucket.consume(500)
+        time.sleep.assert_called_once_with(0.5)
+
+
+class TestStartup(unittest.TestCase):
+    def testModuleImportsLittle(self):
+        # Run in a fresh interpreter, since other tests import everything.
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, uvtool.libvirt.simplestreams; '
+            'print(" ".join(sorted(sys.modules)))'
+        ])
+        modules = output.split()
+        for module in [
+                'simplestreams', 'multiprocessing', 'sqlite3', 'libvirt',
+                'lxml',
+                'uvtool.download', 'uvtool.libvirt.mirror',
+                'uvtool.libvirt.poolgc', 'uvtool.libvirt.store']:
+            self.assertNotIn(module, modules)
@@ -0,0 +1,132 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import itertools
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import mock
+
+import uvtool.ssh
+
+
+class FakeKeygen(object):
+    """Write numbered keys in place of ssh-keygen."""
+    def __init__(self):
+        self.counter = itertools.count()
+        self.key_types = []
+
+    def __call__(self, key_type, private_path):
+        n = next(self.counter)
+        self.key_types.append(key_type)
+        with open(private_path, 'wb') as f:
+            f.write(b'private %d\n' % n)
+        with open(private_path + '.pub', 'wb') as f:
+            f.write(b'public %d\n' % n)
+        return mock.Mock(**{'wait.return_value': 0})
+
+
+@mock.patch('uvtool.ssh._start_keygen', new_callable=FakeKeygen)
+class TestGenerateSSHHostKeys(unittest.TestCase):
+    def testKeyTypes(self, keygen):
+        cloud_init_keys, known_hosts = uvtool.ssh.generate_ssh_host_keys(
+            ['ed25519'])
+        self.assertEqual(keygen.key_types, ['ed25519'])
+        self.assertEqual(
+            cloud_init_keys,
+            {b'ed25519_private': b'private 0\n',
+                b'ed25519_public': b'public 0\n'}
+        )
+        self.assertEqual(known_hosts, b'public 0\n')
+
+    def testFailure(self, keygen):
+        processes = [
+            mock.Mock(**{'wait.return_value': returncode})
+            for returncode in [0, 1, 0]
+        ]
+        with mock.patch('uvtool.ssh._start_keygen', side_effect=processes):
+            self.assertRaises(
+                subprocess.CalledProcessError,
+                uvtool.ssh.generate_ssh_host_keys, ['rsa', 'dsa', 'ecdsa']
+            )
+        # Every process is reaped before giving up
+        for process in processes:
+            process.wait.assert_called_once_with()
+
+
+@mock.patch('uvtool.ssh._start_keygen', new_callable=FakeKeygen)
+class TestKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.pool = uvtool.ssh.KeyPool(os.path.join(self.tmpdir, 'keypool'))
+
+    def testEmpty(self, keygen):
+        self.assertEqual(len(self.pool), 0)
+        self.assertIsNone(self.pool.take())
+
+    def testKeysAreUsedOnce(self, keygen):
+        self.assertEqual(self.pool.fill(2), 2)
+        self.assertEqual(self.pool.fill(2), 0)
+        first = self.pool.take()
+        second = self.pool.take()
+        self.assertIsNone(self.pool.take())
+        self.assertNotEqual(first, second)
+        cloud_init_keys, known_hosts = first
+        self.assertEqual(
+            sorted(cloud_init_keys),
+            sorted(itertools.chain.from_iterable(
+                [key_type + b'_private', key_type + b'_public']
+                for key_type in uvtool.ssh.KEY_TYPES
+            ))
+        )
+        self.assertEqual(known_hosts, b''.join(
+            cloud_init_keys[key_type + b'_public']
+            for key_type in uvtool.ssh.KEY_TYPES
+        ))
+        # Nothing is left behind
+        self.assertEqual(
+            sorted(os.listdir(self.pool.directory)), ['.lock', '.size'])
+
+    def testSizeIsRemembered(self, keygen):
+        self.pool.fill(3)
+        self.pool.take()
+        self.assertEqual(self.pool.fill(), 1)
+        self.assertEqual(len(self.pool), 3)
+
+    def testUnfinishedFillIsDiscarded(self, keygen):
+        os.makedirs(os.path.join(self.pool.directory, '.new-stale'))
+        self.pool.fill(1)
+        self.assertNotIn('.new-stale', os.listdir(self.pool.directory))
+        self.assertEqual(len(self.pool), 1)
+
+    def testTakeKeyTypes(self, keygen):
+        self.pool.fill(1)
+        cloud_init_keys, known_hosts = self.pool.take(['ed25519'])
+        self.assertEqual(
+            sorted(cloud_init_keys), [b'ed25519_private', b'ed25519_public'])
+        self.assertEqual(len(self.pool), 0)
+
+    def testConcurrentFill(self, keygen):
+        os.makedirs(self.pool.directory)
+        with open(os.path.join(self.pool.directory, '.lock'), 'wb') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            self.assertEqual(self.pool.fill(2), 0)
+        self.assertEqual(len(self.pool), 0)
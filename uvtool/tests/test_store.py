@@ -0,0 +1,131 @@
+# Copyright (C) 2014 Canonical Ltd.
+# Author: Robie Basak <robie.basak@canonical.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from uvtool.libvirt.store import MetadataStore
+
+FOO = {'release': 'precise', 'arch': 'amd64', 'label': 'release'}
+BAR = {'release': 'trusty', 'arch': 'amd64', 'label': 'daily'}
+
+
+class EqualsFilter(object):
+    """Like simplestreams.filters.ItemFilter for "key=value" or "key!=value".
+    """
+    def __init__(self, key, value, negate=False):
+        self.key = key
+        self.value = value
+        self.negate = negate
+
+    def matches(self, item):
+        return self.negate != (str(item.get(self.key, '')) == self.value)
+
+
+class TestMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        self.store = MetadataStore(self.metadata_dir)
+
+    def testDictInterface(self):
+        self.store['foo'] = FOO
+        self.store['bar'] = BAR
+        self.assertIn('foo', self.store)
+        self.assertEqual(self.store['foo'], FOO)
+        self.assertEqual(self.store.keys(), ['bar', 'foo'])
+        self.assertEqual(self.store.items(), [('bar', BAR), ('foo', FOO)])
+        del self.store['foo']
+        self.assertNotIn('foo', self.store)
+        self.assertRaises(KeyError, self.store.__delitem__, 'foo')
+        self.store.clear()
+        self.assertEqual(len(self.store), 0)
+
+    def testSelect(self):
+        self.store['foo'] = FOO
+        self.store['bar'] = BAR
+        self.assertEqual(self.store.select(release='trusty'), [('bar', BAR)])
+        self.assertEqual(
+            self.store.select(arch='amd64', label='release'), [('foo', FOO)])
+        self.assertRaises(ValueError, self.store.select, version='12.04')
+
+    def testIndex(self):
+        self.store['foo'] = FOO
+        self.store['bar'] = BAR
+        self.store['baz'] = {'arch': 'armhf', 'size': 100}
+        index = self.store.index()
+        self.assertEqual(
+            index.select([EqualsFilter('arch', 'amd64')]),
+            set(['foo', 'bar'])
+        )
+        self.assertEqual(
+            index.select([
+                EqualsFilter('arch', 'amd64'),
+                EqualsFilter('label', 'daily', negate=True),
+            ]),
+            set(['foo'])
+        )
+        # Fields are compared as strings, and a missing field as empty
+        self.assertEqual(
+            index.select([EqualsFilter('size', '100')]), set(['baz']))
+        self.assertEqual(
+            index.select([EqualsFilter('release', '')]), set(['baz']))
+        self.assertIs(self.store.index(), index)
+        del self.store['baz']
+        self.assertEqual(self.store.index().keys, frozenset(['foo', 'bar']))
+
+    def testResolution(self):
+        self.store['foo'] = FOO
+        self.assertIsNone(self.store.get_resolution('key'))
+        generation = self.store.generation()
+        self.store.set_resolution('key', 'vol', '/pool/vol', generation)
+        self.assertEqual(
+            self.store.get_resolution('key'), ('vol', '/pool/vol'))
+        MetadataStore(self.metadata_dir)['bar'] = BAR
+        self.assertIsNone(self.store.get_resolution('key'))
+        # Recorded against a generation that is already out of date
+        self.store.set_resolution('key', 'vol', '/pool/vol', generation)
+        self.assertIsNone(self.store.get_resolution('key'))
+
+    def testChangesFromAnotherInstanceAreSeen(self):
+        self.store['foo'] = FOO
+        self.assertEqual(self.store.keys(), ['foo'])
+        MetadataStore(self.metadata_dir)['bar'] = BAR
+        self.assertEqual(self.store.keys(), ['bar', 'foo'])
+
+    def testOpeningOnlyReads(self):
+        self.store['foo'] = FOO
+        self.store.set_resolution(
+            'key', 'vol', '/pool/vol', self.store.generation())
+        # Nothing takes the write lock just to read an existing database
+        with mock.patch(
+                'uvtool.libvirt.store.transaction',
+                side_effect=AssertionError("write lock taken")):
+            store = MetadataStore(self.metadata_dir)
+            self.assertEqual(store.items(), [('foo', FOO)])
+            self.assertEqual(
+                store.get_resolution('key'), ('vol', '/pool/vol'))
+
+    def testMigrateFromJSONFiles(self):
+        with open(os.path.join(self.metadata_dir, 'foo'), 'w') as f:
+            json.dump(FOO, f)
+        self.assertEqual(self.store.items(), [('foo', FOO)])
+        self.assertEqual(os.listdir(self.metadata_dir), ['.index.sqlite'])
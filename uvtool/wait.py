@@ -20,6 +20,7 @@ from __future__ import unicode_literals
 import argparse
 import contextlib
 import functools
+import os
 import socket
 import sys
 import time
@@ -37,8 +38,12 @@ class LeaseModifyWaiter(object):
         self.notifier = pyinotify.Notifier(self.wm, pyinotify.ProcessEvent())
 
     def start_watching(self):
+        # The directory is watched so that a lease file that dnsmasq
+        # replaces, rather than rewrites, is still noticed.
         self.wdd = self.wm.add_watch(
-            uvtool.libvirt.LIBVIRT_DNSMASQ_LEASE_FILE, pyinotify.IN_MODIFY)
+            os.path.dirname(uvtool.libvirt.leases.path),
+            pyinotify.IN_MODIFY | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        )
 
     def wait(self, timeout):
         if self.notifier.check_events(timeout=(timeout*1000)):